@@ -29,15 +29,21 @@ from biotite.structure.io.pdb import PDBFile
 
 SSE_BACKEND = Literal["dssp", "psea"]
 
-from train import get_train_valid_test_sets
-
-from foldingdiff.angles_and_coords import get_pdb_length
+from foldingdiff.angles_and_coords import (
+    get_pdb_length,
+    read_backbone,
+    backbone_atom_array,
+)
 
 
 def build_datasets(training_args: Dict[str, Any]):
     """
     Build datasets given args again
     """
+    # Imported here since train imports pytorch lightning, and bin/sample.py
+    # imports this module only for plotting
+    from train import get_train_valid_test_sets
+
     # Build args based on training args
     dset_args = dict(
         timesteps=training_args["timesteps"],
@@ -69,10 +75,17 @@ def count_structures_in_pdb(
 
     # Get the secondary structure
     warnings.filterwarnings("ignore", ".*elements were guessed from atom_.*")
-    source = PDBFile.read(fname)
-    if source.get_model_count() > 1:
-        return (-1, -1)
-    source_struct = source.get_structure()[0]
+    if backend == "psea":
+        # P-SEA only uses CA atoms, so the backbone is sufficient
+        backbone = read_backbone(fname)
+        if backbone.multi_model:
+            return (-1, -1)
+        source_struct = backbone_atom_array(backbone)
+    else:
+        source = PDBFile.read(fname)
+        if source.get_model_count() > 1:
+            return (-1, -1)
+        source_struct = source.get_structure()[0]
     chain_ids = np.unique(source_struct.chain_id)
     assert len(chain_ids) == 1
     chain_id = chain_ids[0]
@@ -0,0 +1,106 @@
+"""
+Export a trained model to a minimal inference bundle, holding the weights in
+safetensors format without optimizer or other training state, the configs,
+and the precomputed variance schedule tables. Bundles can be given as the
+model directory wherever a trained model directory is expected, and are loaded
+by BertForDiffusionBase.from_dir without importing pytorch lightning. After
+exporting, the model loaded from the bundle is checked against the original.
+
+Example usage:
+python bin/export_bundle.py -m wukevin/foldingdiff_cath -o foldingdiff_bundle
+python bin/sample.py -m foldingdiff_bundle -o samples
+"""
+
+import os
+import time
+import logging
+import argparse
+
+import torch
+from huggingface_hub import snapshot_download
+
+from foldingdiff import base_models
+from foldingdiff import utils
+
+logging.basicConfig(level=logging.INFO)
+
+
+@torch.no_grad()
+def check_parity(
+    model: base_models.BertForDiffusionBase,
+    bundled: base_models.BertForDiffusionBase,
+    batch_size: int = 4,
+    seq_length: int = 128,
+) -> float:
+    """
+    Check that the model loaded from the bundle gives the same outputs as the
+    original model, returning the maximum absolute difference
+    """
+    inputs = torch.randn(batch_size, seq_length, model.n_inputs)
+    timestep = torch.randint(0, 250, (batch_size, 1))
+    attn_mask = torch.ones(batch_size, seq_length)
+    diff = torch.max(
+        torch.abs(
+            model(inputs, timestep, attn_mask) - bundled(inputs, timestep, attn_mask)
+        )
+    ).item()
+    if diff > 0:
+        raise ValueError(f"Bundled model differs from the original by {diff}")
+    return diff
+
+
+def export_bundle(model_dir: str, outdir: str, best_by: str = "valid") -> None:
+    """
+    Export the model in model_dir, which can be a huggingface hub identifier,
+    to a bundle in outdir
+    """
+    if not os.path.isdir(model_dir) and utils.is_huggingface_hub_id(model_dir):
+        model_dir = snapshot_download(model_dir)
+    assert os.path.isdir(model_dir)
+
+    start = time.time()
+    model = base_models.BertForDiffusionBase.from_dir(
+        model_dir, best_by=best_by, copy_to=outdir
+    ).eval()
+    logging.info(f"Loaded from training checkpoint in {time.time() - start:.2f}s")
+    start = time.time()
+    bundled = base_models.BertForDiffusionBase.from_dir(outdir).eval()
+    logging.info(f"Loaded from bundle in {time.time() - start:.2f}s")
+    check_parity(model, bundled)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build a basic CLI parser"""
+    parser = argparse.ArgumentParser(
+        usage=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        type=str,
+        default="wukevin/foldingdiff_cath",
+        help="Path to model directory, or a repo identifier on huggingface hub",
+    )
+    parser.add_argument(
+        "-o", "--outdir", type=str, required=True, help="Directory to export to"
+    )
+    parser.add_argument(
+        "--best_by",
+        type=str,
+        choices=["train", "valid"],
+        default="valid",
+        help="Export the best model by training or validation loss",
+    )
+    return parser
+
+
+def main():
+    """Run script"""
+    args = build_parser().parse_args()
+    export_bundle(args.model, args.outdir, best_by=args.best_by)
+    logging.info(f"Exported bundle to {args.outdir}")
+
+
+if __name__ == "__main__":
+    main()
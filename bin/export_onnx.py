@@ -0,0 +1,174 @@
+"""
+Export a trained model to ONNX for sampling with foldingdiff.onnx_sampling,
+which runs on CPU with onnxruntime and does not need torch, transformers, or
+pytorch lightning. The output directory holds the denoiser graph, with dynamic
+batch and length axes, and the variance schedule and feature definitions that
+the model was trained with. After exporting, the ONNX denoiser is checked
+against the torch model. Exporting requires the onnx package, and sampling
+requires onnxruntime.
+
+Example usage:
+python bin/export_onnx.py -m wukevin/foldingdiff_cath -o foldingdiff_onnx
+python bin/sample_onnx.py foldingdiff_onnx -o samples
+"""
+
+import os
+import json
+import inspect
+import logging
+import argparse
+from typing import *
+
+import numpy as np
+import torch
+from huggingface_hub import snapshot_download
+
+from foldingdiff import base_models
+from foldingdiff import beta_schedules
+from foldingdiff import onnx_sampling
+from foldingdiff import utils
+from foldingdiff.datasets import AnglesEmptyDataset
+
+logging.basicConfig(level=logging.INFO)
+
+
+def get_sampling_config(model_dir: str) -> Dict[str, Any]:
+    """
+    Get the schedule and features the model was trained with, as used by
+    sampling.sample_simple
+    """
+    with open(os.path.join(model_dir, "training_args.json")) as source:
+        training_args = json.load(source)
+    dummy_dset = AnglesEmptyDataset.from_dir(model_dir)
+    # sample_simple always samples angles
+    feature_is_angular = dummy_dset.feature_is_angular["angles"]
+    variance_scales = [
+        training_args["variance_scale"] if is_angular else 1.0
+        for is_angular in feature_is_angular
+    ]
+    mean_offset_fname = os.path.join(model_dir, "training_mean_offset.npy")
+    mean_offset = (
+        np.load(mean_offset_fname).tolist()
+        if os.path.isfile(mean_offset_fname)
+        else None
+    )
+    betas = beta_schedules.get_variance_schedule(
+        training_args["variance_schedule"], training_args["timesteps"]
+    )
+    schedule = beta_schedules.compute_alphas(betas)
+    return {
+        "feature_names": dummy_dset.feature_names["angles"],
+        "feature_is_angular": feature_is_angular,
+        "pad": dummy_dset.pad,
+        "variance_scales": variance_scales,
+        "mean_offset": mean_offset,
+        "schedule": {k: schedule[k].tolist() for k in onnx_sampling.SCHEDULE_KEYS},
+    }
+
+
+@torch.no_grad()
+def check_parity(
+    model: base_models.BertForDiffusionBase,
+    denoiser: onnx_sampling.OnnxDenoiser,
+    shapes: Sequence[Tuple[int, int]] = ((1, 50), (5, 128)),
+    atol: float = 1e-4,
+) -> float:
+    """
+    Check that the ONNX denoiser matches the model at valid positions of the
+    given (batch, length) shapes, each with sequences of mixed length. Returns
+    the maximum absolute difference.
+    """
+    max_diff = 0.0
+    for batch_size, seq_length in shapes:
+        inputs = torch.randn(batch_size, seq_length, model.n_inputs)
+        timestep = torch.randint(0, 1000, (batch_size, 1))
+        lengths = torch.randint(1, seq_length + 1, (batch_size,))
+        lengths[0] = seq_length
+        attn_mask = (torch.arange(seq_length)[None, :] < lengths[:, None]).float()
+
+        expected = model(inputs, timestep, attn_mask).numpy()
+        actual = denoiser(inputs.numpy(), timestep.numpy(), attn_mask.numpy())
+        valid = attn_mask.bool().numpy()
+        diff = np.abs(expected[valid] - actual[valid]).max()
+        logging.info(f"Max difference for shape {(batch_size, seq_length)}: {diff}")
+        max_diff = max(max_diff, float(diff))
+    if max_diff > atol:
+        raise ValueError(f"ONNX denoiser differs from torch by {max_diff} > {atol}")
+    return max_diff
+
+
+def export_onnx(model_dir: str, outdir: str, opset: int = 14) -> str:
+    """
+    Export the model in model_dir, which can be a huggingface hub identifier,
+    to outdir. Returns the filename of the ONNX denoiser.
+    """
+    if utils.is_huggingface_hub_id(model_dir):
+        model_dir = snapshot_download(model_dir)
+    assert os.path.isdir(model_dir)
+    os.makedirs(outdir, exist_ok=True)
+
+    model = base_models.BertForDiffusionBase.from_dir(model_dir).eval()
+    config = get_sampling_config(model_dir)
+    with open(os.path.join(outdir, onnx_sampling.SAMPLING_CONFIG_FNAME), "w") as sink:
+        json.dump(config, sink, indent=4)
+
+    # Trace with a batch > 1 so the time embedding does not squeeze the batch
+    inputs = torch.randn(2, config["pad"], model.n_inputs)
+    timestep = torch.zeros(2, 1, dtype=torch.long)
+    attn_mask = torch.ones(2, config["pad"])
+    onnx_fname = os.path.join(outdir, onnx_sampling.ONNX_FNAME)
+    logging.info(f"Exporting denoiser to {onnx_fname} with opset {opset}")
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # Newer torch defaults to the dynamo exporter
+        export_kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (inputs, timestep, attn_mask),
+            onnx_fname,
+            input_names=onnx_sampling.INPUT_NAMES,
+            output_names=onnx_sampling.OUTPUT_NAMES,
+            dynamic_axes={
+                "inputs": {0: "batch", 1: "length"},
+                "timestep": {0: "batch"},
+                "attention_mask": {0: "batch", 1: "length"},
+                "predicted_noise": {0: "batch", 1: "length"},
+            },
+            opset_version=opset,
+            **export_kwargs,
+        )
+
+    check_parity(model, onnx_sampling.OnnxDenoiser(onnx_fname))
+    return onnx_fname
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build a basic CLI parser"""
+    parser = argparse.ArgumentParser(
+        usage=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        type=str,
+        default="wukevin/foldingdiff_cath",
+        help="Path to model directory, or a repo identifier on huggingface hub",
+    )
+    parser.add_argument(
+        "-o", "--outdir", type=str, required=True, help="Directory to export to"
+    )
+    parser.add_argument("--opset", type=int, default=14, help="ONNX opset version")
+    return parser
+
+
+def main():
+    """Run script"""
+    args = build_parser().parse_args()
+    onnx_fname = export_onnx(args.model, args.outdir, opset=args.opset)
+    logging.info(f"Exported denoiser to {onnx_fname}")
+
+
+if __name__ == "__main__":
+    main()
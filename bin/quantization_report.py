@@ -0,0 +1,184 @@
+"""
+Report how far sampling with a dynamic int8 quantized model drifts from the
+fp32 model. Both models sample from the same random seed, so each quantized
+sample is paired with the fp32 sample from the same starting noise. Reports
+the denoiser step latency of each model, the KL divergence between the sampled
+distributions of each angle, the mean wrapped difference between paired
+angles, and the TM-scores between paired structures if TMalign is installed.
+The report is written to quantization_report.json in the output directory.
+
+Example usage:
+python bin/quantization_report.py -m wukevin/foldingdiff_cath -o quant_report
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import multiprocessing
+from pathlib import Path
+from typing import *
+
+import numpy as np
+import pandas as pd
+import torch
+from huggingface_hub import snapshot_download
+
+from foldingdiff import base_models
+from foldingdiff import sampling
+from foldingdiff import tmalign
+from foldingdiff import utils
+from foldingdiff import custom_metrics as cm
+from foldingdiff import datasets as dsets
+from foldingdiff.angles_and_coords import create_new_chain_nerf
+
+logging.basicConfig(level=logging.INFO)
+
+
+@torch.no_grad()
+def time_denoiser(
+    model: torch.nn.Module, batch_size: int, seq_length: int, n_steps: int = 10
+) -> float:
+    """Time a single denoising step of the model, in seconds"""
+    inputs = torch.randn(batch_size, seq_length, model.n_inputs)
+    timestep = torch.randint(0, 250, (batch_size, 1))
+    attn_mask = torch.ones(batch_size, seq_length)
+    model(inputs, timestep, attn_mask)  # Warm up
+    start = time.time()
+    for _ in range(n_steps):
+        model(inputs, timestep, attn_mask)
+    return (time.time() - start) / n_steps
+
+
+def paired_tm_scores(
+    reference: Sequence[pd.DataFrame],
+    query: Sequence[pd.DataFrame],
+    outdir: Path,
+    threads: int = multiprocessing.cpu_count(),
+) -> np.ndarray:
+    """
+    TM-score of each query structure against its paired reference structure,
+    building both from angles under outdir
+    """
+    arg_tuples = []
+    for i, (r, q) in enumerate(zip(reference, query)):
+        arg_tuples.append((str(outdir / f"fp32_{i}.pdb"), r))
+        arg_tuples.append((str(outdir / f"int8_{i}.pdb"), q))
+    os.makedirs(outdir, exist_ok=True)
+    with multiprocessing.Pool(threads) as pool:
+        fnames = pool.starmap(create_new_chain_nerf, arg_tuples)
+        scores = pool.starmap(
+            tmalign.run_tmalign, zip(fnames[1::2], fnames[0::2]), chunksize=10
+        )
+    return np.array(scores)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build a basic CLI parser"""
+    parser = argparse.ArgumentParser(
+        usage=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        type=str,
+        default="wukevin/foldingdiff_cath",
+        help="Path to model directory, or a repo identifier on huggingface hub",
+    )
+    parser.add_argument(
+        "-o", "--outdir", type=str, required=True, help="Directory to write to"
+    )
+    parser.add_argument(
+        "-n", "--num", type=int, default=2, help="Number of samples *per length*"
+    )
+    parser.add_argument(
+        "-l",
+        "--lengths",
+        type=int,
+        nargs=2,
+        default=[50, 128],
+        help="Range of lengths to sample from",
+    )
+    parser.add_argument(
+        "-b", "--batchsize", type=int, default=64, help="Batch size for sampling"
+    )
+    parser.add_argument("--seed", type=int, default=6489, help="Random seed")
+    return parser
+
+
+def main():
+    """Run script"""
+    args = build_parser().parse_args()
+    outdir = Path(args.outdir)
+    os.makedirs(outdir, exist_ok=True)
+    if not os.path.isdir(args.model) and utils.is_huggingface_hub_id(args.model):
+        args.model = snapshot_download(args.model)
+
+    with open(os.path.join(args.model, "training_args.json")) as source:
+        training_args = json.load(source)
+    dummy_noised_dset = dsets.NoisedAnglesDataset(
+        dset=dsets.AnglesEmptyDataset.from_dir(args.model),
+        dset_key="angles",
+        timesteps=training_args["timesteps"],
+        exhaustive_t=False,
+        beta_schedule=training_args["variance_schedule"],
+        nonangular_variance=1.0,
+        angular_variance=training_args["variance_scale"],
+    )
+    feature_names = dummy_noised_dset.feature_names["angles"]
+
+    report = {"latency": {}}
+    sampled = {}
+    for key, quantize in [("fp32", False), ("int8", True)]:
+        model = base_models.BertForDiffusionBase.from_dir(args.model, quantize=quantize)
+        model.eval()
+        report["latency"][key] = time_denoiser(
+            model, args.batchsize, max(args.lengths) - 1
+        )
+        torch.manual_seed(args.seed)
+        sampled[key] = [
+            pd.DataFrame(s[-1], columns=feature_names)
+            for s in sampling.sample(
+                model,
+                dummy_noised_dset,
+                n=args.num,
+                sweep_lengths=tuple(args.lengths),
+                batch_size=args.batchsize,
+            )
+        ]
+    report["speedup"] = report["latency"]["fp32"] / report["latency"]["int8"]
+
+    fp32_angles = pd.concat(sampled["fp32"])
+    int8_angles = pd.concat(sampled["int8"])
+    # Differences between paired angles, wrapped to [-pi, pi)
+    diffs = utils.modulo_with_wrapped_range(
+        int8_angles.values - fp32_angles.values, -np.pi, np.pi
+    )
+    report["kl_divergence"] = {
+        ft: cm.kl_from_empirical(int8_angles[ft], fp32_angles[ft], pseudocount=True)
+        for ft in feature_names
+    }
+    report["mean_abs_difference"] = dict(
+        zip(feature_names, np.abs(diffs).mean(axis=0).tolist())
+    )
+
+    if shutil.which("TMalign"):
+        scores = paired_tm_scores(sampled["fp32"], sampled["int8"], outdir / "pdb")
+        report["tm_score"] = {
+            "mean": float(np.nanmean(scores)),
+            "min": float(np.nanmin(scores)),
+            "frac_above_0.5": float(np.nanmean(scores > 0.5)),
+        }
+    else:
+        logging.warning("TMalign not found in PATH, skipping TM-scores")
+
+    with open(outdir / "quantization_report.json", "w") as sink:
+        json.dump(report, sink, indent=4)
+    logging.info(f"Quantization report: {json.dumps(report, indent=4)}")
+
+
+if __name__ == "__main__":
+    main()
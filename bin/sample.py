@@ -19,11 +19,9 @@ from astropy.visualization.mpl_normalize import ImageNormalize
 import torch
 from huggingface_hub import snapshot_download
 
-# Import data loading code from main training script
-from train import get_train_valid_test_sets
 from annot_secondary_structures import make_ss_cooccurrence_plot
 
-from foldingdiff import modelling
+from foldingdiff import base_models
 from foldingdiff import sampling
 from foldingdiff import plotting
 from foldingdiff.datasets import AnglesEmptyDataset, NoisedAnglesDataset
@@ -58,6 +56,10 @@ def build_datasets(
         training_args = json.load(source)
     # Build args based on training args
     if load_actual:
+        # Import data loading code from main training script; imported here since
+        # train imports pytorch lightning, which sampling does not otherwise need
+        from train import get_train_valid_test_sets
+
         dset_args = dict(
             timesteps=training_args["timesteps"],
             variance_schedule=training_args["variance_schedule"],
@@ -284,6 +286,33 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument("--nopsea", action="store_true", help="Skip PSEA calculations")
     parser.add_argument("--seed", type=int, default=SEED, help="Random seed")
     parser.add_argument("--device", type=str, default="cuda:0", help="Device to use")
+    parser.add_argument(
+        "--fused_attention",
+        action="store_true",
+        help="Use fused scaled dot product attention, which loads the same weights",
+    )
+    parser.add_argument(
+        "--unpad_sequences",
+        action="store_true",
+        help="Skip the padding of each sequence in the encoder, implies --fused_attention",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=get_args(base_models.PRECISION),
+        default="fp32",
+        help="Precision of the encoder, bf16 runs it under autocast",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Run the model in eval mode, without dropout, traced with TorchScript for each batch shape",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Use dynamic int8 Linear layers, on CPU",
+    )
     return parser
 
 
@@ -291,6 +320,9 @@ def main() -> None:
     """Run the script"""
     parser = build_parser()
     args = parser.parse_args()
+    if args.quantize and args.device != "cpu":
+        logging.warning(f"Quantized models run on CPU, ignoring device {args.device}")
+        args.device = "cpu"
 
     logging.info(f"Creating {args.outdir}")
     os.makedirs(args.outdir, exist_ok=True)
@@ -338,9 +370,17 @@ def main() -> None:
 
     # Load the model
     model_snapshot_dir = outdir / "model_snapshot"
-    model = modelling.BertForDiffusionBase.from_dir(
-        args.model, copy_to=model_snapshot_dir
+    model = base_models.BertForDiffusionBase.from_dir(
+        args.model,
+        copy_to=model_snapshot_dir,
+        fused_attention=args.fused_attention,
+        unpad_sequences=args.unpad_sequences,
+        precision=args.precision,
+        quantize=args.quantize,
     ).to(torch.device(args.device))
+    if args.trace:
+        # The traced denoiser runs eagerly in training mode
+        model.eval()
 
     # Checks
     sweep_min_len, sweep_max_len = args.lengths
@@ -355,6 +395,7 @@ def main() -> None:
         n=args.num,
         sweep_lengths=(sweep_min_len, sweep_max_len),
         batch_size=args.batchsize,
+        trace=args.trace,
     )
     final_sampled = [s[-1] for s in sampled]
     sampled_dfs = [
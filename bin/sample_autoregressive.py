@@ -81,6 +81,9 @@ def build_parser():
         default=[50, 128],
         help="Range of lengths to sample from",
     )
+    parser.add_argument(
+        "-b", "--batchsize", type=int, default=512, help="Batch size for sampling"
+    )
     parser.add_argument(
         "-d",
         "--device",
@@ -109,6 +112,7 @@ def main() -> None:
     m = modelling.BertForAutoregressive.from_dir(
         args.model, copy_to=Path(outdir) / "model_snapshot"
     ).to(device)
+    m.eval()
 
     # Load the model offsets
     angle_offsets = torch.from_numpy(
@@ -129,13 +133,21 @@ def main() -> None:
     os.makedirs(sampled_angles_dir, exist_ok=False)
     os.makedirs(sampled_pdb_dir, exist_ok=False)
 
+    # Sample all lengths together; sequences drop out of the batch when done
+    seq_lengths = torch.arange(args.lengths[0], args.lengths[1]).repeat_interleave(
+        args.num
+    )
     sampled_angles = []
-    for i in tqdm(range(args.lengths[0], args.lengths[1]), desc="Sampling structures"):
-        seed_values = torch.zeros((args.num, 128, 6)).to(device)
-        seed_values[:, : args.num_angles, :] = initial_angles
+    for idx in tqdm(
+        torch.split(torch.arange(len(seq_lengths)), args.batchsize),
+        desc="Sampling structures",
+    ):
+        max_len = seq_lengths[idx].max().item()
+        seed_values = torch.zeros((len(idx), max_len, 6)).to(device)
+        seed_values[:, : args.num_angles, :] = initial_angles[idx % args.num]
         s = m.sample(
             seed_angles=seed_values,
-            seq_lengths=torch.tensor([i for _ in range(args.num)]).to(device),
+            seq_lengths=seq_lengths[idx].to(device),
             num_seed=args.num_angles,
             pbar=False,
         )
@@ -0,0 +1,84 @@
+"""
+Sample angles on CPU from a model exported by bin/export_onnx.py. Only needs
+numpy, pandas, and onnxruntime. Writes the final sampled angles to
+sampled_angles in the output directory, as bin/sample.py does.
+
+Example usage:
+python bin/sample_onnx.py foldingdiff_onnx -o samples -n 10 -l 50 128
+"""
+
+import os
+import logging
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+from foldingdiff.onnx_sampling import OnnxSampler
+
+logging.basicConfig(level=logging.INFO)
+
+# Same default seed as bin/sample.py
+SEED = int(
+    float.fromhex("54616977616e20697320616e20696e646570656e64656e7420636f756e747279")
+    % 10000
+)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build a basic CLI parser"""
+    parser = argparse.ArgumentParser(
+        usage=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("model", type=str, help="Directory written by export_onnx.py")
+    parser.add_argument(
+        "--outdir", "-o", type=str, default=os.getcwd(), help="Path to output directory"
+    )
+    parser.add_argument(
+        "--num",
+        "-n",
+        type=int,
+        default=10,
+        help="Number of examples to generate *per length*",
+    )
+    parser.add_argument(
+        "-l",
+        "--lengths",
+        type=int,
+        nargs=2,
+        default=[50, 128],
+        help="Range of lengths to sample from",
+    )
+    parser.add_argument(
+        "-b", "--batchsize", type=int, default=512, help="Batch size for sampling"
+    )
+    parser.add_argument(
+        "-t", "--threads", type=int, default=None, help="Threads for onnxruntime"
+    )
+    parser.add_argument("--seed", type=int, default=SEED, help="Random seed")
+    return parser
+
+
+def main():
+    """Run script"""
+    args = build_parser().parse_args()
+    sampler = OnnxSampler(args.model, num_threads=args.threads)
+    sampled = sampler.sample(
+        n=args.num,
+        sweep_lengths=tuple(args.lengths),
+        batch_size=args.batchsize,
+        seed=args.seed,
+    )
+
+    sampled_angles_folder = Path(args.outdir) / "sampled_angles"
+    os.makedirs(sampled_angles_folder, exist_ok=True)
+    logging.info(f"Writing sampled angles to {sampled_angles_folder}")
+    for i, s in enumerate(sampled):
+        pd.DataFrame(s[-1], columns=sampler.feature_names).to_csv(
+            sampled_angles_folder / f"generated_{i}.csv.gz"
+        )
+
+
+if __name__ == "__main__":
+    main()
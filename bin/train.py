@@ -19,7 +19,7 @@ import numpy as np
 from matplotlib import pyplot as plt
 
 import torch
-from torch.utils.data import Dataset, Subset
+from torch.utils.data import Dataset, IterableDataset, Subset
 from torch.utils.data.dataloader import DataLoader
 import torch.nn.functional as F
 
@@ -29,6 +29,7 @@ from pytorch_lightning.strategies.ddp import DDPStrategy
 from transformers import BertConfig
 
 from foldingdiff import datasets
+from foldingdiff import feature_store
 from foldingdiff import modelling
 from foldingdiff import losses
 from foldingdiff import beta_schedules
@@ -36,7 +37,6 @@ from foldingdiff import plotting
 from foldingdiff import utils
 from foldingdiff import custom_metrics as cm
 
-assert torch.cuda.is_available(), "Requires CUDA to train"
 # reproducibility
 torch.manual_seed(6489)
 # torch.use_deterministic_algorithms(True)
@@ -55,48 +55,54 @@ def plot_timestep_distributions(
     plots_folder: Path,
     shift_angles_zero_twopi: bool = False,
     n_intervals: int = 11,
+    hists: Optional[Dict[str, np.ndarray]] = None,
 ) -> None:
     """
-    Plot the distributions across timesteps. This is parallelized across multiple cores
+    Plot the distributions across timesteps, from the histograms given by
+    cm.timestep_histograms, which are computed if not given
     """
     ts = np.linspace(0, timesteps, num=n_intervals, endpoint=True).astype(int)
     ts = np.minimum(ts, timesteps - 1).tolist()
     logging.info(f"Plotting distributions at {ts} to {plots_folder}")
-    args = [
-        (
+    if hists is None:
+        hists = cm.timestep_histograms(train_dset, timesteps=ts)
+    t_index = {t: i for i, t in enumerate(hists["timesteps"])}
+    for t in ts:
+        fig = plotting.plot_hists_at_t(
             t,
-            train_dset,
-            True,
-            not shift_angles_zero_twopi,
-            plots_folder / f"train_dists_at_t_{t}.pdf",
+            hists["edges"],
+            hists["counts"][t_index[t]],
+            train_dset.feature_names["angles"],
+            share_axes=True,
+            zero_center_angles=not shift_angles_zero_twopi,
+            fname=plots_folder / f"train_dists_at_t_{t}.pdf",
         )
-        for t in ts
-    ]
-
-    # Parallelize the plotting
-    pool = multiprocessing.Pool(processes=min(multiprocessing.cpu_count(), len(ts)))
-    pool.starmap(plotting.plot_val_dists_at_t, args)
-    pool.close()
-    pool.join()
+        plt.close(fig)
 
 
 @pl.utilities.rank_zero_only
-def plot_kl_divergence(train_dset, plots_folder: Path) -> None:
+def plot_kl_divergence(
+    train_dset, plots_folder: Path, hists: Optional[Dict[str, np.ndarray]] = None
+) -> None:
     """
-    Plot the KL divergence over time
+    Plot the KL divergence over time, from the histograms given by
+    cm.timestep_histograms, which are computed if not given
     """
     # This works because the main body of this script should clean out the dir
     # between runs
     outname = plots_folder / "kl_divergence_timesteps.pdf"
     if outname.is_file():
         logging.info(f"KL divergence plot exists at {outname}; skipping...")
-    kl_at_timesteps = cm.kl_from_dset(train_dset)  # Shape (n_timesteps, n_features)
+    if hists is None:
+        hists = cm.timestep_histograms(train_dset)
+    # Shape (n_timesteps, n_features)
+    kl_at_timesteps = cm.kl_from_histograms(hists["counts"], hists["noise_counts"])
     n_timesteps, n_features = kl_at_timesteps.shape
     fig, axes = plt.subplots(
         dpi=300, figsize=(n_features * 3.05, 2.5), ncols=n_features, sharey=True
     )
     for i, (ft_name, ax) in enumerate(zip(train_dset.feature_names["angles"], axes)):
-        ax.plot(np.arange(n_timesteps), kl_at_timesteps[:, i], label=ft_name)
+        ax.plot(hists["timesteps"], kl_at_timesteps[:, i], label=ft_name)
         ax.axhline(0, color="grey", linestyle="--", alpha=0.5)
         ax.set(title=ft_name)
         if i == 0:
@@ -108,6 +114,19 @@ def plot_kl_divergence(train_dset, plots_folder: Path) -> None:
     fig.savefig(outname, bbox_inches="tight")
 
 
+@pl.utilities.rank_zero_only
+def plot_timestep_statistics(train_dset, timesteps: int, plots_folder: Path) -> None:
+    """
+    Plot the KL divergence over time and the distributions across timesteps,
+    both from one vectorized pass over all timesteps
+    """
+    hists = cm.timestep_histograms(train_dset)
+    plot_kl_divergence(train_dset, plots_folder, hists=hists)
+    plot_timestep_distributions(
+        train_dset, timesteps=timesteps, plots_folder=plots_folder, hists=hists
+    )
+
+
 def get_train_valid_test_sets(
     dataset_key: str = "cath",
     angles_definitions: ANGLES_DEFINITIONS = "canonical-full-angles",
@@ -123,6 +142,7 @@ def get_train_valid_test_sets(
     single_angle_debug: int = -1,  # Noise and return a single angle. -1 to disable, 1-3 for omega/theta/phi
     single_time_debug: bool = False,  # Noise and return a single time
     train_only: bool = False,
+    defer_train_noise: bool = False,  # Training set returns clean items for noise_batch
 ) -> Tuple[Dataset, Dataset, Dataset]:
     """
     Get the dataset objects to use for train/valid/test
@@ -143,18 +163,36 @@ def get_train_valid_test_sets(
 
     splits = ["train"] if train_only else ["train", "validation", "test"]
     logging.info(f"Creating data splits: {splits}")
-    clean_dsets = [
-        clean_dset_class(
-            pdbs=dataset_key,
-            split=s,
-            pad=max_seq_len,
-            min_length=min_seq_len,
-            trim_strategy=seq_trim_strategy,
-            zero_center=False if angles_definitions == "cart-coords" else True,
-            toy=toy,
-        )
-        for s in splits
-    ]
+    # A directory of shards written by bin/write_shards.py is streamed
+    streaming = feature_store.read_shard_index(dataset_key) is not None
+    if streaming:
+        assert not toy, "Toy datasets are not supported when streaming shards"
+        clean_dsets = [
+            datasets.ShardedAnglesDataset(
+                dataset_key,
+                feature_set=angles_definitions,
+                split=s,
+                pad=max_seq_len,
+                min_length=min_seq_len,
+                trim_strategy=seq_trim_strategy,
+                zero_center=False if angles_definitions == "cart-coords" else True,
+                shuffle=s == "train",
+            )
+            for s in splits
+        ]
+    else:
+        clean_dsets = [
+            clean_dset_class(
+                pdbs=dataset_key,
+                split=s,
+                pad=max_seq_len,
+                min_length=min_seq_len,
+                trim_strategy=seq_trim_strategy,
+                zero_center=False if angles_definitions == "cart-coords" else True,
+                toy=toy,
+            )
+            for s in splits
+        ]
     assert len(clean_dsets) == len(splits)
     # Set the training set mean to the validation set mean
     if len(clean_dsets) > 1 and clean_dsets[0].means is not None:
@@ -180,7 +218,16 @@ def get_train_valid_test_sets(
         else:
             dset_noiser_class = datasets.NoisedAnglesDataset
 
+    if streaming:
+        assert (
+            dset_noiser_class is datasets.NoisedAnglesDataset
+        ), "Streaming is only supported by NoisedAnglesDataset"
+        dset_noiser_class = datasets.NoisedAnglesIterableDataset
     logging.info(f"Using {dset_noiser_class} for noise")
+    if defer_train_noise or exhaustive_t:
+        assert (
+            dset_noiser_class is datasets.NoisedAnglesDataset or streaming
+        ), "Deferred noise is only supported by NoisedAnglesDataset"
     noised_dsets = [
         dset_noiser_class(
             dset=ds,
@@ -190,6 +237,12 @@ def get_train_valid_test_sets(
             beta_schedule=variance_schedule,
             nonangular_variance=1.0,
             angular_variance=var_scale,
+            # Exhaustive valid/test items are expanded across timesteps per batch
+            **(
+                dict(defer_noise=True)
+                if (i == 0 and defer_train_noise) or (i != 0 and exhaustive_t)
+                else {}
+            ),
         )
         for i, ds in enumerate(clean_dsets)
     ]
@@ -288,7 +341,7 @@ def train(
     # Controls output
     results_dir: str = "./results",
     # Controls data loading and noising process
-    dataset_key: str = "cath",  # cath, alhpafold, or a directory containing pdb files
+    dataset_key: str = "cath",  # cath, alhpafold, or a directory containing pdb files or shards
     angles_definitions: ANGLES_DEFINITIONS = "canonical-full-angles",
     max_seq_len: int = 512,
     min_seq_len: int = 0,  # 0 means no filtering based on min sequence length
@@ -307,9 +360,16 @@ def train(
     ] = "absolute",  # relative_key = https://arxiv.org/pdf/1803.02155.pdf | relative_key_query = https://arxiv.org/pdf/2009.13658.pdf
     dropout_p: float = 0.1,  # Default 0.1, can disable for debugging
     decoder: modelling.DECODER_HEAD = "mlp",
+    fused_attention: bool = False,  # Fused scaled dot product attention, same weights
+    unpad_sequences: bool = False,  # Skip padding in the encoder, implies fused_attention
+    precision: modelling.PRECISION = "fp32",  # bf16 runs the encoder under autocast
+    checkpoint_every: int = 0,  # Checkpoint activations per this many layers, 0 for off
     # Related to training strategy
     gradient_clip: float = 1.0,  # From BERT trainer
     batch_size: int = 64,
+    bucket_by_length: bool = False,  # Batch similar lengths and trim padding per batch
+    pack_sequences: bool = False,  # Pack training structures into shared rows instead of padding
+    batched_noise: bool = False,  # Noise training batches on device
     lr: float = 5e-5,  # Default lr for huggingface BERT trainer
     loss: modelling.LOSS_KEYS = "smooth_l1",
     use_pdist_loss: Union[
@@ -358,7 +418,10 @@ def train(
         exhaustive_t=exhaustive_validation_t,
         single_angle_debug=single_angle_debug,
         single_time_debug=single_timestep_debug,
+        defer_train_noise=batched_noise,
     )
+    # Streamed datasets are noised per batch, and shuffle themselves
+    streaming = isinstance(dsets[0], IterableDataset)
     # Record the masked means in the output directory
     np.save(
         results_folder / "training_mean_offset.npy",
@@ -381,15 +444,43 @@ def train(
         f"Given batch size: {batch_size} --> effective batch size with {torch.cuda.device_count()} GPUs: {effective_batch_size}"
     )
 
+    if streaming:
+        assert not bucket_by_length, "Cannot bucket by length when streaming"
+        assert not pack_sequences, "Cannot pack sequences when streaming"
+    if bucket_by_length:
+        logging.info("Bucketing batches by length and trimming padding per batch")
+        loader_kwargs = [
+            dict(
+                batch_sampler=datasets.LengthBucketedBatchSampler(
+                    ds.all_lengths,
+                    batch_size=effective_batch_size,
+                    shuffle=i == 0,  # Shuffle only train loader
+                ),
+                collate_fn=datasets.collate_trim_padding,
+            )
+            for i, ds in enumerate(dsets)
+        ]
+    else:
+        loader_kwargs = [
+            dict(batch_size=effective_batch_size, shuffle=i == 0 and not streaming)
+            for i, _ in enumerate(dsets)
+        ]
+    if pack_sequences:
+        assert not bucket_by_length, "Cannot both bucket and pack sequences"
+        assert not use_pdist_loss, "Pairwise distance loss does not support packing"
+        assert not batched_noise, "Batched noise does not support packing"
+        logging.info(f"Packing training structures into rows of {max_seq_len}")
+        loader_kwargs[0]["collate_fn"] = functools.partial(
+            datasets.collate_pack, pad=max_seq_len
+        )
     train_dataloader, valid_dataloader, test_dataloader = [
         DataLoader(
             dataset=ds,
-            batch_size=effective_batch_size,
-            shuffle=i == 0,  # Shuffle only train loader
             num_workers=multiprocessing.cpu_count() if multithread else 1,
             pin_memory=True,
+            **kwargs,
         )
-        for i, ds in enumerate(dsets)
+        for ds, kwargs in zip(dsets, loader_kwargs)
     ]
 
     # Create plots in output directories of distributions from different timesteps
@@ -401,13 +492,9 @@ def train(
         and not single_timestep_debug
         and not syn_noiser
         and not dryrun
+        and not streaming
     ):
-        plot_kl_divergence(dsets[0], plots_folder)
-        plot_timestep_distributions(
-            dsets[0],
-            timesteps=timesteps,
-            plots_folder=plots_folder,
-        )
+        plot_timestep_statistics(dsets[0], timesteps, plots_folder)
 
     # https://jaketae.github.io/study/relative-positional-encoding/
     # looking at the relative distance between things is more robust
@@ -418,7 +505,11 @@ def train(
     logging.info(f"Using loss function: {loss_fn}")
 
     # Shape of the input is (batch_size, timesteps, features)
-    sample_input = dsets[0][0]["corrupted"]  # First item of the training dset
+    # First item of the training dset
+    sample_input = next(iter(dsets[0])) if streaming else dsets[0][0]
+    sample_input = sample_input[
+        "corrupted" if "corrupted" in sample_input else dsets[0].dset_key
+    ]
     model_n_inputs = sample_input.shape[-1]
     logging.info(f"Auto detected {model_n_inputs} inputs")
 
@@ -439,6 +530,10 @@ def train(
         config=cfg,
         time_encoding=time_encoding,
         decoder=decoder,
+        fused_attention=fused_attention,
+        unpad_sequences=unpad_sequences,
+        precision=precision,
+        checkpoint_every=checkpoint_every,
         ft_is_angular=dsets[0].dset.feature_is_angular[ft_key],
         ft_names=dsets[0].dset.feature_names[ft_key],
         lr=lr,
@@ -455,6 +550,10 @@ def train(
         write_preds_to_dir=results_folder / "valid_preds"
         if write_valid_preds
         else None,
+        batch_noiser=dsets[0].noise_batch if batched_noise or streaming else None,
+        valid_timestep_batches=dsets[1].iter_timestep_batches
+        if exhaustive_validation_t and dsets[1] is not None
+        else None,
     )
     # https://stackoverflow.com/questions/49201236/check-the-total-number-of-parameters-in-a-pytorch-model
     num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -487,6 +586,8 @@ def train(
         accelerator=accelerator,
         strategy=strategy,
         gpus=ngpu,
+        # The bucketed batch sampler splits batches across replicas itself
+        replace_sampler_ddp=not bucket_by_length,
         enable_progress_bar=False,
         move_metrics_to_cpu=False,  # Saves memory
     )
@@ -543,15 +644,20 @@ def build_parser() -> argparse.ArgumentParser:
         "--ngpu", type=int, default=-1, help="Number of GPUs to use (-1 for all)"
     )
     parser.add_argument("--dryrun", action="store_true", help="Dry run")
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=get_args(modelling.PRECISION),
+        default=None,
+        help="Precision of the encoder, overriding the config",
+    )
     return parser
 
 
-def main():
-    """Run the training script based on params in the given json file"""
-    parser = build_parser()
-    args = parser.parse_args()
-
-    # Load in parameters and run training loop
+def build_config_args(args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Build the keyword arguments to train from the json config and CLI args
+    """
     config_args = {}  # Empty dictionary as default
     if args.config:
         with open(args.config) as source:
@@ -567,7 +673,22 @@ def main():
             "dryrun": args.dryrun,
         },
     )
-    train(**config_args)
+    # Only override precision if given, otherwise fall back to config or default
+    if args.precision is not None:
+        config_args = utils.update_dict_nonnull(
+            config_args, {"precision": args.precision}
+        )
+    return config_args
+
+
+def main():
+    """Run the training script based on params in the given json file"""
+    assert torch.cuda.is_available(), "Requires CUDA to train"
+    parser = build_parser()
+    args = parser.parse_args()
+
+    # Load in parameters and run training loop
+    train(**build_config_args(args))
 
 
 if __name__ == "__main__":
@@ -30,6 +30,7 @@ def get_train_valid_test_sets(
     max_seq_len: int = 512,
     min_seq_len: int = 0,
     seq_trim_strategy: datasets.TRIM_STRATEGIES = "leftalign",
+    all_positions: bool = False,
 ) -> Tuple[
     datasets.AutoregressiveCausalDataset,
     datasets.AutoregressiveCausalDataset,
@@ -68,7 +69,9 @@ def get_train_valid_test_sets(
 
     causal_dsets = [
         datasets.AutoregressiveCausalDataset(
-            d, dset_key="coords" if angles_definitions == "cart-coords" else "angles"
+            d,
+            dset_key="coords" if angles_definitions == "cart-coords" else "angles",
+            all_positions=all_positions,
         )
         for d in clean_dsets
     ]
@@ -105,6 +108,7 @@ def train(
     early_stop_patience: int = 0,  # Set to 0 to disable early stopping
     lr_scheduler: modelling.LR_SCHEDULE = "LinearWarmup",  # Try LinearWarmup?
     use_swa: bool = False,
+    all_positions: bool = False,  # Teacher forced targets at every position, causally masked
 ):
     """
     Train the model
@@ -123,6 +127,7 @@ def train(
         max_seq_len=max_seq_len,
         min_seq_len=min_seq_len,
         seq_trim_strategy=trim_strategy,
+        all_positions=all_positions,
     )
     assert len(dsets) == 3
     np.save(
@@ -185,6 +190,7 @@ def train(
         epochs=max_epochs,
         steps_per_epoch=len(train_dataloader),
         lr_scheduler=lr_scheduler,
+        causal=all_positions,
     )
     # https://stackoverflow.com/questions/49201236/check-the-total-number-of-parameters-in-a-pytorch-model
     num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -0,0 +1,115 @@
+"""
+Featurize a corpus of PDB files into shards that can be streamed during
+training by datasets.ShardedAnglesDataset, for corpora that do not fit in
+memory. Files are featurized in parallel and written out as they are done,
+so memory use is bounded by the shard size. Files that cannot be featurized
+are listed with the reason in failures.json in the output directory.
+
+To train on the shards, give the output directory as the dataset_key.
+
+Example usage:
+python bin/write_shards.py data/alphafold data/alphafold_shards
+"""
+
+import os
+import json
+import logging
+import argparse
+import multiprocessing
+from typing import *
+
+from foldingdiff import datasets
+from foldingdiff import utils
+from foldingdiff.angles_and_coords import EXHAUSTIVE_ANGLES, EXHAUSTIVE_DISTS
+from foldingdiff.feature_store import ShardWriter
+
+logging.basicConfig(level=logging.INFO)
+
+FEATURE_NAMES = EXHAUSTIVE_DISTS + EXHAUSTIVE_ANGLES
+FAILURES_FNAME = "failures.json"
+
+
+def write_shards(
+    pdbs: str,
+    outdir: str,
+    structures_per_shard: int = 2000,
+    threads: int = multiprocessing.cpu_count(),
+    timeout: Optional[float] = None,
+) -> str:
+    """
+    Featurize the structures in pdbs, which can be a directory or a keyword
+    recognized by the datasets, into shards under outdir. Files that fail or
+    take longer than timeout seconds are recorded in failures.json under outdir.
+    Returns the filename of the shard index.
+    """
+    fnames = sorted(datasets.get_pdb_fnames(pdbs))
+    writer = ShardWriter(
+        outdir, feature_names=FEATURE_NAMES, structures_per_shard=structures_per_shard
+    )
+    stats = datasets.ShardSplitStatistics(n_features=len(FEATURE_NAMES))
+    failures = {}
+    for fname, s, error in datasets.featurize_files(
+        fnames, num_workers=threads, timeout=timeout
+    ):
+        if s is None:
+            failures[fname] = error
+            continue
+        key = utils.md5_file(fname)
+        angles = s["angles"].loc[:, FEATURE_NAMES].values
+        writer.add({"angles": angles, "coords": s["coords"], "fname": fname}, key)
+        stats.add(key, angles)
+    with open(os.path.join(outdir, FAILURES_FNAME), "w") as sink:
+        json.dump(failures, sink, indent=4)
+    if failures:
+        logging.warning(f"Failed to featurize {len(failures)} structures")
+    return writer.close(metadata={"splits": stats.to_dict()})
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build a basic CLI parser"""
+    parser = argparse.ArgumentParser(
+        usage=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "pdbs", type=str, help="Directory of PDB files, or cath/alphafold"
+    )
+    parser.add_argument("outdir", type=str, help="Directory to write shards to")
+    parser.add_argument(
+        "-n",
+        "--structures_per_shard",
+        type=int,
+        default=2000,
+        help="Number of structures in each shard",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Number of processes to featurize with",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Seconds after which to give up on featurizing a file",
+    )
+    return parser
+
+
+def main():
+    """Run script"""
+    args = build_parser().parse_args()
+    index_fname = write_shards(
+        args.pdbs,
+        args.outdir,
+        structures_per_shard=args.structures_per_shard,
+        threads=args.threads,
+        timeout=args.timeout,
+    )
+    logging.info(f"Wrote shard index to {index_fname}")
+
+
+if __name__ == "__main__":
+    main()
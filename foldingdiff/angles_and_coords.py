@@ -27,23 +27,166 @@ MINIMAL_ANGLES = ["phi", "psi", "omega"]
 MINIMAL_DISTS = []
 
 
-def canonical_distances_and_dihedrals(
-    fname: str,
-    distances: List[str] = MINIMAL_DISTS,
-    angles: List[str] = MINIMAL_ANGLES,
-) -> Optional[pd.DataFrame]:
-    """Parse the pdb file for the given values"""
+BackboneRecords = namedtuple(
+    "BackboneRecords",
+    [
+        "coords",
+        "atom_names",
+        "res_ids",
+        "ins_codes",
+        "res_names",
+        "chain_ids",
+        "multi_model",
+    ],
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _amino_acid_names() -> FrozenSet[str]:
+    """Residue names that biotite considers amino acids"""
+    return frozenset(struc.info.amino_acid_names())
+
+
+def read_backbone(fname: str) -> BackboneRecords:
+    """
+    Read only the N, CA, C atoms of amino acids from the first model of the
+    pdb file, scanning ATOM/HETATM records rather than building a full
+    AtomArray. Alternate locations are resolved as in biotite (the first
+    altloc in each residue). multi_model is True if the file contains more
+    than one model; reading stops at the start of the second model.
+    """
+    assert os.path.isfile(fname)
+    backbone_names = ("N", "CA", "C")
+    amino_acids = _amino_acid_names()
+    coords, atom_names, res_ids, ins_codes, res_names, chain_ids = [], [], [], [], [], []
+    multi_model = False
+    n_models = 0
+    curr_residue, curr_altloc = None, None
+    opener = gzip.open if fname.endswith(".gz") else open
+    with opener(str(fname), "rt") as f:
+        for line in f:
+            if line.startswith("MODEL"):
+                n_models += 1
+                if n_models > 1:
+                    multi_model = True
+                    break
+                continue
+            if not (line.startswith("ATOM") or line.startswith("HETATM")):
+                continue
+            # Track the first altloc of each residue, counting all its atoms
+            residue = line[17:27]
+            if residue != curr_residue:
+                curr_residue, curr_altloc = residue, None
+            altloc = line[16]
+            if altloc != " ":
+                if curr_altloc is None:
+                    curr_altloc = altloc
+                elif altloc != curr_altloc:
+                    continue
+            atom_name = line[12:16].strip()
+            if atom_name not in backbone_names:
+                continue
+            res_name = line[17:20].strip()
+            if res_name not in amino_acids:
+                continue
+            coords.append((line[30:38], line[38:46], line[46:54]))
+            atom_names.append(atom_name)
+            res_ids.append(line[22:26])
+            ins_codes.append(line[26].strip())
+            res_names.append(res_name)
+            chain_ids.append(line[21].strip())
+    return BackboneRecords(
+        coords=np.array(coords, dtype=np.float32).reshape(-1, 3),
+        atom_names=np.array(atom_names, dtype="U6"),
+        res_ids=np.array(res_ids, dtype=int),
+        ins_codes=np.array(ins_codes, dtype="U1"),
+        res_names=np.array(res_names, dtype="U5"),
+        chain_ids=np.array(chain_ids, dtype="U4"),
+        multi_model=multi_model,
+    )
+
+
+def backbone_atom_array(backbone: BackboneRecords) -> struc.AtomArray:
+    """Build a backbone only AtomArray from the records of read_backbone"""
+    atoms = struc.AtomArray(len(backbone.coords))
+    atoms.coord = backbone.coords
+    atoms.atom_name = backbone.atom_names
+    atoms.res_id = backbone.res_ids
+    atoms.ins_code = backbone.ins_codes
+    atoms.res_name = backbone.res_names
+    atoms.chain_id = backbone.chain_ids
+    # Backbone atom names start with their element
+    atoms.element = np.array([a[0] for a in backbone.atom_names], dtype="U2")
+    return atoms
+
+
+def read_structure(fname: str) -> Optional[struc.AtomArray]:
+    """
+    Parse the pdb file into an AtomArray, returning None if the file contains
+    more than one model
+    """
     assert os.path.isfile(fname)
     warnings.filterwarnings("ignore", ".*elements were guessed from atom_.*")
-    warnings.filterwarnings("ignore", ".*invalid value encountered in true_div.*")
     opener = gzip.open if fname.endswith(".gz") else open
     with opener(str(fname), "rt") as f:
         source = PDBFile.read(f)
     if source.get_model_count() > 1:
         return None
     # Pull out the atomarray from atomarraystack
-    source_struct = source.get_structure()[0]
+    return source.get_structure()[0]
+
+
+def featurize_structure(
+    source: Union[str, struc.AtomArray],
+    distances: List[str] = EXHAUSTIVE_DISTS,
+    angles: List[str] = EXHAUSTIVE_ANGLES,
+    coord_atoms: Collection[Literal["N", "CA", "C"]] = ["CA"],
+) -> Optional[Dict[str, Any]]:
+    """
+    Compute the given distances and angles, and the backbone coordinates of
+    coord_atoms, from a pdb file or an already parsed AtomArray. The file is
+    parsed only once. Returns a dict with keys (angles, coords), or None if
+    the structure cannot be featurized.
+    """
+    if isinstance(source, str):
+        backbone = read_backbone(source)
+        if backbone.multi_model:
+            return None
+        fname, source_struct = source, backbone_atom_array(backbone)
+    else:
+        fname, source_struct = "<AtomArray>", source
+    calc_angles = _distances_and_dihedrals(source_struct, distances, angles, fname)
+    if calc_angles is None:
+        return None
+    backbone = source_struct[struc.filter_backbone(source_struct)]
+    coords = backbone.coord[np.isin(backbone.atom_name, coord_atoms)]
+    return {"angles": calc_angles, "coords": coords}
+
+
+def canonical_distances_and_dihedrals(
+    fname: Union[str, struc.AtomArray],
+    distances: List[str] = MINIMAL_DISTS,
+    angles: List[str] = MINIMAL_ANGLES,
+) -> Optional[pd.DataFrame]:
+    """Parse the pdb file (or take the given AtomArray) for the given values"""
+    if isinstance(fname, str):
+        backbone = read_backbone(fname)
+        if backbone.multi_model:
+            return None
+        return _distances_and_dihedrals(
+            backbone_atom_array(backbone), distances, angles, fname
+        )
+    return _distances_and_dihedrals(fname, distances, angles, "<AtomArray>")
 
+
+def _distances_and_dihedrals(
+    source_struct: struc.AtomArray,
+    distances: List[str],
+    angles: List[str],
+    fname: str,
+) -> Optional[pd.DataFrame]:
+    """Compute the given values from the structure; fname is used for logging"""
+    warnings.filterwarnings("ignore", ".*invalid value encountered in true_div.*")
     # First get the dihedrals
     try:
         phi, psi, omega = struc.dihedral_backbone(source_struct)
@@ -258,13 +401,10 @@ def get_pdb_length(fname: str) -> int:
     """
     Get the length of the chain described in the PDB file
     """
-    warnings.filterwarnings("ignore", ".*elements were guessed from atom_.*")
-    structure = PDBFile.read(fname)
-    if structure.get_model_count() > 1:
+    backbone = read_backbone(fname)
+    if backbone.multi_model:
         return -1
-    chain = structure.get_structure()[0]
-    backbone = chain[struc.filter_backbone(chain)]
-    l = int(len(backbone) / 3)
+    l = int(len(backbone.coords) / 3)
     return l
 
 
@@ -272,15 +412,10 @@ def extract_backbone_coords(
     fname: str, atoms: Collection[Literal["N", "CA", "C"]] = ["CA"]
 ) -> Optional[np.ndarray]:
     """Extract the coordinates of the alpha carbons"""
-    opener = gzip.open if fname.endswith(".gz") else open
-    with opener(str(fname), "rt") as f:
-        structure = PDBFile.read(f)
-    if structure.get_model_count() > 1:
+    backbone = read_backbone(fname)
+    if backbone.multi_model:
         return None
-    chain = structure.get_structure()[0]
-    backbone = chain[struc.filter_backbone(chain)]
-    ca = [c for c in backbone if c.atom_name in atoms]
-    coords = np.vstack([c.coord for c in ca])
+    coords = backbone.coords[np.isin(backbone.atom_names, atoms)]
     return coords
 
 
@@ -0,0 +1,733 @@
+"""
+Model architectures, without the pytorch lightning training code in modelling.py,
+so that trained models can be built for inference without importing pytorch
+lightning, e.g. from an inference bundle written by bin/export_bundle.py
+"""
+import os
+import re
+import time
+import glob
+import json
+import logging
+import math
+import functools
+from typing import *
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from transformers import BertConfig
+from transformers.models.bert.modeling_bert import (
+    BertPreTrainedModel,
+    BertEncoder,
+)
+from transformers.activations import get_activation
+
+from tqdm.auto import tqdm
+
+from foldingdiff import inference_bundle, losses
+from foldingdiff.checkpointing import run_layers
+from foldingdiff.fused_attention import FusedBertEncoder
+from foldingdiff.kv_cache import KVCache, encode_incremental
+
+TIME_ENCODING = Literal["gaussian_fourier", "sinusoidal"]
+DECODER_HEAD = Literal["mlp", "linear"]
+PRECISION = Literal["fp32", "bf16"]
+PRECISION_DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16}
+
+
+class GaussianFourierProjection(nn.Module):
+    """
+    Gaussian random features for encoding time steps.
+    Built primarily for score-based models.
+
+    Source:
+    https://colab.research.google.com/drive/120kYYBOVa1i0TD85RjlEkFjaWDxSFUx3?usp=sharing#scrollTo=YyQtV7155Nht
+    """
+
+    def __init__(self, embed_dim: int, scale: float = 2 * torch.pi):
+        super().__init__()
+        # Randomly sample weights during initialization. These weights are fixed
+        # during optimization and are not trainable.
+        w = torch.randn(embed_dim // 2) * scale
+        assert w.requires_grad == False
+        self.register_buffer("W", w)
+
+    def forward(self, x: torch.Tensor):
+        """
+        takes as input the time vector and returns the time encoding
+        time (x): (batch_size, )
+        output  : (batch_size, embed_dim)
+        """
+        if x.ndim > 1:
+            x = x.squeeze()
+        elif x.ndim < 1:
+            x = x.unsqueeze(0)
+        x_proj = x[:, None] * self.W[None, :] * 2 * torch.pi
+        embed = torch.cat([torch.sin(x_proj), torch.cos(x_proj)], dim=-1)
+        return embed
+
+
+class SinusoidalPositionEmbeddings(nn.Module):
+    """
+    Positional embeddings
+    """
+
+    def __init__(self, dim: int) -> None:
+        super().__init__()
+        self.dim = dim
+
+    def forward(self, time: torch.Tensor) -> torch.Tensor:
+        device = time.device
+        half_dim = self.dim // 2
+        embeddings = math.log(10000) / (half_dim - 1)
+        # half_dim shape
+        embeddings = torch.exp(torch.arange(half_dim, device=device) * -embeddings)
+        # outer product (batch, 1) x (1, half_dim) -> (batch x half_dim)
+        embeddings = time[:, None] * embeddings[None, :]
+        # sin and cosine embeddings
+        embeddings = torch.cat((embeddings.sin(), embeddings.cos()), dim=-1)
+        return embeddings
+
+
+class PositionalEncoding(nn.Module):
+    """
+    Positional embedding for BERT.
+    Source: https://pytorch.org/tutorials/beginner/transformer_tutorial.html
+    """
+
+    def __init__(self, d_model: int, dropout: float = 0.1, max_len: int = 5000):
+        super().__init__()
+        self.dropout = nn.Dropout(p=dropout)
+
+        position = torch.arange(max_len).unsqueeze(1)
+        div_term = torch.exp(
+            torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model)
+        )
+        pe = torch.zeros(max_len, 1, d_model)
+        pe[:, 0, 0::2] = torch.sin(position * div_term)
+        pe[:, 0, 1::2] = torch.cos(position * div_term)
+        self.register_buffer("pe", pe)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            x: Tensor, shape [batch_size, seq_len, embedding_dim]
+        """
+        assert len(x.shape) == 3
+        orig_shape = x.shape
+        # x is a tensor of shape (batch_size, seq_len, embedding_dim)
+        # permute to be (seq_len, batch_size, embedding_dim)
+        x = x.permute(1, 0, 2)
+        x += self.pe[: x.size(0)]
+        # permute back to (batch_size, seq_len, embedding_dim)
+        x = x.permute(1, 0, 2)
+        assert x.shape == orig_shape, f"{x.shape} != {orig_shape}"
+        return self.dropout(x)
+
+
+class BertEmbeddings(nn.Module):
+    """
+    Adds in positional embeddings if using absolute embeddings, adds layer norm and dropout
+    """
+
+    def __init__(self, config):
+        super().__init__()
+        self.position_embedding_type = getattr(
+            config, "position_embedding_type", "absolute"
+        )
+        if self.position_embedding_type == "absolute":
+            self.position_embeddings = nn.Embedding(
+                config.max_position_embeddings, config.hidden_size
+            )
+            self.register_buffer(
+                "position_ids",
+                torch.arange(config.max_position_embeddings).expand((1, -1)),
+            )
+
+        # self.LayerNorm is not snake-cased to stick with TensorFlow model variable name and be able to load
+        # any TensorFlow checkpoint file
+        self.LayerNorm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        # position_ids (1, len position emb) is contiguous in memory and exported when serialized
+
+    def forward(
+        self,
+        input_embeds: torch.Tensor,
+        position_ids: torch.LongTensor,
+    ) -> torch.Tensor:
+        assert position_ids is not None, "`position_ids` must be defined"
+        embeddings = input_embeds
+        if self.position_embedding_type == "absolute":
+            position_embeddings = self.position_embeddings(position_ids)
+            embeddings += position_embeddings
+
+        embeddings = self.LayerNorm(embeddings)
+        embeddings = self.dropout(embeddings)
+        return embeddings
+
+
+class AnglesPredictor(nn.Module):
+    """
+    Predict angles from the embeddings. For BERT, the MLM task is done using an
+    architecture like
+    d_model -> dense -> d_model -> activation -> layernorm -> dense -> d_output
+    https://github.com/huggingface/transformers/blob/v4.21.1/src/transformers/models/bert/modeling_bert.py#L681
+
+    activation should be given as nn.ReLU for example -- NOT nn.ReLU()
+    """
+
+    def __init__(
+        self,
+        d_model: int,
+        d_out: int = 4,
+        activation: Union[str, nn.Module] = "gelu",
+        eps: float = 1e-12,
+    ) -> None:
+        super().__init__()
+        self.d_model = d_model
+        self.d_out = d_out
+        self.dense1 = nn.Linear(d_model, d_model)
+
+        if isinstance(activation, str):
+            self.dense1_act = get_activation(activation)
+        else:
+            self.dense1_act = activation()
+        self.layer_norm = nn.LayerNorm(d_model, eps=eps)
+
+        self.dense2 = nn.Linear(d_model, d_out)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = self.dense1(x)
+        x = self.dense1_act(x)
+        x = self.layer_norm(x)
+        x = self.dense2(x)
+        return x
+
+
+class BertForDiffusionBase(BertPreTrainedModel):
+    """
+    BERT designed to be used with continuous inputs instead of tokens
+
+    Reference: https://github.com/huggingface/transformers/blob/f681437203baa7671de3174b0fa583c349d9d5e1/src/transformers/models/bert/modeling_bert.py#L870
+
+    Decoder: linear = single linear decoding of per-position embeddings
+             mlp = two-layer MLP to decode per-position embeddings
+
+    This is the base model object and does _not_ include the pytorch lightning code
+    """
+
+    # Define loss functions and their wrapped angular versions
+    nonangular_loss_fn_dict = {
+        "l1": F.l1_loss,
+        "smooth_l1": F.smooth_l1_loss,
+    }
+    angular_loss_fn_dict = {
+        "l1": losses.radian_l1_loss,
+        "smooth_l1": functools.partial(
+            losses.radian_smooth_l1_loss, beta=torch.pi / 10
+        ),
+    }
+    # Betas of (angular, non-angular) features to compute each of the losses above
+    # for all features at once with losses.feature_smooth_l1_loss
+    fused_loss_betas_dict = {
+        "l1": (0.0, 0.0),
+        "smooth_l1": (torch.pi / 10, 1.0),
+    }
+    # To have legacy models still work with these
+    loss_autocorrect_dict = {
+        "radian_l1_smooth": "smooth_l1",
+    }
+
+    def __init__(
+        self,
+        config,
+        ft_is_angular: List[bool] = [False, True, True, True],
+        ft_names: Optional[List[str]] = None,
+        time_encoding: TIME_ENCODING = "gaussian_fourier",
+        decoder: DECODER_HEAD = "mlp",
+        fused_attention: bool = False,
+        unpad_sequences: bool = False,
+        precision: PRECISION = "fp32",
+        checkpoint_every: int = 0,
+    ) -> None:
+        """
+        dim should be the dimension of the inputs. fused_attention uses an encoder
+        with fused scaled dot product attention, which loads the same weights.
+        unpad_sequences additionally skips the padding of each sequence in the
+        encoder, and implies fused_attention. precision is that of the encoder,
+        which runs under autocast if reduced; everything else runs in fp32.
+        If checkpoint_every is positive, encoder activations are checkpointed in
+        segments of that many layers when training, to save memory.
+        """
+        super().__init__(config)
+        self.config = config
+        assert precision in PRECISION_DTYPES, f"Unrecognized precision: {precision}"
+        self.encoder_precision = precision
+        if self.config.is_decoder:
+            raise NotImplementedError
+        self.ft_is_angular = ft_is_angular
+        n_inputs = len(ft_is_angular)
+        self.n_inputs = n_inputs
+
+        if ft_names is not None:
+            self.ft_names = ft_names
+        else:
+            self.ft_names = [f"ft{i}" for i in range(n_inputs)]
+        assert (
+            len(self.ft_names) == n_inputs
+        ), f"Got {len(self.ft_names)} names, expected {n_inputs}"
+
+        # Needed to project the low dimensional input to hidden dim
+        self.inputs_to_hidden_dim = nn.Linear(
+            in_features=n_inputs, out_features=config.hidden_size
+        )
+        self.embeddings = BertEmbeddings(config)
+        self.checkpoint_every = checkpoint_every
+        if fused_attention or unpad_sequences:
+            self.encoder = FusedBertEncoder(
+                config, unpad=unpad_sequences, checkpoint_every=checkpoint_every
+            )
+        else:
+            self.encoder = BertEncoder(config)
+
+        # Set up the network to project token representation to our four outputs
+        if decoder == "linear":
+            self.token_decoder = nn.Linear(config.hidden_size, n_inputs)
+        elif decoder == "mlp":
+            self.token_decoder = AnglesPredictor(config.hidden_size, n_inputs)
+        else:
+            raise ValueError(f"Unrecognized decoder: {decoder}")
+
+        # Set up the time embedder
+        if time_encoding == "gaussian_fourier":
+            self.time_embed = GaussianFourierProjection(config.hidden_size)
+        elif time_encoding == "sinusoidal":
+            self.time_embed = SinusoidalPositionEmbeddings(config.hidden_size)
+        else:
+            raise ValueError(f"Unknown time encoding: {time_encoding}")
+        logging.info(f"Using time embedding: {self.time_embed}")
+
+        # Initialize weights and apply final processing
+        self.init_weights()
+
+        # Epoch counters and timers
+        self.train_epoch_counter = 0
+        self.train_epoch_last_time = time.time()
+
+    @classmethod
+    def from_dir(
+        cls,
+        dirname: str,
+        ft_is_angular: Optional[Sequence[bool]] = None,
+        load_weights: bool = True,
+        idx: int = -1,
+        best_by: Literal["train", "valid"] = "valid",
+        copy_to: str = "",
+        quantize: bool = False,
+        **kwargs,
+    ):
+        """
+        Builds this model out from directory. Legacy mode is for loading models
+        before there were separate folders for training and validation best models.
+        idx indicates which model to load if multiple are given. The directory can
+        also be an inference bundle, as written to copy_to, which holds only the
+        weights and what is needed to build the model. If quantize, returns a
+        model for CPU inference with dynamic int8 Linear layers.
+        """
+        train_args_fname = os.path.join(dirname, "training_args.json")
+        with open(train_args_fname, "r") as source:
+            train_args = json.load(source)
+        config = BertConfig.from_json_file(os.path.join(dirname, "config.json"))
+
+        is_bundle = inference_bundle.is_bundle(dirname)
+        if is_bundle:
+            bundle_args = inference_bundle.load_model_args(dirname)
+            if ft_is_angular is not None:
+                bundle_args["ft_is_angular"] = list(ft_is_angular)
+        else:
+            if ft_is_angular is None:
+                # Imported here so that loading a bundle does not import datasets
+                from foldingdiff.datasets import FEATURE_SET_NAMES_TO_ANGULARITY
+
+                ft_is_angular = FEATURE_SET_NAMES_TO_ANGULARITY[
+                    train_args["angles_definitions"]
+                ]
+                logging.info(f"Auto constructed ft_is_angular: {ft_is_angular}")
+
+            # Handles the case where we repurpose the time encoding for seq len encoding in the AR model
+            time_encoding_key = (
+                "time_encoding" if "time_encoding" in train_args else "seq_len_encoding"
+            )
+            bundle_args = dict(
+                ft_is_angular=list(ft_is_angular),
+                time_encoding=train_args[time_encoding_key],
+                decoder=train_args["decoder"],
+            )
+        model_args = dict(
+            config=config,
+            # lr=train_args["lr"],
+            # loss=train_args["loss"],
+            # l2=train_args["l2_norm"],
+            # l1=train_args["l1_norm"],
+            # circle_reg=train_args["circle_reg"],
+            # lr_scheduler=train_args["lr_scheduler"],
+            **bundle_args,
+            **kwargs,
+        )
+
+        if load_weights and is_bundle:
+            logging.info(f"Loading weights from bundle {dirname}")
+            retval = cls(**model_args)
+            retval.load_state_dict(inference_bundle.load_weights(dirname))
+        elif load_weights:
+            epoch_getter = lambda x: int(
+                re.findall(r"epoch=[0-9]+", os.path.basename(x)).pop().split("=")[-1]
+            )
+            subfolder = f"best_by_{best_by}"
+            # Sort checkpoints by epoch -- last item is latest epoch
+            ckpt_names = sorted(
+                glob.glob(os.path.join(dirname, "models", subfolder, "*.ckpt")),
+                key=epoch_getter,
+            )
+            logging.info(f"Found {len(ckpt_names)} checkpoints")
+            ckpt_name = ckpt_names[idx]
+            logging.info(f"Loading weights from {ckpt_name}")
+            if hasattr(cls, "load_from_checkpoint"):
+                # Defined for pytorch lightning module
+                retval = cls.load_from_checkpoint(
+                    checkpoint_path=ckpt_name, **model_args
+                )
+            else:
+                retval = cls(**model_args)
+                loaded = torch.load(ckpt_name, map_location=torch.device("cpu"))
+                retval.load_state_dict(loaded["state_dict"])
+        else:
+            retval = cls(**model_args)
+            logging.info(f"Loaded unitialized model from {dirname}")
+
+        # If specified, write out a bundle of the model to the given directory
+        if copy_to:
+            logging.info(f"Copying minimal model file set to: {copy_to}")
+            inference_bundle.write_bundle(
+                copy_to,
+                retval.state_dict() if load_weights else None,
+                config,
+                train_args,
+                bundle_args,
+                mean_offset_fname=os.path.join(
+                    dirname, inference_bundle.MEAN_OFFSET_FNAME
+                ),
+            )
+
+        if quantize:
+            logging.info("Quantizing Linear layers to dynamic int8")
+            retval = torch.quantization.quantize_dynamic(
+                retval.eval(), {nn.Linear}, dtype=torch.qint8
+            )
+        return retval
+
+    def forward(
+        self,
+        inputs: torch.Tensor,
+        timestep: torch.Tensor,  # Tensor of shape batch_length with time indices
+        attention_mask: torch.Tensor,
+        position_ids: Optional[torch.Tensor] = None,
+        head_mask: Optional[torch.Tensor] = None,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+        return_dict: Optional[bool] = None,
+    ):
+        r"""
+        encoder_hidden_states  (`torch.FloatTensor` of shape `(batch_size, sequence_length, hidden_size)`, *optional*):
+            Sequence of hidden-states at the output of the last layer of the encoder. Used in the cross-attention if
+            the model is configured as a decoder.
+        encoder_attention_mask (`torch.FloatTensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Mask to avoid performing attention on the padding token indices of the encoder input. This mask is used in
+            the cross-attention if the model is configured as a decoder. Mask values selected in `[0, 1]`:
+            - 1 for tokens that are **not masked**,
+            - 0 for tokens that are **masked**.
+        past_key_values (`tuple(tuple(torch.FloatTensor))` of length `config.n_layers` with each tuple having 4 tensors of shape `(batch_size, num_heads, sequence_length - 1, embed_size_per_head)`):
+            Contains precomputed key and value hidden states of the attention blocks. Can be used to speed up decoding.
+            If `past_key_values` are used, the user can optionally input only the last `decoder_input_ids` (those that
+            don't have their past key value states given to this model) of shape `(batch_size, 1)` instead of all
+            `decoder_input_ids` of shape `(batch_size, sequence_length)`.
+        use_cache (`bool`, *optional*):
+            If set to `True`, `past_key_values` key value states are returned and can be used to speed up decoding (see
+            `past_key_values`).
+        """
+        output_attentions = (
+            output_attentions
+            if output_attentions is not None
+            else self.config.output_attentions
+        )
+        output_hidden_states = (
+            output_hidden_states
+            if output_hidden_states is not None
+            else self.config.output_hidden_states
+        )
+        return_dict = (
+            return_dict if return_dict is not None else self.config.use_return_dict
+        )
+
+        input_shape = inputs.size()
+        batch_size, seq_length, *_ = input_shape
+        logging.debug(f"Detected batch {batch_size} and seq length {seq_length}")
+
+        assert attention_mask is not None
+
+        # If position IDs are not given, auto-generate them
+        if position_ids is None:
+            # [1, seq_length]
+            position_ids = (
+                torch.arange(
+                    seq_length,
+                )
+                .expand(batch_size, -1)
+                .type_as(timestep)
+            )
+
+        assert attention_mask.dim() in (
+            2,
+            3,
+        ), f"Attention mask expected in shape (batch_size, [seq_length,] seq_length), got {attention_mask.shape}"
+
+        # Prepare head mask if needed
+        # 1.0 in head_mask indicate we keep the head
+        # attention_probs has shape bsz x n_heads x N x N
+        # input head_mask has shape [num_heads] or [num_hidden_layers x num_heads]
+        # and head_mask is converted to shape [num_hidden_layers x batch x num_heads x seq_length x seq_length]
+        # msk = torch.ones(size=(self.config.num_attention_heads,))
+        # msk = msk.type_as(inputs)
+        # head_mask = self.get_head_mask(msk, self.config.num_hidden_layers)
+
+        assert len(inputs.shape) == 3  # batch_size, seq_length, features
+        inputs_upscaled = self.inputs_to_hidden_dim(inputs)  # Batch * seq_len * dim
+
+        # Pass through embeddings
+        inputs_upscaled = self.embeddings(inputs_upscaled, position_ids=position_ids)
+
+        if timestep.dim() == 2 and timestep.shape[1] == seq_length > 1:
+            # Per token timesteps (batch, seq_len), e.g. of packed sequences
+            time_encoded = self.time_embed(timestep.reshape(-1)).view(
+                batch_size, seq_length, -1
+            )
+        else:
+            # timestep is (batch, 1), squeeze to (batch,)
+            # embedding gets to (batch, embed_dim) -> unsqueee to (batch, 1, dim)
+            time_encoded = self.time_embed(timestep.squeeze(dim=-1)).unsqueeze(1)
+        inputs_with_time = inputs_upscaled + time_encoded
+        encoder_outputs = self._encode(
+            inputs_with_time,
+            attention_mask=attention_mask,
+            output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+            return_dict=return_dict,
+        )
+
+        sequence_output = encoder_outputs[0]
+        per_token_decoded = self.token_decoder(sequence_output)
+        return per_token_decoded
+
+    def _encode(
+        self, hidden_states: torch.Tensor, attention_mask: torch.Tensor, **kwargs
+    ):
+        """
+        Run the encoder given a 0/1 attention mask of shape (batch, seq_len), or
+        (batch, seq_len, seq_len) e.g. for block diagonal masks of packed sequences
+        """
+        if self.encoder_precision == "fp32":
+            return self._run_encoder(hidden_states, attention_mask, **kwargs)
+        with torch.autocast(
+            device_type=hidden_states.device.type,
+            dtype=PRECISION_DTYPES[self.encoder_precision],
+        ):
+            encoder_outputs = self._run_encoder(hidden_states, attention_mask, **kwargs)
+        # Decoding and anything downstream of it, e.g. losses, stays in fp32
+        return (encoder_outputs[0].float(),)
+
+    def _run_encoder(
+        self, hidden_states: torch.Tensor, attention_mask: torch.Tensor, **kwargs
+    ):
+        """Run the encoder as is, converting the attention mask as needed"""
+        if isinstance(self.encoder, FusedBertEncoder):
+            return self.encoder(hidden_states, attention_mask=attention_mask, **kwargs)
+        # We can provide a self-attention mask of dimensions [batch_size, from_seq_length, to_seq_length]
+        # ourselves in which case we just need to make it broadcastable to all heads. This code is taken
+        # from hugggingface modeling_utils
+        if attention_mask.dim() == 2:
+            extended_attention_mask = attention_mask[:, None, None, :]
+        else:
+            extended_attention_mask = attention_mask[:, None, :, :]
+        extended_attention_mask = extended_attention_mask.type_as(attention_mask)
+        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        if self.checkpoint_every > 0 and self.training and torch.is_grad_enabled():
+            # BertEncoder can only checkpoint every layer, so run its layers here
+            hidden_states = run_layers(
+                self.encoder.layer,
+                hidden_states,
+                extended_attention_mask,
+                checkpoint_every=self.checkpoint_every,
+            )
+            return (hidden_states,)
+        return self.encoder(
+            hidden_states, attention_mask=extended_attention_mask, **kwargs
+        )
+
+
+class BertForAutoregressiveBase(BertForDiffusionBase):
+    """
+    Overrides the previous model's forward function to not handle noise or timesteps
+
+    If causal, each position attends only to itself and preceding positions, and
+    predicts the values at the next position, as trained with all_positions in
+    AutoregressiveCausalDataset. Otherwise, the prediction for a position attends
+    to the positions before it.
+    """
+
+    def __init__(self, *args, causal: bool = False, **kwargs) -> None:
+        BertForDiffusionBase.__init__(self, *args, **kwargs)
+        self.causal = causal
+
+    @classmethod
+    def from_dir(cls, dirname: str, **kwargs):
+        """Builds the model from directory, as causal if trained on all positions"""
+        with open(os.path.join(dirname, "training_args.json")) as source:
+            train_args = json.load(source)
+        kwargs.setdefault("causal", train_args.get("all_positions", False))
+        return super().from_dir(dirname, **kwargs)
+
+    def forward(
+        self,
+        inputs: torch.Tensor,
+        attention_mask: torch.Tensor,
+        seq_lengths: torch.Tensor,
+        position_ids: Optional[torch.Tensor] = None,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+        return_dict: Optional[bool] = None,
+    ):
+        assert len(inputs.shape) == 3  # batch_size, seq_length, features
+        inputs_upscaled = self.inputs_to_hidden_dim(inputs)  # Batch * seq_len * dim
+
+        # Embed the lengths - note that we are reusing the time embedding here
+        # Shape (batch, embed) -> (batch, 1, embed)
+        len_embed = self.time_embed(seq_lengths).unsqueeze(1)
+        inputs_upscaled += len_embed
+
+        if position_ids is None:
+            batch_size, seq_length, *_ = inputs.size()
+            # Shape (batch, seq_len)
+            position_ids = (
+                torch.arange(
+                    seq_length,
+                )
+                .expand(batch_size, -1)
+                .to(inputs.device)
+            )
+
+        assert (
+            attention_mask.dim() == 2
+        ), f"Attention mask expected in shape (batch_size, seq_length), got {attention_mask.shape}"
+        if self.causal:
+            # Lower triangular (batch, from_seq_length, to_seq_length) mask
+            seq_length = attention_mask.shape[1]
+            attention_mask = attention_mask[:, None, :] * torch.tril(
+                torch.ones(seq_length, seq_length, device=attention_mask.device)
+            ).type_as(attention_mask)
+
+        inputs_upscaled = self.embeddings(inputs_upscaled, position_ids=position_ids)
+        encoder_outputs = self._encode(
+            inputs_upscaled,
+            attention_mask=attention_mask,
+            output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+            return_dict=return_dict,
+        )
+
+        sequence_output = encoder_outputs[0]
+        per_token_decoded = self.token_decoder(sequence_output)
+        return per_token_decoded
+
+    @torch.no_grad()
+    def sample(
+        self,
+        seed_angles: torch.Tensor,
+        seq_lengths: torch.Tensor,
+        num_seed: int = 2,
+        pbar: bool = True,
+        use_cache: bool = True,
+    ) -> List[torch.Tensor]:
+        """
+        Sample a set of angles of seq_lengths given a series of seed angles
+        seed_angles should be given as a tensor of (batch, seq_len, num_angles)
+        The first num_seed angles are taken as fixed and the rest are autoregressively
+        generated. Sequences are dropped from the batch once they reach their length.
+        If causal and use_cache, the keys and values of preceding positions are cached
+        so that each step only encodes the newest position.
+        """
+        assert torch.all(seed_angles[:, :num_seed, :] <= torch.pi)
+        assert torch.all(seed_angles[:, :num_seed, :] >= -torch.pi)
+        retval = seed_angles.clone().to(seed_angles.device)
+        assert seed_angles.ndim == 3
+        assert seed_angles.shape[1] >= torch.max(seq_lengths).item()
+
+        steps = tqdm(range(num_seed, torch.max(seq_lengths).item()), disable=not pbar)
+        if self.causal and use_cache:
+            self._sample_cached(retval, seq_lengths, num_seed, steps)
+            return [retval[i, :l, :] for i, l in enumerate(seq_lengths)]
+
+        # Indices of the sequences still being generated
+        active = torch.arange(retval.shape[0], device=retval.device)
+        for i in steps:
+            active = active[seq_lengths[active] > i]
+            # Positions after i are masked out, so there is no need to encode them
+            attention_mask = torch.ones(len(active), i + 1, device=retval.device)
+            attention_mask[:, i] = 0.0
+            next_angle = self.forward(
+                retval[active, : i + 1],
+                attention_mask=attention_mask,
+                seq_lengths=seq_lengths[active],
+            )[:, i - 1 if self.causal else i, :]
+            retval[active, i, :] = next_angle
+        return [retval[i, :l, :] for i, l in enumerate(seq_lengths)]
+
+    def _sample_cached(
+        self,
+        retval: torch.Tensor,
+        seq_lengths: torch.Tensor,
+        num_seed: int,
+        steps: Iterable[int],
+    ) -> None:
+        """
+        Fill in retval (batch, seq_len, num_angles) from num_seed onwards, caching
+        keys and values so that each step encodes only the previous position
+        """
+        cache = KVCache(len(self.encoder.layer))
+        active = torch.arange(retval.shape[0], device=retval.device)
+        # Shape (batch, embed) -> (batch, 1, embed)
+        len_embed = self.time_embed(seq_lengths).unsqueeze(1)
+        inputs, start = retval[:, :num_seed], 0
+        for i in steps:
+            # Drop sequences that are done from the batch and from the cache
+            keep = seq_lengths[active] > i
+            if not torch.all(keep):
+                active, inputs = active[keep], inputs[keep]
+                cache.select(keep)
+            hidden_states = self.inputs_to_hidden_dim(inputs) + len_embed[active]
+            position_ids = torch.arange(start, i, device=retval.device)
+            hidden_states = self.embeddings(
+                hidden_states, position_ids=position_ids.expand(len(active), -1)
+            )
+            with torch.autocast(
+                device_type=retval.device.type,
+                dtype=PRECISION_DTYPES[self.encoder_precision],
+                enabled=self.encoder_precision != "fp32",
+            ):
+                hidden_states = encode_incremental(
+                    self.encoder, hidden_states, cache, start
+                )
+            next_angle = self.token_decoder(hidden_states[:, -1].float())
+            retval[active, i, :] = next_angle
+            inputs, start = next_angle[:, None, :], i
@@ -0,0 +1,45 @@
+"""
+Activation checkpointing for stacks of encoder layers, to train on longer
+sequences or larger batches in the same memory. Rather than keeping the
+activations of every layer for the backward pass, only the inputs of each
+segment of layers are kept, and the segment is recomputed during backward.
+"""
+import functools
+from typing import *
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+
+def run_layers(
+    layers: Sequence[nn.Module],
+    hidden_states: torch.Tensor,
+    *args,
+    checkpoint_every: int = 0,
+) -> torch.Tensor:
+    """
+    Run hidden_states through the layers in order, each called with the
+    given additional args. Layers may return a tensor or a tuple whose first
+    item is the hidden states, as huggingface layers do. If checkpoint_every
+    is positive, checkpoint segments of that many layers.
+    """
+
+    def run_segment(segment, h: torch.Tensor, *segment_args) -> torch.Tensor:
+        for layer in segment:
+            h = layer(h, *segment_args)
+            if isinstance(h, tuple):
+                h = h[0]
+        return h
+
+    if checkpoint_every <= 0:
+        return run_segment(layers, hidden_states, *args)
+    for start in range(0, len(layers), checkpoint_every):
+        segment = layers[start : start + checkpoint_every]
+        hidden_states = checkpoint(
+            functools.partial(run_segment, segment),
+            hidden_states,
+            *args,
+            use_reentrant=False,
+        )
+    return hidden_states
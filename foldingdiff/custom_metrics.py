@@ -1,9 +1,8 @@
 """
 Some custom metrics
 """
-import functools
-import multiprocessing
 import logging
+from typing import *
 
 import numpy as np
 from scipy import stats
@@ -11,6 +10,8 @@ from scipy import stats
 import torch
 from torch.utils.data import Dataset
 
+from foldingdiff import utils
+
 
 def kl_from_empirical(
     u: np.ndarray, v: np.ndarray, nbins: int = 100, pseudocount: bool = False
@@ -37,49 +38,127 @@ def kl_from_empirical(
     return kl
 
 
-def _kl_helper(t: int, dset: Dataset) -> np.ndarray:
+def _clean_values_from_dset(dset: Dataset) -> torch.Tensor:
     """
-    Compute the KL divergence for each feature at timestep t
-    Returns an array of size (n_features,) corresponding to KL divergence
-    dset should be NoisedAnglesDataset
+    Collect the clean (un-noised) values of every non-masked position of the
+    dataset wrapped by the given NoisedAnglesDataset, as (n_positions, n_features)
     """
-    assert hasattr(dset, "feature_names")
-    assert hasattr(dset, "sample_noise")
-    select_by_attn = lambda x: x["corrupted"][torch.where(x["attn_mask"])]
     values = []
-    for i in range(len(dset)):
-        vals = dset.__getitem__(i, use_t_val=t)
-        values.append(select_by_attn(vals).numpy())  # Non-masked positions
-
-    values = np.vstack(values)
+    for i in range(len(dset.dset)):
+        item = dset.dset[i]
+        vals = item[dset.dset_key] if dset.dset_key is not None else item
+        values.append(vals[torch.where(item["attn_mask"])])
+    values = torch.vstack(values)
     assert values.ndim == 2
     assert values.shape[1] == len(dset.feature_names["angles"])
+    return values
 
-    # compute KL at each timestep
-    noise = dset.sample_noise(torch.from_numpy(values)).numpy()
-    kl_values = [
-        kl_from_empirical(values[:, i], noise[:, i]) for i in range(values.shape[1])
-    ]
-    return np.array(kl_values)
 
-
-def kl_from_dset(dset: Dataset, single_thread: bool = False) -> np.ndarray:
+def timestep_histograms(
+    dset: Dataset,
+    nbins: int = 100,
+    max_chunk_elements: int = 2**24,
+    timesteps: Optional[Sequence[int]] = None,
+) -> Dict[str, np.ndarray]:
     """
-    For each timestep in the dataset, compute the KL divergence across each feature
+    Histogram the values of the NoisedAnglesDataset dset at each timestep, and a
+    reference sample of the noise distribution, for each feature. The clean values
+    are loaded once, and noised for chunks of timesteps at a time in the same way
+    as dset.__getitem__, so that this is O(T x N) tensor ops rather than T x N
+    item constructions.
+
+    All timesteps share one binning per feature: [-pi, pi] for angular features,
+    and bounds that contain every possible noised value otherwise (draws of
+    the Gaussian noise beyond the reference sample fall in the outermost bins).
+
+    Returns a dict with keys:
+    * timesteps - (n_timesteps,) the timesteps histogrammed
+    * edges - (n_features, nbins + 1) bin edges
+    * counts - (n_timesteps, n_features, nbins) counts of noised values
+    * noise_counts - (n_features, nbins) counts of the reference noise
     """
     assert hasattr(dset, "timesteps")
-    pfunc = functools.partial(_kl_helper, dset=dset)
-    if single_thread:
-        kl_values = [pfunc(t) for t in range(dset.timesteps)]
-    else:
-        logging.info(
-            f"Computing KL divergence for {dset.timesteps} timesteps using {multiprocessing.cpu_count()} workers"
+    assert hasattr(dset, "sample_noise")
+    if timesteps is None:
+        timesteps = np.arange(dset.timesteps)
+    timesteps = np.clip(np.asarray(timesteps, dtype=int), 0, dset.timesteps - 1)
+    values = _clean_values_from_dset(dset)
+    n, n_features = values.shape
+    is_angular = torch.tensor(dset.feature_is_angular[dset.dset_key])
+    sqrt_a = dset.alpha_beta_terms["sqrt_alphas_cumprod"].to(values.dtype)
+    sqrt_1ma = dset.alpha_beta_terms["sqrt_one_minus_alphas_cumprod"].to(
+        values.dtype
+    )
+
+    # Shared binning, from the extremes of sqrt_a * x + sqrt_1ma * noise over t.
+    # Each term is linear in its scale, so its extremes are at the extreme scales
+    noise = dset.sample_noise(values)
+    scaled = lambda scale, x: torch.stack([scale.min() * x, scale.max() * x])
+    lo = (
+        scaled(sqrt_a, values.min(0)[0]).min(0)[0]
+        + scaled(sqrt_1ma, noise.min(0)[0]).min(0)[0]
+    )
+    hi = (
+        scaled(sqrt_a, values.max(0)[0]).max(0)[0]
+        + scaled(sqrt_1ma, noise.max(0)[0]).max(0)[0]
+    )
+    lo = torch.where(is_angular, torch.full_like(lo, -np.pi), lo)
+    hi = torch.where(is_angular, torch.full_like(hi, np.pi), hi)
+    width = torch.clamp(hi - lo, min=torch.finfo(values.dtype).eps)
+
+    def histogram(x: torch.Tensor) -> torch.Tensor:
+        """Histogram x of shape (..., n, n_features) to (..., n_features, nbins)"""
+        bin_idx = torch.floor((x - lo) / width * nbins).long().clamp(0, nbins - 1)
+        bin_idx += torch.arange(n_features) * nbins  # Offset per feature
+        lead = x.shape[:-2]
+        bin_idx = bin_idx.reshape(-1, n * n_features)
+        bin_idx += torch.arange(bin_idx.shape[0])[:, None] * n_features * nbins
+        counts = torch.bincount(
+            bin_idx.flatten(), minlength=bin_idx.shape[0] * n_features * nbins
+        )
+        return counts.reshape(*lead, n_features, nbins)
+
+    chunk_size = max(1, max_chunk_elements // (n * n_features))
+    logging.info(
+        f"Histogramming {n} positions at {len(timesteps)} timesteps in chunks of {chunk_size}"
+    )
+    counts = []
+    for i in range(0, len(timesteps), chunk_size):
+        t = torch.from_numpy(timesteps[i : i + chunk_size])
+        chunk_noise = dset.sample_noise(values.new_empty(len(t), n, n_features))
+        noised = (
+            sqrt_a[t][:, None, None] * values + sqrt_1ma[t][:, None, None] * chunk_noise
+        )
+        noised[..., is_angular] = utils.modulo_with_wrapped_range(
+            noised[..., is_angular], -np.pi, np.pi
         )
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        kl_values = pool.map(pfunc, range(dset.timesteps))
-        pool.close()
-        pool.join()
-    return np.array(kl_values)
+        counts.append(histogram(noised))
+
+    edges = lo[:, None] + width[:, None] * torch.linspace(0, 1, nbins + 1)
+    return {
+        "timesteps": timesteps,
+        "edges": edges.numpy(),
+        "counts": torch.cat(counts).numpy(),
+        "noise_counts": histogram(noise).numpy(),
+    }
+
+
+def kl_from_histograms(counts: np.ndarray, noise_counts: np.ndarray) -> np.ndarray:
+    """
+    KL divergence of each histogram in counts (..., nbins) from the reference
+    noise_counts, broadcast over the leading dimensions. Infinite where counts
+    has mass in a bin where noise_counts does not, as in kl_from_empirical
+    """
+    return stats.entropy(counts, np.broadcast_to(noise_counts, counts.shape), axis=-1)
+
+
+def kl_from_dset(dset: Dataset) -> np.ndarray:
+    """
+    For each timestep in the dataset, compute the KL divergence across each feature
+    Returns an array of shape (n_timesteps, n_features)
+    """
+    hists = timestep_histograms(dset)
+    return kl_from_histograms(hists["counts"], hists["noise_counts"])
 
 
 def wrapped_mean(x: np.ndarray, axis=None) -> float:
@@ -92,3 +171,142 @@ def wrapped_mean(x: np.ndarray, axis=None) -> float:
 
     retval = np.arctan2(np.nanmean(sin_x, axis=axis), np.nanmean(cos_x, axis=axis))
     return retval
+
+
+class FeatureStatistics:
+    """
+    Mergeable statistics of each feature of (n, n_features) values: the counts
+    of nan and non-nan values, sums of sin and cos for the wrapped (circular)
+    mean, and Welford's running mean and sum of squared deviations (m2) for the
+    linear mean and variance. nan values are otherwise ignored.
+
+    Fields have shape (..., n_features), so that the statistics of many segments
+    (e.g. one per structure) can be held together and reduced over any subset.
+    """
+
+    field_names = ("count", "nan_count", "sin_sum", "cos_sum", "mean", "m2")
+
+    def __init__(
+        self,
+        count: np.ndarray,
+        nan_count: np.ndarray,
+        sin_sum: np.ndarray,
+        cos_sum: np.ndarray,
+        mean: np.ndarray,
+        m2: np.ndarray,
+    ) -> None:
+        self.count = count
+        self.nan_count = nan_count
+        self.sin_sum = sin_sum
+        self.cos_sum = cos_sum
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def empty(cls, n_features: int):
+        """Statistics of no values"""
+        return cls.from_values(np.zeros((0, n_features)))
+
+    @classmethod
+    def from_segments(
+        cls, values: np.ndarray, offsets: np.ndarray, lengths: np.ndarray
+    ):
+        """
+        Statistics of each segment values[offsets[i] : offsets[i] + lengths[i]],
+        computed with vectorized ops across segments
+        """
+        assert values.ndim == 2
+        offsets, lengths = np.asarray(offsets), np.asarray(lengths)
+        retval = {
+            k: np.zeros((len(lengths), values.shape[1]), dtype=np.float64)
+            for k in cls.field_names
+        }
+        # reduceat does not sum empty segments to 0, so leave those out
+        nonempty = lengths > 0
+        if np.any(nonempty):
+            starts = offsets[nonempty]
+            isnan = np.isnan(values)
+            x = np.where(isnan, 0.0, values.astype(np.float64))
+            segment_sum = lambda a: np.add.reduceat(a, starts, axis=0)
+            sums = {
+                "count": segment_sum(~isnan),
+                "nan_count": segment_sum(isnan),
+                "sin_sum": segment_sum(np.where(isnan, 0.0, np.sin(x))),
+                "cos_sum": segment_sum(np.where(isnan, 0.0, np.cos(x))),
+            }
+            sums["mean"] = segment_sum(x) / np.maximum(sums["count"], 1)
+            seg_mean = np.repeat(sums["mean"], lengths[nonempty], axis=0)
+            sums["m2"] = segment_sum(np.where(isnan, 0.0, (x - seg_mean) ** 2))
+            for k, v in sums.items():
+                retval[k][nonempty] = v
+        retval["count"] = retval["count"].astype(np.int64)
+        retval["nan_count"] = retval["nan_count"].astype(np.int64)
+        return cls(**retval)
+
+    @classmethod
+    def from_values(cls, values: np.ndarray):
+        """Statistics of (n, n_features) values"""
+        return cls.from_segments(values, [0], [len(values)]).reduce()
+
+    def reduce(self, idx: Optional[np.ndarray] = None):
+        """
+        Combine the statistics along the first axis, optionally only those at
+        the given indices, using Chan et al.'s parallel update for m2
+        """
+        fields = {k: getattr(self, k) for k in self.field_names}
+        if idx is not None:
+            fields = {k: v[idx] for k, v in fields.items()}
+        count = fields["count"].sum(axis=0)
+        mean = (fields["count"] * fields["mean"]).sum(axis=0) / np.maximum(count, 1)
+        m2 = fields["m2"].sum(axis=0)
+        m2 += (fields["count"] * (fields["mean"] - mean) ** 2).sum(axis=0)
+        return FeatureStatistics(
+            count=count,
+            nan_count=fields["nan_count"].sum(axis=0),
+            sin_sum=fields["sin_sum"].sum(axis=0),
+            cos_sum=fields["cos_sum"].sum(axis=0),
+            mean=mean,
+            m2=m2,
+        )
+
+    def merge(self, other: "FeatureStatistics"):
+        """Combine with the statistics of other values of the same shape"""
+        stacked = FeatureStatistics(
+            **{
+                k: np.stack([getattr(self, k), getattr(other, k)])
+                for k in self.field_names
+            }
+        )
+        return stacked.reduce()
+
+    def update(self, values: np.ndarray) -> None:
+        """Update in place with (n, n_features) values"""
+        merged = self.merge(FeatureStatistics.from_values(values))
+        for k in self.field_names:
+            setattr(self, k, getattr(merged, k))
+
+    def wrapped_mean(self) -> np.ndarray:
+        """Circular mean in [-pi, pi], equivalent to wrapped_mean of the values"""
+        with np.errstate(invalid="ignore"):
+            return np.where(
+                self.count > 0, np.arctan2(self.sin_sum, self.cos_sum), np.nan
+            )
+
+    def circular_variance(self) -> np.ndarray:
+        """1 - the mean resultant length, in [0, 1]"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return 1.0 - np.hypot(self.sin_sum, self.cos_sum) / self.count
+
+    def var(self, ddof: int = 0) -> np.ndarray:
+        """Linear variance"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.m2 / (self.count - ddof)
+
+    def to_dict(self) -> Dict[str, list]:
+        """Return the statistics as a JSON-friendly dict"""
+        return {k: np.asarray(getattr(self, k)).tolist() for k in self.field_names}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, list]):
+        """Inverse of to_dict"""
+        return cls(**{k: np.asarray(d[k]) for k in cls.field_names})
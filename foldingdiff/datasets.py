@@ -4,9 +4,12 @@ data loader object
 """
 
 import json
-import pickle
+import time
+import shutil
+import signal
 import hashlib
 import functools
+import itertools
 import multiprocessing
 import os
 import glob
@@ -19,7 +22,14 @@ import numpy as np
 
 import torch
 from torch import nn
-from torch.utils.data import Dataset
+import torch.distributed as dist
+from torch.utils.data import (
+    Dataset,
+    IterableDataset,
+    Sampler,
+    default_collate,
+    get_worker_info,
+)
 
 LOCAL_DATA_DIR = Path(
     os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
@@ -30,17 +40,28 @@ ALPHAFOLD_DIR = LOCAL_DATA_DIR / "alphafold"
 
 
 from foldingdiff import beta_schedules
+from foldingdiff import angles_and_coords
 from foldingdiff.angles_and_coords import (
-    canonical_distances_and_dihedrals,
+    featurize_structure,
     EXHAUSTIVE_ANGLES,
     EXHAUSTIVE_DISTS,
-    extract_backbone_coords,
 )
 from foldingdiff import custom_metrics as cm
 from foldingdiff import utils
+from foldingdiff.feature_store import (
+    FeatureStore,
+    FeaturizationCache,
+    StringTable,
+    read_shard,
+    read_shard_index,
+    share_array,
+)
 
 TRIM_STRATEGIES = Literal["leftalign", "randomcrop", "discard"]
 
+# Fraction of structures in each split, as used by the in-memory datasets
+SPLIT_FRACTIONS = {"train": 0.8, "validation": 0.1, "test": 0.1}
+
 FEATURE_SET_NAMES_TO_ANGULARITY = {
     "canonical": [False, False, False, True, True, True, True, True, True],
     "canonical-full-angles": [True, True, True, True, True, True],
@@ -72,6 +93,238 @@ FEATURE_SET_NAMES_TO_FEATURE_NAMES = {
 }
 
 
+def featurization_schema() -> str:
+    """
+    Identify the featurization code and features, which determine the cached
+    per-structure values. Changes elsewhere in the codebase do not invalidate them.
+    """
+    hash_md5 = hashlib.md5(
+        utils.md5_file(os.path.abspath(angles_and_coords.__file__)).encode()
+    )
+    hash_md5.update(",".join(EXHAUSTIVE_DISTS + EXHAUSTIVE_ANGLES).encode())
+    return hash_md5.hexdigest()
+
+
+def get_pdb_fnames(
+    pdbs: Union[Literal["cath", "alphafold"], str, List[str], Tuple[str]]
+) -> List[str]:
+    """Return a list of filenames for PDB structures making up this dataset"""
+    if isinstance(pdbs, (list, tuple)):
+        # A list of PDBs
+        for f in pdbs:
+            assert os.path.isfile(f), f"Given file does not exist: {f}"
+        fnames = pdbs
+        logging.info(f"Given {len(fnames)} PDB files")
+    elif Path(pdbs).is_dir():
+        fnames = []
+        for ext in [".pdb", ".pdb.gz"]:
+            fnames.extend(glob.glob(os.path.join(pdbs, f"*{ext}")))
+        assert fnames, f"No PDB files found in {pdbs}"
+        logging.info(f"Found {len(fnames)} PDB files in {pdbs}")
+    else:  # Should be a keyword
+        if pdbs == "cath":
+            fnames = glob.glob(os.path.join(CATH_DIR, "dompdb", "*"))
+            assert fnames, f"No files found in {CATH_DIR}/dompdb"
+        elif pdbs == "alphafold":
+            fnames = glob.glob(os.path.join(ALPHAFOLD_DIR, "*.pdb.gz"))
+            assert fnames, f"No files found in {ALPHAFOLD_DIR}"
+        else:
+            raise ValueError(f"Unknown pdb set: {pdbs}")
+
+    return fnames
+
+
+def _featurize_file(
+    fname: str, timeout: Optional[float] = None
+) -> Tuple[str, Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Featurize the structure in fname, returning (fname, featurization, error)
+    where featurization is None and error describes why if it failed. Gives
+    up after timeout seconds if given, where supported (i.e. not on Windows).
+    """
+
+    def handler(signum, frame):
+        raise TimeoutError(f"Timed out after {timeout} seconds")
+
+    use_alarm = timeout is not None and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        prev_handler = signal.signal(signal.SIGALRM, handler)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        s = featurize_structure(
+            fname,
+            distances=EXHAUSTIVE_DISTS,
+            angles=EXHAUSTIVE_ANGLES,
+            coord_atoms=["CA"],
+        )
+        if s is None:
+            return fname, None, "Not featurizable (e.g. multiple models)"
+        return fname, s, None
+    except Exception as e:
+        return fname, None, f"{type(e).__name__}: {e}"
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, prev_handler)
+
+
+def featurize_files(
+    fnames: Sequence[str],
+    num_workers: Optional[int] = None,
+    timeout: Optional[float] = None,
+    log_interval: float = 30.0,
+) -> Iterator[Tuple[str, Optional[Dict[str, Any]], Optional[str]]]:
+    """
+    Featurize the given files across num_workers processes (default all cores),
+    yielding (fname, featurization, error) as each file finishes, in no
+    particular order. Files are handed out one at a time so that a slow file
+    does not hold up others, and failures, including files taking longer than
+    timeout seconds, are yielded with an error rather than raised. Logs
+    throughput and ETA every log_interval seconds.
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    logging.info(f"Featurizing {len(fnames)} structures with {num_workers} workers")
+    pfunc = functools.partial(_featurize_file, timeout=timeout)
+    start = last_log = time.monotonic()
+    n_failed = 0
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        for i, (fname, s, error) in enumerate(
+            pool.imap_unordered(pfunc, fnames), start=1
+        ):
+            if s is None:
+                n_failed += 1
+                logging.debug(f"Failed to featurize {fname}: {error}")
+            yield fname, s, error
+            now = time.monotonic()
+            if now - last_log >= log_interval or i == len(fnames):
+                last_log = now
+                rate = i / max(now - start, 1e-6)
+                logging.info(
+                    f"Featurized {i}/{len(fnames)} structures ({n_failed} failed) at {rate:.1f}/s, ETA {(len(fnames) - i) / rate:.0f}s"
+                )
+
+
+def hash_split(key: str) -> str:
+    """
+    Deterministically assign a structure to a split by hashing its key (e.g. the
+    content hash of its file), in the proportions of SPLIT_FRACTIONS
+    """
+    x = int(hashlib.md5(key.encode()).hexdigest()[:8], 16) / 2**32
+    for split, frac in SPLIT_FRACTIONS.items():
+        if x < frac:
+            return split
+        x -= frac
+    return split  # Only reached through rounding
+
+
+def _replicas() -> Tuple[int, int]:
+    """Return the (num_replicas, rank) of this process"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size(), dist.get_rank()
+    return 1, 0
+
+
+def center_and_select_features(
+    angles: np.ndarray,
+    names: Sequence[str],
+    selected: Sequence[str],
+    means: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Given angles of shape (n, len(names)), offset by means and wrap the angular
+    features if means are given, subset to the selected features, and replace nan
+    values with 0. Returns a contiguous float32 array of shape (n, len(selected))
+    """
+    # The distance features all contain a single ":"
+    is_angular = np.array([c.count(":") != 1 for c in names])
+    if means is not None:
+        assert means.shape == (len(names),)
+        angles = angles - means
+        angles[:, is_angular] = utils.modulo_with_wrapped_range(
+            angles[:, is_angular], -np.pi, np.pi
+        )
+    # Subset angles to ones we are actaully using as features
+    feature_idx = [list(names).index(ft) for ft in selected]
+    angles = angles[:, feature_idx]
+    is_angular = is_angular[feature_idx]
+    np.nan_to_num(angles, copy=False, nan=0)
+    if angles.size:
+        assert utils.tolerant_comparison_check(
+            angles[:, is_angular], ">=", -np.pi
+        ), f"Illegal value: {np.min(angles[:, is_angular])}"
+        assert utils.tolerant_comparison_check(
+            angles[:, is_angular], "<=", np.pi
+        ), f"Illegal value: {np.max(angles[:, is_angular])}"
+    return np.ascontiguousarray(angles, dtype=np.float32)
+
+
+def pad_and_mask(
+    angles: np.ndarray,
+    coords: np.ndarray,
+    pad: int,
+    trim_strategy: TRIM_STRATEGIES = "leftalign",
+    rng: Optional[np.random.Generator] = None,
+) -> Dict[str, torch.Tensor]:
+    """
+    Pad or trim the angles and coords of a structure to pad positions, and
+    return them as an item with an attention mask, position ids, and length.
+    rng is used to choose crops for the randomcrop trim strategy.
+    """
+    assert angles.shape[0] == coords.shape[0]
+    # Create attention mask. 0 indicates masked
+    l = min(pad, angles.shape[0])
+    attn_mask = torch.zeros(size=(pad,))
+    attn_mask[:l] = 1.0
+
+    # Additionally, mask out positions that are nan
+    # is_nan = np.where(np.any(np.isnan(angles), axis=1))[0]
+    # attn_mask[is_nan] = 0.0  # Mask out the nan positions
+
+    # Perform padding/trimming
+    if angles.shape[0] < pad:
+        angles = np.pad(
+            angles,
+            ((0, pad - angles.shape[0]), (0, 0)),
+            mode="constant",
+            constant_values=0,
+        )
+        coords = np.pad(
+            coords,
+            ((0, pad - coords.shape[0]), (0, 0)),
+            mode="constant",
+            constant_values=0,
+        )
+    elif angles.shape[0] > pad:
+        if trim_strategy == "leftalign":
+            angles = angles[:pad]
+            coords = coords[:pad]
+        elif trim_strategy == "randomcrop":
+            # Randomly crop the sequence to
+            start_idx = rng.integers(0, angles.shape[0] - pad)
+            end_idx = start_idx + pad
+            assert end_idx < angles.shape[0]
+            angles = angles[start_idx:end_idx]
+            coords = coords[start_idx:end_idx]
+            assert angles.shape[0] == coords.shape[0] == pad
+        else:
+            raise ValueError(f"Unknown trim strategy: {trim_strategy}")
+
+    # Create position IDs
+    position_ids = torch.arange(start=0, end=pad, step=1, dtype=torch.long)
+
+    angles = torch.from_numpy(angles).float()
+    coords = torch.from_numpy(coords).float()
+
+    retval = {
+        "angles": angles,
+        "coords": coords,
+        "attn_mask": attn_mask,
+        "position_ids": position_ids,
+        "lengths": torch.tensor(l, dtype=torch.int64),
+    }
+    return retval
+
+
 class CathCanonicalAnglesDataset(Dataset):
     """
     Load in the dataset.
@@ -111,75 +364,115 @@ class CathCanonicalAnglesDataset(Dataset):
         zero_center: bool = True,  # Center the features to have 0 mean
         use_cache: bool = True,  # Use/build cached computations of dihedrals and angles
         cache_dir: Path = Path(os.path.dirname(os.path.abspath(__file__))),
+        precompute: bool = True,  # Center/wrap/select features once rather than per item
+        featurize_workers: Optional[int] = None,  # Featurization processes, default all
+        featurize_timeout: Optional[float] = None,  # Seconds before giving up on a file
+        shared_memory: bool = False,  # Hold in-memory arrays in shared memory
     ) -> None:
         super().__init__()
         assert pad > min_length
         self.trim_strategy = trim_strategy
         self.pad = pad
         self.min_length = min_length
+        self.precompute = precompute
+        self.featurize_workers = featurize_workers
+        self.featurize_timeout = featurize_timeout
+        self.shared_memory = shared_memory
+        # Processed angles for each item, keyed on whether they are zero centered,
+        # and if in shared memory, the tensors that hold them
+        self._item_angles = {}
+        self._shared_item_angles = {}
 
         # gather files
         self.pdbs_src = pdbs
-        fnames = self.__get_pdb_fnames(pdbs)
-        self.fnames = fnames
-
-        # self.structures should be a list of dicts with keys (angles, coords, fname)
-        # Define as None by default; allow for easy checking later
-        self.structures = None
-        codebase_hash = utils.md5_all_py_files(
-            os.path.dirname(os.path.abspath(__file__))
-        )
-        # Default to false; assuming no cache, also doesn't match
-        codebase_matches_hash = False
+        fnames = get_pdb_fnames(pdbs)
+        self.fnames = StringTable.from_strings(fnames)
+
+        # self.store holds the featurized structures and self.structure_idx the
+        # indices into the store that make up this dataset (after filtering,
+        # shuffling, and splitting). Define as None by default; allow for easy
+        # checking later
+        self.store = None
         self.use_cache = use_cache
         self.cache_dir = cache_dir
-        # Always compute for toy; do not save
         if toy:
             if isinstance(toy, bool):
                 toy = 150
             fnames = fnames[:toy]
-
             logging.info(f"Loading toy dataset of {toy} structures")
-            self.structures = self.__compute_featurization(fnames)
-        elif use_cache and os.path.exists(self.cache_fname):
-            logging.info(f"Loading cached full dataset from {self.cache_fname}")
-            with open(self.cache_fname, "rb") as source:
-                loaded_hash, loaded_structures = pickle.load(source)
-                codebase_matches_hash = loaded_hash == codebase_hash
-                if not codebase_matches_hash:
-                    logging.warning(
-                        "Mismatched hashes between codebase and cached values; updating cached values"
+
+        if not use_cache:
+            featurized = {
+                fname: s for fname, s, _ in self.__compute_featurization(fnames)
+            }
+            # Contains only non-null structures, in the order of fnames
+            self.store = FeatureStore.from_structures(
+                [
+                    {"fname": f, **featurized[f]}
+                    for f in fnames
+                    if featurized[f] is not None
+                ],
+                feature_names=EXHAUSTIVE_DISTS + EXHAUSTIVE_ANGLES,
+            )
+        else:
+            featurization_cache = FeaturizationCache(
+                os.path.join(self.cache_dir, "featurization_cache"),
+                schema=featurization_schema(),
+            )
+            keys = featurization_cache.content_hashes(fnames)
+            # Identifies the assembled store by its files' contents and order
+            hash_md5 = hashlib.md5(featurization_cache.schema.encode())
+            for fname, key in zip(fnames, keys):
+                hash_md5.update(f"{os.path.basename(fname)}:{key}".encode())
+            contents_hash = hash_md5.hexdigest()
+
+            # Toy datasets are assembled from the per-structure cache; do not save
+            if not toy and os.path.isdir(self.cache_fname):
+                meta = FeatureStore.read_metadata(self.cache_fname)
+                if meta is None:
+                    logging.warning(f"Ignoring incomplete cache at {self.cache_fname}")
+                elif meta["metadata"].get("contents_hash") != contents_hash:
+                    logging.info(
+                        "Dataset contents or featurization changed; reassembling cached values"
                     )
                 else:
-                    self.structures = loaded_structures
-                    logging.info("Hash matches between codebase and cached values!")
-        # We have not yet populated self.structures
-        if self.structures is None:
-            self.__clean_mismatched_caches()
-            self.structures = self.__compute_featurization(fnames)
-            if use_cache and not codebase_matches_hash:
-                logging.info(f"Saving full dataset to cache at {self.cache_fname}")
-                with open(self.cache_fname, "wb") as sink:
-                    pickle.dump((codebase_hash, self.structures), sink)
+                    logging.info(f"Loading cached full dataset from {self.cache_fname}")
+                    self.store = FeatureStore.load(self.cache_fname)
+            if self.store is None:
+                self.store = FeatureStore.from_structures(
+                    self.__cached_featurization(fnames, keys, featurization_cache),
+                    feature_names=EXHAUSTIVE_DISTS + EXHAUSTIVE_ANGLES,
+                    metadata={"contents_hash": contents_hash},
+                )
+                if not toy:
+                    self.__clean_legacy_caches()
+                    logging.info(f"Saving full dataset to cache at {self.cache_fname}")
+                    self.store.save(self.cache_fname)
+                    # Reopen so that we share memory mapped pages with other readers
+                    self.store = FeatureStore.load(self.cache_fname)
+        # Memory mapped stores are already shared, including with spawned workers
+        if self.shared_memory and self.store._mmap_dirname is None:
+            self.store.share_memory()
+        self.structure_idx = np.arange(len(self.store))
 
         # If specified, remove sequences shorter than min_length
         if self.min_length:
-            orig_len = len(self.structures)
-            self.structures = [
-                s for s in self.structures if s["angles"].shape[0] >= self.min_length
+            orig_len = len(self.structure_idx)
+            self.structure_idx = self.structure_idx[
+                self.store.lengths[self.structure_idx] >= self.min_length
             ]
-            len_delta = orig_len - len(self.structures)
+            len_delta = orig_len - len(self.structure_idx)
             logging.info(
-                f"Removing structures shorter than {self.min_length} residues excludes {len_delta}/{orig_len} --> {len(self.structures)} sequences"
+                f"Removing structures shorter than {self.min_length} residues excludes {len_delta}/{orig_len} --> {len(self.structure_idx)} sequences"
             )
         if self.trim_strategy == "discard":
-            orig_len = len(self.structures)
-            self.structures = [
-                s for s in self.structures if s["angles"].shape[0] <= self.pad
+            orig_len = len(self.structure_idx)
+            self.structure_idx = self.structure_idx[
+                self.store.lengths[self.structure_idx] <= self.pad
             ]
-            len_delta = orig_len - len(self.structures)
+            len_delta = orig_len - len(self.structure_idx)
             logging.info(
-                f"Removing structures longer than {self.pad} produces {orig_len} - {len_delta} = {len(self.structures)} sequences"
+                f"Removing structures longer than {self.pad} produces {orig_len} - {len_delta} = {len(self.structure_idx)} sequences"
             )
 
         # Split the dataset if requested. This is implemented here to maintain
@@ -187,39 +480,45 @@ class CathCanonicalAnglesDataset(Dataset):
         # a 80/10/10 split
         self.rng = np.random.default_rng(seed=6489)
         # Shuffle the sequences so contiguous splits acts like random splits
-        self.rng.shuffle(self.structures)
+        self.rng.shuffle(self.structure_idx)
         if split is not None:
-            split_idx = int(len(self.structures) * 0.8)
+            split_idx = int(len(self.structure_idx) * 0.8)
             if split == "train":
-                self.structures = self.structures[:split_idx]
+                self.structure_idx = self.structure_idx[:split_idx]
             elif split == "validation":
-                self.structures = self.structures[
-                    split_idx : split_idx + int(len(self.structures) * 0.1)
+                self.structure_idx = self.structure_idx[
+                    split_idx : split_idx + int(len(self.structure_idx) * 0.1)
                 ]
             elif split == "test":
-                self.structures = self.structures[
-                    split_idx + int(len(self.structures) * 0.1) :
+                self.structure_idx = self.structure_idx[
+                    split_idx + int(len(self.structure_idx) * 0.1) :
                 ]
             else:
                 raise ValueError(f"Unknown split: {split}")
 
-            logging.info(f"Split {split} contains {len(self.structures)} structures")
+            logging.info(f"Split {split} contains {len(self.structure_idx)} structures")
+
+        # Statistics of the (unpadded) features of this split, combined from the
+        # per-structure statistics saved with the store
+        self.statistics = self.store.statistics.reduce(self.structure_idx)
 
         # if given, zero center the features
         self.means = None
         if zero_center:
-            # Note that these angles are not yet padded
-            structures_concat = np.concatenate([s["angles"] for s in self.structures])
-            assert structures_concat.ndim == 2
-            self.means = cm.wrapped_mean(structures_concat, axis=0)
-            assert self.means.shape == (structures_concat.shape[1],)
+            self.means = self.statistics.wrapped_mean()
+            assert self.means.shape == (len(self.store.feature_names),)
             # Subtract the mean and perform modulo where values are radial
             logging.info(
                 f"Offsetting features {self.feature_names['angles']} by means {self.means}"
             )
 
         # Aggregate lengths
-        self.all_lengths = [s["angles"].shape[0] for s in self.structures]
+        self.all_lengths = np.array(self.store.lengths[self.structure_idx])
+        # Row offset of each item in the precomputed item angles
+        self._item_offsets = np.zeros(len(self.structure_idx), dtype=np.int64)
+        self._item_offsets[1:] = np.cumsum(self.all_lengths)[:-1]
+        if self.precompute and self._returns_angles:
+            self.__get_item_angles(zero_center=self.means is not None)
         self._length_rng = np.random.default_rng(seed=6489)
         logging.info(
             f"Length of angles: {np.min(self.all_lengths)}-{np.max(self.all_lengths)}, mean {np.mean(self.all_lengths)}"
@@ -232,110 +531,90 @@ class CathCanonicalAnglesDataset(Dataset):
         #     m, v = self.get_feature_mean_var(ft)
         #     logging.info(f"Feature {ft} mean, var: {m}, {v}")
 
-    def __get_pdb_fnames(
-        self, pdbs: Union[Literal["cath", "alphafold"], str, List[str], Tuple[str]]
-    ) -> List[str]:
-        """Return a list of filenames for PDB structures making up this dataset"""
-        if isinstance(pdbs, (list, tuple)):
-            # A list of PDBs
-            for f in pdbs:
-                assert os.path.isfile(f), f"Given file does not exist: {f}"
-            fnames = pdbs
-            logging.info(f"Given {len(fnames)} PDB files")
-        elif Path(pdbs).is_dir():
-            fnames = []
-            for ext in [".pdb", ".pdb.gz"]:
-                fnames.extend(glob.glob(os.path.join(pdbs, f"*{ext}")))
-            assert fnames, f"No PDB files found in {pdbs}"
-            logging.info(f"Found {len(fnames)} PDB files in {pdbs}")
-        else:  # Should be a keyword
-            if pdbs == "cath":
-                fnames = glob.glob(os.path.join(CATH_DIR, "dompdb", "*"))
-                assert fnames, f"No files found in {CATH_DIR}/dompdb"
-            elif pdbs == "alphafold":
-                fnames = glob.glob(os.path.join(ALPHAFOLD_DIR, "*.pdb.gz"))
-                assert fnames, f"No files found in {ALPHAFOLD_DIR}"
-            else:
-                raise ValueError(f"Unknown pdb set: {pdbs}")
-
-        return fnames
-
     @property
     def cache_fname(self) -> str:
-        """Return the filename for the cache file"""
-        if os.path.isdir(self.pdbs_src):
-            k = os.path.basename(self.pdbs_src)
-        else:
-            k = self.pdbs_src
-
-        # Create md5 of all the filenames (NOT their contents)
-        hash_md5 = hashlib.md5()
-        for fname in self.fnames:
-            hash_md5.update(os.path.basename(fname).encode())
-        filename_hash = hash_md5.hexdigest()
-
-        return os.path.join(
-            self.cache_dir, f"cache_canonical_structures_{k}_{filename_hash}.pkl"
-        )
-
-    def __clean_mismatched_caches(self) -> None:
-        """Clean out mismatched cache files"""
-        if not self.use_cache:
-            logging.info("Not using cache -- skipping cache cleaning")
-            return
-
+        """Return the directory name for the cached feature store"""
         if os.path.isdir(self.pdbs_src):
             k = os.path.basename(self.pdbs_src)
         else:
             k = self.pdbs_src
+        return os.path.join(self.cache_dir, f"cache_canonical_structures_{k}")
 
-        matches = glob.glob(
-            os.path.join(self.cache_dir, f"cache_canonical_structures_{k}_*.pkl")
-        )
-        if not matches:
-            logging.info(
-                f"No cache files found matching {matches}, no cleaning necessary"
-            )
-        for fname in matches:
-            if fname != self.cache_fname:
-                logging.info(f"Removing old cache file {fname}")
+    def __clean_legacy_caches(self) -> None:
+        """
+        Remove caches keyed on filename hashes left by older versions. Caches
+        for other datasets and the per-structure featurization cache are kept.
+        """
+        for fname in glob.glob(f"{self.cache_fname}_*"):
+            logging.info(f"Removing legacy cache file {fname}")
+            if os.path.isdir(fname):
+                shutil.rmtree(fname)
+            else:
                 os.remove(fname)
 
-    def __compute_featurization(
-        self, fnames: Sequence[str]
-    ) -> List[Dict[str, np.ndarray]]:
-        """Get the featurization of the given fnames"""
-        pfunc = functools.partial(
-            canonical_distances_and_dihedrals,
-            distances=EXHAUSTIVE_DISTS,
-            angles=EXHAUSTIVE_ANGLES,
-        )
-        coords_pfunc = functools.partial(extract_backbone_coords, atoms=["CA"])
-
+    def __cached_featurization(
+        self,
+        fnames: Sequence[str],
+        keys: Sequence[str],
+        featurization_cache: FeaturizationCache,
+    ) -> List[Dict[str, Any]]:
+        """
+        Get the featurization of the given fnames, with content hashes keys,
+        computing and caching only those not already in featurization_cache.
+        Results are written to the cache as they arrive, and failures are
+        recorded so that they are not retried.
+        """
+        missing = [
+            f
+            for f, k in zip(fnames, keys)
+            if k not in featurization_cache and k not in featurization_cache.failures
+        ]
+        n_failed = sum(k in featurization_cache.failures for k in keys)
         logging.info(
-            f"Computing full dataset of {len(fnames)} with {multiprocessing.cpu_count()} threads"
+            f"Found {len(fnames) - len(missing) - n_failed}/{len(fnames)} structures in featurization cache {featurization_cache.dirname}, and {n_failed} previously failed"
         )
-        # Generate dihedral angles
-        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-        struct_arrays = list(pool.map(pfunc, fnames, chunksize=250))
-        coord_arrays = list(pool.map(coords_pfunc, fnames, chunksize=250))
-        pool.close()
-        pool.join()
-
-        # Contains only non-null structures
+        key_of = dict(zip(fnames, keys))
+        failures = {}
+        try:
+            for fname, s, error in (
+                self.__compute_featurization(missing) if missing else []
+            ):
+                if s is None:
+                    failures[key_of[fname]] = {"fname": fname, "reason": error}
+                    continue
+                angles = s["angles"].loc[:, EXHAUSTIVE_DISTS + EXHAUSTIVE_ANGLES]
+                featurization_cache.put(
+                    key_of[fname], angles=angles.values, coords=s["coords"]
+                )
+        finally:
+            featurization_cache.record_failures(failures)
+        if failures:
+            logging.warning(
+                f"Failed to featurize {len(failures)} structures, recorded in {featurization_cache.failures_fname}"
+            )
+
+        # Contains only non-null structures; those that failed have no entry
         structures = []
-        for fname, s, c in zip(fnames, struct_arrays, coord_arrays):
-            if s is None:
+        for fname, key in zip(fnames, keys):
+            entry = featurization_cache.get(key)
+            if entry is None:
                 continue
-            structures.append(
-                {
-                    "angles": s,
-                    "coords": c,
-                    "fname": fname,
-                }
-            )
+            structures.append({"fname": fname, **entry})
         return structures
 
+    def __compute_featurization(
+        self, fnames: Sequence[str]
+    ) -> Iterator[Tuple[str, Optional[Dict[str, Any]], Optional[str]]]:
+        """
+        Featurize the given fnames, yielding (fname, featurization, error) as
+        they complete; see featurize_files
+        """
+        return featurize_files(
+            fnames,
+            num_workers=self.featurize_workers,
+            timeout=self.featurize_timeout,
+        )
+
     def sample_length(self, n: int = 1) -> Union[int, List[int]]:
         """
         Sample a observed length of a sequence
@@ -347,6 +626,70 @@ class CathCanonicalAnglesDataset(Dataset):
             l = self._length_rng.choice(self.all_lengths, size=n, replace=True).tolist()
         return l
 
+    @property
+    def means(self) -> Optional[np.ndarray]:
+        """Means that the angles are offset by, None if not zero centered"""
+        return self._means
+
+    @means.setter
+    def means(self, value: Optional[np.ndarray]) -> None:
+        self._means = value
+        # Invalidate and, if initialized, eagerly recompute the item angles
+        self._item_angles = {}
+        self._shared_item_angles = {}
+        if (
+            self.precompute
+            and self._returns_angles
+            and hasattr(self, "_item_offsets")
+        ):
+            self.__get_item_angles(zero_center=self._means is not None)
+
+    @property
+    def _returns_angles(self) -> bool:
+        """Whether items include angles, rather than only coords"""
+        return "angles" in self.feature_names
+
+    def __get_item_angles(self, zero_center: bool) -> np.ndarray:
+        """
+        Return the angles of all items concatenated as a contiguous float32
+        array, zero centered and wrapped if specified, subset to the features
+        used, and with nan values replaced by 0. Computed once and cached.
+        """
+        if zero_center in self._item_angles:
+            return self._item_angles[zero_center]
+        angles = np.concatenate(
+            [np.zeros((0, len(self.store.feature_names)), dtype=np.float32)]
+            + [self.store.get_angles(i) for i in self.structure_idx]
+        )
+        if zero_center:
+            assert self.means is not None
+        angles = center_and_select_features(
+            angles,
+            self.store.feature_names,
+            CathCanonicalAnglesDataset.feature_names["angles"],
+            means=self.means if zero_center else None,
+        )
+        if self.shared_memory:
+            self._shared_item_angles[zero_center] = share_array(angles)
+            angles = self._shared_item_angles[zero_center].numpy()
+        self._item_angles[zero_center] = angles
+        return self._item_angles[zero_center]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Shared item angles are pickled as their tensors, as handles to the pages
+        state = self.__dict__.copy()
+        state["_item_angles"] = {
+            k: v
+            for k, v in self._item_angles.items()
+            if k not in self._shared_item_angles
+        }
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        for k, v in self._shared_item_angles.items():
+            self._item_angles[k] = v.numpy()
+
     def get_masked_means(self) -> np.ndarray:
         """Return the means subset to the actual features used"""
         if self.means is None:
@@ -354,12 +697,12 @@ class CathCanonicalAnglesDataset(Dataset):
         return np.copy(self.means)
 
     @functools.cached_property
-    def filenames(self) -> List[str]:
+    def filenames(self) -> StringTable:
         """Return the filenames that constitute this dataset"""
-        return [s["fname"] for s in self.structures]
+        return self.store.fnames.take(self.structure_idx)
 
     def __len__(self) -> int:
-        return len(self.structures)
+        return len(self.structure_idx)
 
     def __getitem__(
         self, index, ignore_zero_center: bool = False
@@ -367,13 +710,37 @@ class CathCanonicalAnglesDataset(Dataset):
         if not 0 <= index < len(self):
             raise IndexError("Index out of range")
 
-        angles = self.structures[index]["angles"]
+        zero_center = self.means is not None and not ignore_zero_center
+        if not self._returns_angles:
+            # Subclasses drop the angles, so avoid materializing them at all
+            coords = np.array(self.store.get_coords(self.structure_idx[index]))
+            angles = np.zeros((coords.shape[0], 0), dtype=np.float32)
+        elif self.precompute:
+            # Copies so that returned tensors never alias the dataset
+            o, n = self._item_offsets[index], self.all_lengths[index]
+            angles = np.array(self.__get_item_angles(zero_center)[o : o + n])
+            coords = np.array(self.store.get_coords(self.structure_idx[index]))
+        else:
+            angles, coords = self.__process_item(index, zero_center)
+        return pad_and_mask(
+            angles, coords, pad=self.pad, trim_strategy=self.trim_strategy, rng=self.rng
+        )
+
+    def __process_item(
+        self, index: int, zero_center: bool
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Per item equivalent of __get_item_angles operating on a DataFrame,
+        used if not precomputing. Returns the angles and coords.
+        """
+        structure = self.store[self.structure_idx[index]]
+        angles = structure["angles"]
         # NOTE coords are NOT shifted or wrapped, has same length as angles
-        coords = self.structures[index]["coords"]
+        coords = structure["coords"]
         assert angles.shape[0] == coords.shape[0]
 
         # If given, offset the angles with mean
-        if self.means is not None and not ignore_zero_center:
+        if zero_center:
             assert (
                 self.means.shape[0] == angles.shape[1]
             ), f"Mismatched shapes for mean offset: {self.means.shape} != {angles.shape}"
@@ -399,47 +766,6 @@ class CathCanonicalAnglesDataset(Dataset):
         # Replace nan values with zero
         np.nan_to_num(angles, copy=False, nan=0)
 
-        # Create attention mask. 0 indicates masked
-        l = min(self.pad, angles.shape[0])
-        attn_mask = torch.zeros(size=(self.pad,))
-        attn_mask[:l] = 1.0
-
-        # Additionally, mask out positions that are nan
-        # is_nan = np.where(np.any(np.isnan(angles), axis=1))[0]
-        # attn_mask[is_nan] = 0.0  # Mask out the nan positions
-
-        # Perform padding/trimming
-        if angles.shape[0] < self.pad:
-            angles = np.pad(
-                angles,
-                ((0, self.pad - angles.shape[0]), (0, 0)),
-                mode="constant",
-                constant_values=0,
-            )
-            coords = np.pad(
-                coords,
-                ((0, self.pad - coords.shape[0]), (0, 0)),
-                mode="constant",
-                constant_values=0,
-            )
-        elif angles.shape[0] > self.pad:
-            if self.trim_strategy == "leftalign":
-                angles = angles[: self.pad]
-                coords = coords[: self.pad]
-            elif self.trim_strategy == "randomcrop":
-                # Randomly crop the sequence to
-                start_idx = self.rng.integers(0, angles.shape[0] - self.pad)
-                end_idx = start_idx + self.pad
-                assert end_idx < angles.shape[0]
-                angles = angles[start_idx:end_idx]
-                coords = coords[start_idx:end_idx]
-                assert angles.shape[0] == coords.shape[0] == self.pad
-            else:
-                raise ValueError(f"Unknown trim strategy: {self.trim_strategy}")
-
-        # Create position IDs
-        position_ids = torch.arange(start=0, end=self.pad, step=1, dtype=torch.long)
-
         angular_idx = np.where(CathCanonicalAnglesDataset.feature_is_angular["angles"])[
             0
         ]
@@ -449,17 +775,7 @@ class CathCanonicalAnglesDataset(Dataset):
         assert utils.tolerant_comparison_check(
             angles[:, angular_idx], "<=", np.pi
         ), f"Illegal value: {np.max(angles[:, angular_idx])}"
-        angles = torch.from_numpy(angles).float()
-        coords = torch.from_numpy(coords).float()
-
-        retval = {
-            "angles": angles,
-            "coords": coords,
-            "attn_mask": attn_mask,
-            "position_ids": position_ids,
-            "lengths": torch.tensor(l, dtype=torch.int64),
-        }
-        return retval
+        return angles, coords
 
     def get_feature_mean_var(self, ft_name: str) -> Tuple[float, float]:
         """
@@ -469,6 +785,17 @@ class CathCanonicalAnglesDataset(Dataset):
         idx = self.feature_names["angles"].index(ft_name)
         logging.info(f"Computing metrics for {ft_name} - idx {idx}")
 
+        if self.precompute:
+            # The values within the attention mask of each item are its first pad
+            # values, or a window of pad values if randomly cropping
+            angles = self.__get_item_angles(zero_center=self.means is not None)
+            col = CathCanonicalAnglesDataset.feature_names["angles"].index(ft_name)
+            pos = np.arange(angles.shape[0]) - np.repeat(
+                self._item_offsets, self.all_lengths
+            )
+            stats = cm.FeatureStatistics.from_values(angles[pos < self.pad, col, None])
+            return torch.tensor(stats.mean[0]), torch.tensor(stats.var(ddof=1)[0])
+
         all_vals = []
         for i in range(len(self)):
             item = self[i]
@@ -532,7 +859,10 @@ class CathCanonicalAnglesOnlyDataset(CathCanonicalAnglesDataset):
         if self.means is None:
             raise NotImplementedError
         logging.info(f"Setting means for features {self.feature_idx} <- {mean_values}")
-        self.means[self.feature_idx] = mean_values.copy()
+        # Assign rather than modify in place so that item angles are recomputed
+        means = np.copy(self.means)
+        means[self.feature_idx] = mean_values.copy()
+        self.means = means
 
     def __getitem__(
         self, index, ignore_zero_center: bool = False
@@ -566,6 +896,303 @@ class CathCanonicalMinimalAnglesDataset(CathCanonicalAnglesOnlyDataset):
     feature_is_angular = {"angles": [True, True, True, True]}
 
 
+class ShardSplitStatistics:
+    """
+    Per-split statistics of structures, accumulated while writing shards and
+    stored in the shard index so that ShardedAnglesDataset does not need to
+    read the corpus to get lengths or the means to zero center by
+    """
+
+    def __init__(self, n_features: int) -> None:
+        self.n_features = n_features
+        self.n_structures = {k: 0 for k in SPLIT_FRACTIONS}
+        self.length_counts = {k: np.zeros(0, dtype=np.int64) for k in SPLIT_FRACTIONS}
+        self.statistics = {
+            k: cm.FeatureStatistics.empty(n_features) for k in SPLIT_FRACTIONS
+        }
+
+    def add(self, key: str, angles: np.ndarray) -> None:
+        """Add a structure with the given key and (n_residues, n_features) angles"""
+        assert angles.ndim == 2 and angles.shape[1] == self.n_features
+        split = hash_split(key)
+        self.n_structures[split] += 1
+        counts = self.length_counts[split]
+        if len(counts) <= angles.shape[0]:
+            counts = np.pad(counts, (0, angles.shape[0] + 1 - len(counts)))
+        counts[angles.shape[0]] += 1
+        self.length_counts[split] = counts
+        self.statistics[split].update(angles)
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        """Return the statistics of each split as a JSON-friendly dict"""
+        return {
+            k: {
+                "n_structures": self.n_structures[k],
+                "length_counts": self.length_counts[k].tolist(),
+                "statistics": self.statistics[k].to_dict(),
+            }
+            for k in SPLIT_FRACTIONS
+        }
+
+
+class ShardedAnglesDataset(IterableDataset):
+    """
+    Stream structures from a directory of shards written by bin/write_shards.py
+    rather than holding the corpus in memory. Items match those of the
+    CathCanonical datasets for the given feature set.
+
+    Structures are assigned to splits by hashing their keys, so splits are
+    stable as the corpus grows; note that these are not the same splits as the
+    in-memory datasets. Shards are partitioned across distributed replicas and
+    DataLoader workers, so there should be many more shards than workers.
+    Every replica yields exactly len(self) items, so that replicas run the same
+    number of steps: replicas with more structures than that skip the rest, and
+    those with fewer repeat theirs, or those of all shards if they have none.
+    Shuffling shuffles the order of the shards, and the items within a bounded
+    buffer of shuffle_buffer items.
+    """
+
+    def __init__(
+        self,
+        dirname: str,
+        feature_set: str = "canonical-full-angles",
+        split: Optional[Literal["train", "test", "validation"]] = None,
+        pad: int = 512,
+        min_length: int = 40,  # Set to 0 to disable
+        trim_strategy: TRIM_STRATEGIES = "leftalign",
+        zero_center: bool = True,  # Center the features to have 0 mean
+        shuffle: bool = False,
+        shuffle_buffer: int = 1000,
+        seed: int = 6489,
+    ) -> None:
+        super().__init__()
+        assert pad > min_length
+        index = read_shard_index(dirname)
+        assert index is not None, f"No shards found at {dirname}"
+        self.dirname = dirname
+        self.shard_fnames = [os.path.join(dirname, s["fname"]) for s in index["shards"]]
+        self.store_feature_names = index["feature_names"]
+
+        self.feature_set = feature_set
+        self.dset_key = "coords" if feature_set == "cart-coords" else "angles"
+        self.feature_names = {
+            self.dset_key: FEATURE_SET_NAMES_TO_FEATURE_NAMES[feature_set]
+        }
+        self.feature_is_angular = {
+            self.dset_key: FEATURE_SET_NAMES_TO_ANGULARITY[feature_set]
+        }
+
+        self.split = split
+        self.pad = pad
+        self.min_length = min_length
+        self.trim_strategy = trim_strategy
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+        # Aggregate the statistics of the splits that make up this dataset
+        split_stats = [
+            v
+            for k, v in index["metadata"]["splits"].items()
+            if split is None or k == split
+        ]
+        assert split_stats, f"Unknown split: {split}"
+        self.length_counts = np.zeros(
+            max(len(v["length_counts"]) for v in split_stats), dtype=np.int64
+        )
+        for v in split_stats:
+            counts = np.asarray(v["length_counts"], dtype=np.int64)
+            self.length_counts[: len(counts)] += counts
+        self.length_counts[: self.min_length] = 0
+        if self.trim_strategy == "discard":
+            self.length_counts[self.pad + 1 :] = 0
+        logging.info(
+            f"Sharded dataset {dirname} split {split} contains {self.length_counts.sum()} structures in {len(self.shard_fnames)} shards"
+        )
+        # Number of structures in each shard that belong to this dataset, read
+        # here so that workers do not each read every shard to balance their load
+        self.shard_counts = np.array(
+            [
+                len(self.__keep(*read_shard(fname, arrays=["lengths"])))
+                for fname in self.shard_fnames
+            ],
+            dtype=np.int64,
+        )
+        self._length_rng = np.random.default_rng(seed=6489)
+
+        # Means are computed before filtering by length, unlike in-memory datasets
+        self.means = None
+        if zero_center and self.dset_key == "angles":
+            stats = functools.reduce(
+                cm.FeatureStatistics.merge,
+                [cm.FeatureStatistics.from_dict(v["statistics"]) for v in split_stats],
+            )
+            self.means = stats.wrapped_mean()
+            logging.info(
+                f"Offsetting features {self.store_feature_names} by means {self.means}"
+            )
+
+    def get_masked_means(self) -> Optional[np.ndarray]:
+        """Return the means subset to the actual features used"""
+        if self.means is None:
+            return None
+        idx = [
+            self.store_feature_names.index(ft)
+            for ft in self.feature_names[self.dset_key]
+        ]
+        return np.copy(self.means)[idx]
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch, which seeds the shuffling in the main process"""
+        self.epoch = epoch
+
+    def sample_length(self, n: int = 1) -> Union[int, List[int]]:
+        """
+        Sample a observed length of a sequence
+        """
+        assert n > 0
+        p = self.length_counts / self.length_counts.sum()
+        l = self._length_rng.choice(len(p), size=n, replace=True, p=p).tolist()
+        return l[0] if n == 1 else l
+
+    def __len__(self) -> int:
+        """Number of structures in this split, divided across replicas"""
+        num_replicas, _ = _replicas()
+        return -(-int(self.length_counts.sum()) // num_replicas)
+
+    def __keep(self, store: FeatureStore, keys: Sequence[str]) -> np.ndarray:
+        """Indices of the structures in a shard that belong to this dataset"""
+        keep = store.lengths >= self.min_length
+        if self.trim_strategy == "discard":
+            keep &= store.lengths <= self.pad
+        if self.split is not None:
+            keep &= np.array([hash_split(k) == self.split for k in keys], dtype=bool)
+        return np.where(keep)[0]
+
+    def __worker_quota(
+        self, rank: int, worker_id: int, num_replicas: int, num_workers: int
+    ) -> int:
+        """
+        Number of items the given worker yields, so that the workers of each
+        replica together yield len(self) items. Workers yield their own
+        structures where possible, taking any shortfall in equal parts.
+        """
+        parts = num_replicas * num_workers
+        counts = np.array(
+            [
+                self.shard_counts[rank * num_workers + w :: parts].sum()
+                for w in range(num_workers)
+            ],
+            dtype=np.int64,
+        )
+        target = len(self)
+        if counts.sum() >= target:
+            quotas = target * counts // max(counts.sum(), 1)
+            # Hand out the remainder to workers with structures to spare
+            for w in np.where(quotas < counts)[0][: target - quotas.sum()]:
+                quotas[w] += 1
+        else:
+            deficit = target - counts.sum()
+            quotas = counts + deficit // num_workers
+            quotas[: deficit % num_workers] += 1
+        return int(quotas[worker_id])
+
+    @functools.cached_property
+    def filenames(self) -> StringTable:
+        """Return the filenames that constitute this dataset"""
+        retval = []
+        for fname in self.shard_fnames:
+            store, keys = read_shard(fname, arrays=["lengths"])
+            retval.extend(store.fnames[i] for i in self.__keep(store, keys))
+        return StringTable.from_strings(retval)
+
+    def __iter_shards(
+        self, shard_fnames: Sequence[str], rng: np.random.Generator
+    ) -> Iterator[Dict[str, torch.Tensor]]:
+        """Yield the items of the given shards in order"""
+        for fname in shard_fnames:
+            store, keys = read_shard(fname)
+            for i in self.__keep(store, keys):
+                angles = center_and_select_features(
+                    store.get_angles(i),
+                    store.feature_names,
+                    self.feature_names["angles"]
+                    if self.dset_key == "angles"
+                    else store.feature_names,
+                    means=self.means,
+                )
+                item = pad_and_mask(
+                    angles,
+                    np.array(store.get_coords(i)),
+                    pad=self.pad,
+                    trim_strategy=self.trim_strategy,
+                    rng=rng,
+                )
+                if self.dset_key == "coords":
+                    item.pop("angles")
+                yield item
+
+    def __iter_pass(
+        self, shard_fnames: Sequence[str], rng: np.random.Generator
+    ) -> Iterator[Dict[str, torch.Tensor]]:
+        """Yield the items of the given shards once, shuffled if specified"""
+        if not self.shuffle:
+            yield from self.__iter_shards(shard_fnames, rng)
+            return
+
+        shard_fnames = [shard_fnames[i] for i in rng.permutation(len(shard_fnames))]
+        buffer = []
+        for item in self.__iter_shards(shard_fnames, rng):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = item
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+    def __iter_repeated(
+        self, shard_fnames: Sequence[str], rng: np.random.Generator
+    ) -> Iterator[Dict[str, torch.Tensor]]:
+        """
+        Yield the items of the given shards, repeating them indefinitely, or
+        those of all shards if the given shards have none
+        """
+        for candidates in (shard_fnames, self.shard_fnames):
+            while True:
+                n = 0
+                for item in self.__iter_pass(candidates, rng):
+                    n += 1
+                    yield item
+                if not n:
+                    break
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers, seed = 0, 1, self.seed + self.epoch
+            if self.shuffle:
+                # Advance so that epochs differ even if set_epoch is never called
+                self.epoch += 1
+        else:
+            # The base seed of workers is drawn anew for each epoch
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            seed = self.seed + worker_info.seed
+        num_replicas, rank = _replicas()
+        # Partition shards in a fixed order so that no two workers overlap
+        shard_fnames = self.shard_fnames[
+            rank * num_workers + worker_id :: num_replicas * num_workers
+        ]
+        rng = np.random.default_rng(seed=[seed, rank])
+        quota = self.__worker_quota(rank, worker_id, num_replicas, num_workers)
+        yield from itertools.islice(self.__iter_repeated(shard_fnames, rng), quota)
+
+    def __str__(self) -> str:
+        return f"ShardedAnglesDataset of {self.feature_set} from {self.dirname} split {self.split}"
+
+
 class AnglesEmptyDataset(Dataset):
     """
     "Dataset" that doesn't actually contain any data. This is so that we can run sampling without needing to load
@@ -627,16 +1254,22 @@ class AutoregressiveCausalDataset(Dataset):
     """
     Class that produces otuoputs in a causal LM format.
     Wrapped dset should return a dictionary with keys as strings and values as tensors
+
+    By default, each item has a single target at a randomly chosen position. With
+    all_positions, each item instead has the next values as targets at every
+    position, for teacher forced training with a causal attention mask.
     """
 
     def __init__(
         self,
         dset: Dataset,
         dset_key: str = "angles",
+        all_positions: bool = False,
     ) -> None:
         super().__init__()
         self.dset = dset
         self.dset_key = dset_key
+        self.all_positions = all_positions
         assert hasattr(self.dset, "feature_names")
         assert hasattr(self.dset, "feature_is_angular")
         assert (
@@ -656,6 +1289,9 @@ class AutoregressiveCausalDataset(Dataset):
         orig_len = return_dict["lengths"].item()
         assert orig_len <= self.dset.pad
 
+        if self.all_positions:
+            return self.__shifted_targets(return_dict)
+
         # sample a length, high is exclusive, generate uniformly
         causal_len = torch.randint(low=1, high=orig_len, size=(1,)).item()
         assert causal_len < orig_len
@@ -677,9 +1313,30 @@ class AutoregressiveCausalDataset(Dataset):
         return_dict["causal_idx"] = causal_len
         return return_dict
 
+    def __shifted_targets(
+        self, return_dict: Dict[str, torch.Tensor]
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Add the values at the next position as the target for every position,
+        and a mask of the positions whose next position is not padding
+        """
+        assert (
+            "causal_target" not in return_dict
+            and "causal_target_mask" not in return_dict
+        )
+        vals = return_dict[self.dset_key]
+        assert vals.ndim == 2
+        causal_target = torch.zeros_like(vals)
+        causal_target[:-1] = vals[1:]
+        causal_target_mask = torch.zeros_like(return_dict["attn_mask"])
+        causal_target_mask[:-1] = return_dict["attn_mask"][1:]
+        return_dict["causal_target"] = causal_target
+        return_dict["causal_target_mask"] = causal_target_mask
+        return return_dict
+
     def __str__(self):
         """Return the string representation"""
-        return f"AutoregressiveCausalDataset wrapping {self.dset} with {self.dset_key}"
+        return f"AutoregressiveCausalDataset wrapping {self.dset} with {self.dset_key} (all positions: {self.all_positions})"
 
 
 class NoisedAnglesDataset(Dataset):
@@ -690,6 +1347,10 @@ class NoisedAnglesDataset(Dataset):
     to noise is under dset_key
 
     modulo can be given as either a float or a list of floats
+
+    With exhaustive_t, each item is repeated at every timestep. If noise is also
+    deferred, each clean item is instead returned once, and iter_timestep_batches
+    expands batches of them across every timestep on device.
     """
 
     def __init__(
@@ -701,9 +1362,11 @@ class NoisedAnglesDataset(Dataset):
         beta_schedule: beta_schedules.SCHEDULES = "linear",
         nonangular_variance: float = 1.0,
         angular_variance: float = 1.0,
+        defer_noise: bool = False,  # Return clean items, to be noised with noise_batch
     ) -> None:
         super().__init__()
         self.dset = dset
+        self.defer_noise = defer_noise
         assert hasattr(dset, "feature_names")
         assert hasattr(dset, "feature_is_angular")
         self.dset_key = dset_key
@@ -744,6 +1407,13 @@ class NoisedAnglesDataset(Dataset):
         """Pass through the filenames property of the wrapped dset"""
         return self.dset.filenames
 
+    @property
+    def all_lengths(self) -> np.ndarray:
+        """Lengths of each item, repeated across timesteps if exhaustive"""
+        if not self.exhaustive_timesteps or self.defer_noise:
+            return self.dset.all_lengths
+        return np.repeat(self.dset.all_lengths, self.timesteps)
+
     def sample_length(self, *args, **kwargs):
         return self.dset.sample_length(*args, **kwargs)
 
@@ -751,7 +1421,7 @@ class NoisedAnglesDataset(Dataset):
         return f"NoisedAnglesDataset wrapping {self.dset} with {len(self)} examples with {self.schedule}-{self.timesteps} with variance scales {self.nonangular_var_scale} and {self.angular_var_scale}"
 
     def __len__(self) -> int:
-        if not self.exhaustive_timesteps:
+        if not self.exhaustive_timesteps or self.defer_noise:
             return len(self.dset)
         else:
             return int(len(self.dset) * self.timesteps)
@@ -782,13 +1452,15 @@ class NoisedAnglesDataset(Dataset):
 
         # Scale by provided variance scales based on angular or not
         if self.angular_var_scale != 1.0 or self.nonangular_var_scale != 1.0:
-            for j in range(noise.shape[-1]):  # Last dim = feature dim
-                s = (
-                    self.angular_var_scale
-                    if self.dset.feature_is_angular[self.dset_key][j]
-                    else self.nonangular_var_scale
-                )
-                noise[..., j] *= s
+            scales = torch.tensor(
+                [
+                    self.angular_var_scale if is_angular else self.nonangular_var_scale
+                    for is_angular in self.dset.feature_is_angular[self.dset_key]
+                ],
+                dtype=noise.dtype,
+                device=noise.device,
+            )
+            noise *= scales  # Last dim = feature dim
 
         # Make sure that the noise doesn't run over the boundaries
         angular_idx = np.where(self.dset.feature_is_angular[self.dset_key])[0]
@@ -810,7 +1482,7 @@ class NoisedAnglesDataset(Dataset):
         """
         assert 0 <= index < len(self), f"Index {index} out of bounds for {len(self)}"
         # Handle cases where we exhaustively loop over t
-        if self.exhaustive_timesteps:
+        if self.exhaustive_timesteps and not self.defer_noise:
             item_index = index // self.timesteps
             assert item_index < len(self.dset)
             time_index = index % self.timesteps
@@ -826,6 +1498,10 @@ class NoisedAnglesDataset(Dataset):
         else:
             item = self.dset.__getitem__(index, ignore_zero_center=ignore_zero_center)
 
+        # Leave noising to noise_batch, unless a specific timestep is requested
+        if self.defer_noise and use_t_val is None:
+            return item
+
         # If wrapped dset returns a dictionary then we extract the item to noise
         if self.dset_key is not None:
             assert isinstance(item, dict)
@@ -843,7 +1519,7 @@ class NoisedAnglesDataset(Dataset):
             ), "Cannot use specific t in exhaustive mode"
             t_val = np.clip(np.array([use_t_val]), 0, self.timesteps - 1)
             t = torch.from_numpy(t_val).long()
-        elif self.exhaustive_timesteps:
+        elif self.exhaustive_timesteps and not self.defer_noise:
             t = torch.tensor([time_index]).long()  # list to get correct shape
         else:
             t = torch.randint(0, self.timesteps, (1,)).long()
@@ -885,6 +1561,88 @@ class NoisedAnglesDataset(Dataset):
             return item
         return retval
 
+    def noise_batch(self, batch: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """
+        Noise a collated batch of clean items from defer_noise, as __getitem__
+        does for a single item but vectorized across the batch, on the device
+        of the batch. If the batch contains t, uses those timesteps.
+        """
+        vals = batch[self.dset_key]
+        assert vals.ndim == 3, f"Expected (batch, seq_len, features), got {vals.shape}"
+        if "t" in batch:
+            t = batch["t"].long()
+        else:
+            t = torch.randint(0, self.timesteps, (vals.shape[0], 1), device=vals.device)
+        sqrt_alphas_cumprod_t = self.alpha_beta_terms["sqrt_alphas_cumprod"].to(
+            vals.device
+        )[t.squeeze(-1)]
+        sqrt_one_minus_alphas_cumprod_t = self.alpha_beta_terms[
+            "sqrt_one_minus_alphas_cumprod"
+        ].to(vals.device)[t.squeeze(-1)]
+        noise = self.sample_noise(vals)  # Vals passed in only for shape
+
+        noised_vals = (
+            sqrt_alphas_cumprod_t.to(vals.dtype)[:, None, None] * vals
+            + sqrt_one_minus_alphas_cumprod_t.to(vals.dtype)[:, None, None] * noise
+        )
+        angular_idx = np.where(self.dset.feature_is_angular[self.dset_key])[0]
+        noised_vals[..., angular_idx] = utils.modulo_with_wrapped_range(
+            noised_vals[..., angular_idx], -np.pi, np.pi
+        )
+
+        retval = dict(batch)
+        retval.update(
+            {
+                "corrupted": noised_vals,
+                "t": t,
+                "known_noise": noise,
+                "sqrt_alphas_cumprod_t": sqrt_alphas_cumprod_t,
+                "sqrt_one_minus_alphas_cumprod_t": sqrt_one_minus_alphas_cumprod_t,
+            }
+        )
+        return retval
+
+    def iter_timestep_batches(
+        self, batch: Dict[str, torch.Tensor], max_items: int = 512
+    ) -> Iterator[Tuple[range, Dict[str, torch.Tensor]]]:
+        """
+        Noise each clean item of a collated batch at every timestep. Yields the
+        timesteps covered and batches of at most max_items items (but at least one
+        timestep), ordered by timestep then item. Each is noised in one op by
+        noise_batch, without reloading the items.
+        """
+        bs = batch[self.dset_key].shape[0]
+        step = max(1, max_items // bs)
+        device = batch[self.dset_key].device
+        for start in range(0, self.timesteps, step):
+            timesteps = range(start, min(start + step, self.timesteps))
+            expanded = {
+                k: v.repeat(len(timesteps), *[1] * (v.ndim - 1))
+                for k, v in batch.items()
+            }
+            t = torch.arange(timesteps.start, timesteps.stop, device=device)
+            expanded["t"] = t.repeat_interleave(bs)[:, None]
+            yield timesteps, self.noise_batch(expanded)
+
+
+class NoisedAnglesIterableDataset(NoisedAnglesDataset, IterableDataset):
+    """
+    Streaming counterpart of NoisedAnglesDataset for an iterable dataset, e.g.
+    ShardedAnglesDataset. Yields clean items, to be noised per batch on device
+    with noise_batch.
+    """
+
+    def __init__(self, dset: IterableDataset, **kwargs) -> None:
+        assert not kwargs.get("exhaustive_t", False), "Cannot exhaust t when streaming"
+        kwargs["defer_noise"] = True
+        super().__init__(dset, **kwargs)
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        return iter(self.dset)
+
+    def __getitem__(self, index: int, **kwargs):
+        raise NotImplementedError("Streaming datasets cannot be indexed")
+
 
 class SingleNoisedAngleDataset(NoisedAnglesDataset):
     """
@@ -1197,6 +1955,170 @@ class ScoreMatchingNoisedAnglesDataset(Dataset):
         return super().__getitem__(index)
 
 
+# Keys of items that are indexed by sequence position in their first dimension
+SEQUENCE_KEYS = (
+    "angles",
+    "coords",
+    "attn_mask",
+    "position_ids",
+    "corrupted",
+    "known_noise",
+)
+
+
+class LengthBucketedBatchSampler(Sampler):
+    """
+    Batch sampler that groups items of similar length. Indices are shuffled,
+    split into chunks of batch_size * bucket_factor that are each sorted by
+    length and cut into batches, and the batches are then shuffled. Combined
+    with collate_trim_padding, this avoids computing attention over padding.
+
+    Under distributed training, each replica takes every num_replicas-th batch.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        shuffle: bool = True,
+        bucket_factor: int = 50,
+        drop_last: bool = False,
+        seed: int = 6489,
+    ) -> None:
+        assert batch_size > 0 and bucket_factor > 0
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_factor = bucket_factor
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch, which seeds the shuffling"""
+        self.epoch = epoch
+
+    def _num_batches(self) -> int:
+        """Total number of batches across all replicas"""
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return int(np.ceil(len(self.lengths) / self.batch_size))
+
+    def __len__(self) -> int:
+        num_replicas, _ = _replicas()
+        return self._num_batches() // num_replicas
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rng = np.random.default_rng(seed=self.seed + self.epoch)
+        idx = (
+            rng.permutation(len(self.lengths))
+            if self.shuffle
+            else np.arange(len(self.lengths))
+        )
+        chunk_size = self.batch_size * self.bucket_factor
+        batches = []
+        for i in range(0, len(idx), chunk_size):
+            chunk = idx[i : i + chunk_size]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind="stable")]
+            batches.extend(
+                chunk[j : j + self.batch_size]
+                for j in range(0, len(chunk), self.batch_size)
+            )
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        assert len(batches) == self._num_batches()
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+            # Advance so that epochs differ even if set_epoch is never called
+            self.epoch += 1
+
+        num_replicas, rank = _replicas()
+        for b in batches[rank : len(self) * num_replicas : num_replicas]:
+            yield b.tolist()
+
+
+def collate_trim_padding(
+    batch: List[Dict[str, torch.Tensor]]
+) -> Dict[str, torch.Tensor]:
+    """
+    Collate items and trim the padding of sequence keys to the last position
+    that is unmasked in any item of the batch
+    """
+    retval = default_collate(batch)
+    l = int(torch.where(retval["attn_mask"].any(dim=0))[0].max()) + 1
+    for k in SEQUENCE_KEYS:
+        if k in retval:
+            retval[k] = retval[k][:, :l].contiguous()
+    return retval
+
+
+# Keys of noised items holding one value per item, broadcast per token when packing
+PER_ITEM_NOISE_KEYS = ("t", "sqrt_alphas_cumprod_t", "sqrt_one_minus_alphas_cumprod_t")
+
+
+def collate_pack(
+    batch: List[Dict[str, torch.Tensor]], pad: Optional[int] = None
+) -> Dict[str, torch.Tensor]:
+    """
+    Collate items by packing them into as few rows of length pad as possible
+    (first fit decreasing), rather than padding each item. pad defaults to the
+    padded length of the items. Within each row:
+    * sequence keys are concatenated, followed by zero padding
+    * position_ids restart at 0 for each segment
+    * attn_mask is block diagonal, shape (rows, pad, pad), so that segments
+      cannot attend to each other; padding tokens attend to nothing
+    * per item values such as t are repeated for each token, shape (rows, pad)
+    * lengths is the total number of real tokens
+    """
+    if pad is None:
+        pad = batch[0]["attn_mask"].shape[-1]
+    lengths = [int(item["attn_mask"].sum()) for item in batch]
+    assert all(l <= pad for l in lengths), f"Cannot pack items longer than {pad}"
+
+    # First fit decreasing assignment of items to rows
+    rows, row_lengths = [], []
+    for i in sorted(range(len(batch)), key=lambda i: lengths[i], reverse=True):
+        for r, l in enumerate(row_lengths):
+            if l + lengths[i] <= pad:
+                rows[r].append(i)
+                row_lengths[r] += lengths[i]
+                break
+        else:
+            rows.append([i])
+            row_lengths.append(lengths[i])
+
+    seq_keys = [
+        k
+        for k in SEQUENCE_KEYS
+        if k in batch[0] and k not in ("attn_mask", "position_ids")
+    ]
+    retval = {
+        k: batch[0][k].new_zeros((len(rows), pad, *batch[0][k].shape[1:]))
+        for k in seq_keys
+    }
+    retval["attn_mask"] = torch.zeros((len(rows), pad, pad))
+    retval["position_ids"] = torch.zeros((len(rows), pad), dtype=torch.long)
+    for k in PER_ITEM_NOISE_KEYS:
+        if k in batch[0]:
+            v = torch.as_tensor(batch[0][k])
+            retval[k] = v.new_zeros((len(rows), pad))
+    for r, row in enumerate(rows):
+        start = 0
+        for i in row:
+            l = lengths[i]
+            end = start + l
+            for k in seq_keys:
+                retval[k][r, start:end] = batch[i][k][:l]
+            retval["attn_mask"][r, start:end, start:end] = 1.0
+            retval["position_ids"][r, start:end] = torch.arange(l)
+            for k in PER_ITEM_NOISE_KEYS:
+                if k in retval:
+                    retval[k][r, start:end] = torch.as_tensor(batch[i][k]).reshape(())
+            start = end
+    retval["lengths"] = torch.tensor(row_lengths, dtype=torch.int64)
+    return retval
+
+
 def main():
     dset = CathCanonicalAnglesDataset(
         "/data/alphafold_swissprot",
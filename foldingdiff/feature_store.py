@@ -0,0 +1,629 @@
+"""
+Columnar, memory-mapped on-disk format for featurized structures.
+
+A store is a directory containing:
+* meta.json     - format version, feature names, and any caller metadata
+* angles.npy    - float32 (total_residues, n_features) concatenated angles/distances
+* coords.npy    - float32 (total_residues, 3) concatenated CA coordinates
+* offsets.npy   - int64 (n_structures,) row offset of each structure
+* lengths.npy   - int64 (n_structures,) number of residues in each structure
+* fnames.txt    - newline separated table of source filenames
+* fnames_data.npy, fnames_offsets.npy - the same filenames as a StringTable
+* statistics_*.npy - per-structure FeatureStatistics of the angles, each field
+  of shape (n_structures, n_features), so that dataset splits can compute their
+  means without reading the angles
+
+The arrays are opened with np.load(mmap_mode="r") so that datasets, and the
+DataLoader workers forked from them, share the same physical pages rather than
+each unpickling a private copy of the corpus. Filenames are held in a single
+StringTable rather than as a str object each, so that there are no per-structure
+Python objects whose refcounts trigger copy-on-write in forked workers. Stores
+can also be moved into shared memory with share_memory(), which additionally
+keeps workers started by spawning from receiving copies.
+
+Stores are assembled from a FeaturizationCache, which holds one entry per
+structure keyed on the md5 of the file contents, so that adding or changing a
+handful of files only featurizes those files.
+
+Corpora too large to hold in memory are instead written as a directory of
+shards by ShardWriter. Each shard is an npz holding the arrays above for a
+fixed number of structures, plus their filenames and keys, and shards.json
+indexes the shards for streaming.
+"""
+
+import os
+import json
+import shutil
+import logging
+from typing import *
+
+import numpy as np
+import pandas as pd
+
+import torch
+
+from foldingdiff import utils
+from foldingdiff.custom_metrics import FeatureStatistics
+
+FORMAT_VERSION = 3
+
+META_FNAME = "meta.json"
+ARRAY_NAMES = ("angles", "coords", "offsets", "lengths")
+FNAMES_FNAME = "fnames.txt"
+FNAMES_TABLE_NAMES = ("fnames_data", "fnames_offsets")
+STATISTICS_NAMES = tuple(f"statistics_{k}" for k in FeatureStatistics.field_names)
+SHARD_INDEX_FNAME = "shards.json"
+
+
+class StringTable:
+    """
+    Immutable sequence of strings stored as one utf-8 encoded byte array, with
+    the i-th string at data[offsets[i] : offsets[i + 1]]. Lookups by value build
+    a dict of each string to its first index on first use, which is not pickled.
+    """
+
+    # Built on first lookup by value
+    _index = None
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray) -> None:
+        assert data.dtype == np.uint8 and offsets.ndim == 1 and len(offsets) > 0
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]):
+        """Build a table from the given strings"""
+        encoded = [x.encode() for x in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in encoded])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8).copy(), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, "StringTable"]:
+        if isinstance(index, slice):
+            return self.take(range(*index.indices(len(self))))
+        if not -len(self) <= index < len(self):
+            raise IndexError("Index out of range")
+        index %= len(self)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.data[start:end].tobytes().decode()
+
+    def __iter__(self) -> Iterator[str]:
+        return (self[i] for i in range(len(self)))
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, StringTable):
+            return np.array_equal(self.offsets, other.offsets) and np.array_equal(
+                self.data, other.data
+            )
+        if isinstance(other, (list, tuple)):
+            return self.tolist() == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state.pop("_index", None)
+        return state
+
+    def __lookup(self) -> Dict[str, int]:
+        """Return the dict of each string to its first index"""
+        if self._index is None:
+            index = {}
+            for i, x in enumerate(self):
+                index.setdefault(x, i)
+            self._index = index
+        return self._index
+
+    def __contains__(self, x: str) -> bool:
+        return x in self.__lookup()
+
+    def index(self, x: str) -> int:
+        """Return the index of the first occurrence of x"""
+        try:
+            return self.__lookup()[x]
+        except KeyError:
+            raise ValueError(f"{x} is not in table") from None
+
+    def take(self, indices: Sequence[int]):
+        """Return a new table of the strings at the given indices"""
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        # Position of each byte of the new table in the original data
+        pos = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return StringTable(self.data[pos], offsets)
+
+    def tolist(self) -> List[str]:
+        return list(self)
+
+
+def share_array(arr: np.ndarray) -> torch.Tensor:
+    """
+    Return a copy of arr as a tensor in shared memory, which is pickled by
+    torch.multiprocessing (e.g. for DataLoader workers) as a handle to the
+    same pages. Its .numpy() is a view of the shared memory.
+    """
+    return torch.from_numpy(np.array(arr)).share_memory_()
+
+
+class FeatureStore:
+    """
+    Concatenated per-residue features for a collection of structures. The i-th
+    structure occupies rows offsets[i] : offsets[i] + lengths[i] of angles and
+    coords.
+    """
+
+    # Set by load() and share_memory() respectively, to pickle without copying
+    _mmap_dirname = None
+    _shared = None
+    # Computed on first access if not loaded
+    _statistics = None
+
+    def __init__(
+        self,
+        angles: np.ndarray,
+        coords: np.ndarray,
+        offsets: np.ndarray,
+        lengths: np.ndarray,
+        fnames: Sequence[str],
+        feature_names: Sequence[str],
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        assert angles.ndim == 2 and coords.ndim == 2
+        assert angles.shape[0] == coords.shape[0], "Mismatched angles and coords"
+        assert angles.shape[1] == len(
+            feature_names
+        ), f"Got {angles.shape[1]} features but {len(feature_names)} names"
+        assert offsets.shape == lengths.shape == (len(fnames),)
+        self.angles = angles
+        self.coords = coords
+        self.offsets = offsets
+        self.lengths = lengths
+        if not isinstance(fnames, StringTable):
+            fnames = StringTable.from_strings(fnames)
+        self.fnames = fnames
+        self.feature_names = list(feature_names)
+        self.metadata = metadata if metadata is not None else {}
+
+    @classmethod
+    def from_structures(
+        cls,
+        structures: Sequence[Dict[str, Any]],
+        feature_names: Optional[Sequence[str]] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        Build an in-memory store from a list of dicts with keys (angles, coords,
+        fname), where angles is a DataFrame as returned by featurization
+        """
+        if feature_names is None:
+            assert structures, "Cannot infer feature names from no structures"
+            feature_names = list(structures[0]["angles"].columns)
+        lengths = np.array([len(s["angles"]) for s in structures], dtype=np.int64)
+        offsets = np.zeros_like(lengths)
+        if len(lengths):
+            offsets[1:] = np.cumsum(lengths)[:-1]
+
+        angles = np.zeros((int(lengths.sum()), len(feature_names)), dtype=np.float32)
+        coords = np.zeros((int(lengths.sum()), 3), dtype=np.float32)
+        for s, o, l in zip(structures, offsets, lengths):
+            a = s["angles"]
+            if isinstance(a, pd.DataFrame):
+                a = a.loc[:, feature_names].values
+            assert s["coords"].shape[0] == l, f"Mismatched coords for {s['fname']}"
+            angles[o : o + l] = a
+            coords[o : o + l] = s["coords"]
+        return cls(
+            angles=angles,
+            coords=coords,
+            offsets=offsets,
+            lengths=lengths,
+            fnames=[s["fname"] for s in structures],
+            feature_names=feature_names,
+            metadata=metadata,
+        )
+
+    @staticmethod
+    def read_metadata(dirname: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the metadata of the store at dirname, or None if there is no
+        complete store of the current format version there
+        """
+        meta_fname = os.path.join(dirname, META_FNAME)
+        if not os.path.isfile(meta_fname):
+            return None
+        with open(meta_fname) as source:
+            meta = json.load(source)
+        if meta.get("format_version") != FORMAT_VERSION:
+            logging.warning(
+                f"Feature store {dirname} has format version {meta.get('format_version')}, expected {FORMAT_VERSION}"
+            )
+            return None
+        return meta
+
+    @classmethod
+    def load(cls, dirname: str, mmap: bool = True):
+        """Open the store at dirname, memory mapping the arrays by default"""
+        meta = cls.read_metadata(dirname)
+        if meta is None:
+            raise FileNotFoundError(f"No valid feature store at {dirname}")
+        arrays = {
+            k: np.load(os.path.join(dirname, f"{k}.npy"), mmap_mode="r" if mmap else None)
+            for k in ARRAY_NAMES
+        }
+        fnames = StringTable(
+            *[
+                np.load(
+                    os.path.join(dirname, f"{k}.npy"), mmap_mode="r" if mmap else None
+                )
+                for k in FNAMES_TABLE_NAMES
+            ]
+        )
+        assert len(fnames) == meta["n_structures"]
+        retval = cls(
+            fnames=fnames,
+            feature_names=meta["feature_names"],
+            metadata=meta.get("metadata", {}),
+            **arrays,
+        )
+        retval._statistics = FeatureStatistics(
+            *[
+                np.load(
+                    os.path.join(dirname, f"{k}.npy"), mmap_mode="r" if mmap else None
+                )
+                for k in STATISTICS_NAMES
+            ]
+        )
+        if mmap:
+            retval._mmap_dirname = dirname
+        return retval
+
+    @property
+    def statistics(self) -> FeatureStatistics:
+        """
+        Per-structure FeatureStatistics of the angles, with fields of shape
+        (n_structures, n_features). Saved with the store, so that these are
+        computed once when the store is assembled after featurization.
+        """
+        if self._statistics is None:
+            self._statistics = FeatureStatistics.from_segments(
+                self.angles, self.offsets, self.lengths
+            )
+        return self._statistics
+
+    def share_memory(self):
+        """
+        Move the arrays and filename table into shared memory, so that pickling
+        the store (e.g. for spawned DataLoader workers) passes handles to the same
+        pages rather than copies. Memory mapped stores are already pickled as
+        their location, so need not be shared. Returns self.
+        """
+        self._shared = {k: share_array(getattr(self, k)) for k in ARRAY_NAMES}
+        self._shared["fnames_data"] = share_array(self.fnames.data)
+        self._shared["fnames_offsets"] = share_array(self.fnames.offsets)
+        self.__set_shared_views()
+        self._mmap_dirname = None
+        return self
+
+    def __set_shared_views(self) -> None:
+        """Point the arrays at the shared tensors"""
+        for k in ARRAY_NAMES:
+            setattr(self, k, self._shared[k].numpy())
+        self.fnames = StringTable(
+            self._shared["fnames_data"].numpy(), self._shared["fnames_offsets"].numpy()
+        )
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        if self._mmap_dirname is not None or self._shared is not None:
+            for k in ARRAY_NAMES + ("fnames",):
+                state.pop(k)
+            state.pop("_statistics", None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        if self._shared is not None:
+            self.__set_shared_views()
+        elif self._mmap_dirname is not None:
+            loaded = self.load(self._mmap_dirname)
+            for k in ARRAY_NAMES + ("fnames", "_statistics"):
+                setattr(self, k, getattr(loaded, k))
+
+    def save(self, dirname: str) -> str:
+        """
+        Write the store to dirname. Files are written to a temporary sibling
+        directory that is renamed into place, so readers never see a partial store.
+        """
+        tmp_dirname = dirname.rstrip(os.sep) + f".tmp{os.getpid()}"
+        if os.path.isdir(tmp_dirname):
+            shutil.rmtree(tmp_dirname)
+        os.makedirs(tmp_dirname)
+        for k in ARRAY_NAMES:
+            np.save(os.path.join(tmp_dirname, f"{k}.npy"), np.asarray(getattr(self, k)))
+        for k, v in zip(FNAMES_TABLE_NAMES, (self.fnames.data, self.fnames.offsets)):
+            np.save(os.path.join(tmp_dirname, f"{k}.npy"), np.asarray(v))
+        for k, field in zip(STATISTICS_NAMES, FeatureStatistics.field_names):
+            v = getattr(self.statistics, field)
+            np.save(os.path.join(tmp_dirname, f"{k}.npy"), np.asarray(v))
+        with open(os.path.join(tmp_dirname, FNAMES_FNAME), "w") as sink:
+            sink.write("\n".join(self.fnames))
+        # Metadata is written last as it marks the store as complete
+        with open(os.path.join(tmp_dirname, META_FNAME), "w") as sink:
+            json.dump(
+                {
+                    "format_version": FORMAT_VERSION,
+                    "feature_names": self.feature_names,
+                    "n_structures": len(self),
+                    "n_residues": int(self.angles.shape[0]),
+                    "metadata": self.metadata,
+                },
+                sink,
+                indent=4,
+            )
+
+        if os.path.isdir(dirname):
+            shutil.rmtree(dirname)
+        os.replace(tmp_dirname, dirname)
+        return dirname
+
+    def __len__(self) -> int:
+        return len(self.fnames)
+
+    def get_angles(self, index: int) -> np.ndarray:
+        """Return a (read-only if memory mapped) view of the angles of a structure"""
+        o, l = self.offsets[index], self.lengths[index]
+        return self.angles[o : o + l]
+
+    def get_coords(self, index: int) -> np.ndarray:
+        """Return a (read-only if memory mapped) view of the coords of a structure"""
+        o, l = self.offsets[index], self.lengths[index]
+        return self.coords[o : o + l]
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        """
+        Return a copy of the index-th structure in the same dict format as
+        featurization, i.e. with keys (angles, coords, fname)
+        """
+        return {
+            "angles": pd.DataFrame(
+                np.array(self.get_angles(index)), columns=self.feature_names
+            ),
+            "coords": np.array(self.get_coords(index)),
+            "fname": self.fnames[index],
+        }
+
+    def __str__(self) -> str:
+        return f"FeatureStore with {len(self)} structures and {self.angles.shape[0]} residues of {self.feature_names}"
+
+
+class FeaturizationCache:
+    """
+    Per-structure featurization cache under dirname/schema, where schema
+    identifies the featurization code. Entries are keyed on the md5 of the
+    structure file contents, so they are shared across datasets drawing on
+    the same files (e.g. toy subsets) and survive renames. File hashes are
+    remembered by (size, mtime) to avoid rereading unchanged files.
+
+    Structures that could not be featurized are recorded in a failure manifest
+    keyed the same way, so that they are not retried on every run; delete
+    failures.json to retry them.
+    """
+
+    manifest_basename = "content_hashes.json"
+    failures_basename = "failures.json"
+
+    def __init__(self, dirname: str, schema: str) -> None:
+        self.dirname = os.path.join(dirname, schema)
+        self.schema = schema
+        self.manifest_fname = os.path.join(self.dirname, self.manifest_basename)
+        self.manifest = {}
+        if os.path.isfile(self.manifest_fname):
+            with open(self.manifest_fname) as source:
+                self.manifest = json.load(source)
+        self.failures_fname = os.path.join(self.dirname, self.failures_basename)
+        self.failures = {}
+        if os.path.isfile(self.failures_fname):
+            with open(self.failures_fname) as source:
+                self.failures = json.load(source)
+
+    def content_hashes(self, fnames: Sequence[str]) -> List[str]:
+        """Return the content hash of each of the given files"""
+        retval = []
+        updated = False
+        for fname in fnames:
+            k = os.path.abspath(fname)
+            st = os.stat(k)
+            stat_key = [st.st_size, st.st_mtime_ns]
+            if k in self.manifest and self.manifest[k][:2] == stat_key:
+                retval.append(self.manifest[k][2])
+                continue
+            h = utils.md5_file(k)
+            self.manifest[k] = stat_key + [h]
+            updated = True
+            retval.append(h)
+        if updated:
+            self.__write_json(self.manifest, self.manifest_fname)
+        return retval
+
+    def __write_json(self, obj: Any, fname: str) -> None:
+        """Write obj as json to fname atomically"""
+        os.makedirs(self.dirname, exist_ok=True)
+        tmp_fname = fname + f".tmp{os.getpid()}"
+        with open(tmp_fname, "w") as sink:
+            json.dump(obj, sink)
+        os.replace(tmp_fname, fname)
+
+    def record_failures(self, failures: Dict[str, Dict[str, str]]) -> None:
+        """
+        Record structures that could not be featurized, given as a dict of key
+        to a dict with the fname and reason
+        """
+        if not failures:
+            return
+        self.failures.update(failures)
+        self.__write_json(self.failures, self.failures_fname)
+
+    def entry_fname(self, key: str) -> str:
+        """Entries are sharded into subdirectories by the first 2 characters"""
+        return os.path.join(self.dirname, key[:2], f"{key}.npz")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.isfile(self.entry_fname(key))
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """Return the cached (angles, coords) arrays for key, or None"""
+        fname = self.entry_fname(key)
+        if not os.path.isfile(fname):
+            return None
+        with np.load(fname) as data:
+            return {"angles": data["angles"], "coords": data["coords"]}
+
+    def put(self, key: str, angles: np.ndarray, coords: np.ndarray) -> None:
+        """Write an entry, atomically so concurrent readers never see partial files"""
+        fname = self.entry_fname(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp_fname = fname[: -len(".npz")] + f".tmp{os.getpid()}.npz"
+        np.savez(
+            tmp_fname,
+            angles=np.asarray(angles, dtype=np.float32),
+            coords=np.asarray(coords, dtype=np.float32),
+        )
+        os.replace(tmp_fname, fname)
+
+
+def write_shard(fname: str, store: FeatureStore, keys: Sequence[str]) -> str:
+    """
+    Write the store, and a key for each of its structures, as an uncompressed
+    npz shard at fname. Written atomically so readers never see partial shards.
+    """
+    assert len(keys) == len(store)
+    tmp_fname = fname[: -len(".npz")] + f".tmp{os.getpid()}.npz"
+    np.savez(
+        tmp_fname,
+        **{k: np.asarray(getattr(store, k)) for k in ARRAY_NAMES},
+        fnames=np.array(store.fnames.tolist(), dtype=str),
+        keys=np.array(keys, dtype=str),
+        feature_names=np.array(store.feature_names, dtype=str),
+    )
+    os.replace(tmp_fname, fname)
+    return fname
+
+
+def read_shard(
+    fname: str, arrays: Sequence[str] = ARRAY_NAMES
+) -> Tuple[FeatureStore, List[str]]:
+    """
+    Read a shard written by write_shard, returning the store and the keys of its
+    structures. Only the given arrays are read; the others are left empty, which
+    is useful to cheaply read e.g. only lengths and filenames.
+    """
+    with np.load(fname) as data:
+        n = len(data["keys"])
+        feature_names = data["feature_names"].tolist()
+        empty = {
+            "angles": np.zeros((0, len(feature_names)), dtype=np.float32),
+            "coords": np.zeros((0, 3), dtype=np.float32),
+            "offsets": np.zeros(n, dtype=np.int64),
+            "lengths": np.zeros(n, dtype=np.int64),
+        }
+        store = FeatureStore(
+            fnames=data["fnames"].tolist(),
+            feature_names=feature_names,
+            **{k: data[k] if k in arrays else empty[k] for k in ARRAY_NAMES},
+        )
+        return store, data["keys"].tolist()
+
+
+def read_shard_index(dirname: str) -> Optional[Dict[str, Any]]:
+    """
+    Return the index of the shards at dirname, or None if there is no complete
+    set of shards of the current format version there
+    """
+    index_fname = os.path.join(dirname, SHARD_INDEX_FNAME)
+    if not os.path.isfile(index_fname):
+        return None
+    with open(index_fname) as source:
+        index = json.load(source)
+    if index.get("format_version") != FORMAT_VERSION:
+        logging.warning(
+            f"Shards at {dirname} have format version {index.get('format_version')}, expected {FORMAT_VERSION}"
+        )
+        return None
+    return index
+
+
+class ShardWriter:
+    """
+    Write structures to a directory of shards of structures_per_shard structures
+    each, so that corpora can be converted without holding them in memory.
+    Call close() to write the index, which marks the shards as complete.
+    """
+
+    def __init__(
+        self,
+        dirname: str,
+        feature_names: Sequence[str],
+        structures_per_shard: int = 2000,
+    ) -> None:
+        assert structures_per_shard > 0
+        self.dirname = dirname
+        self.feature_names = list(feature_names)
+        self.structures_per_shard = structures_per_shard
+        self.shards = []
+        self._structures, self._keys = [], []
+        os.makedirs(dirname, exist_ok=True)
+        # Any existing index is stale until close() is called
+        if os.path.isfile(os.path.join(dirname, SHARD_INDEX_FNAME)):
+            os.remove(os.path.join(dirname, SHARD_INDEX_FNAME))
+
+    def add(self, structure: Dict[str, Any], key: str) -> None:
+        """Add a structure dict with keys (angles, coords, fname) under key"""
+        self._structures.append(structure)
+        self._keys.append(key)
+        if len(self._structures) >= self.structures_per_shard:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write any pending structures to a new shard"""
+        if not self._structures:
+            return
+        store = FeatureStore.from_structures(
+            self._structures, feature_names=self.feature_names
+        )
+        basename = f"shard_{len(self.shards):06d}.npz"
+        write_shard(os.path.join(self.dirname, basename), store, self._keys)
+        logging.info(f"Wrote {len(store)} structures to shard {basename}")
+        self.shards.append(
+            {
+                "fname": basename,
+                "n_structures": len(store),
+                "n_residues": int(store.angles.shape[0]),
+            }
+        )
+        self._structures, self._keys = [], []
+
+    def close(self, metadata: Optional[Dict[str, Any]] = None) -> str:
+        """Flush and write the index of the shards, returning its filename"""
+        self.flush()
+        index_fname = os.path.join(self.dirname, SHARD_INDEX_FNAME)
+        tmp_fname = index_fname + f".tmp{os.getpid()}"
+        with open(tmp_fname, "w") as sink:
+            json.dump(
+                {
+                    "format_version": FORMAT_VERSION,
+                    "feature_names": self.feature_names,
+                    "shards": self.shards,
+                    "metadata": metadata if metadata is not None else {},
+                },
+                sink,
+                indent=4,
+            )
+        os.replace(tmp_fname, index_fname)
+        return index_fname
@@ -0,0 +1,288 @@
+"""
+Drop-in replacement for the huggingface BertEncoder that computes attention with
+torch.nn.functional.scaled_dot_product_attention, which uses fused kernels that
+avoid materializing the attention probabilities where possible, and projects
+queries, keys, and values with a single fused linear layer.
+
+Parameters are named as in BertEncoder, except that the query, key, and value
+projections of each layer are held as one qkv projection. State dicts are
+mapped between the two layouts as they are loaded and saved, so checkpoints are
+interchangeable between the two encoders.
+
+With unpad, the encoder runs on only the valid tokens of each sequence: the
+padding of a batch is removed before the first layer and restored after the
+last, so projections and feed-forward layers skip padding. Attention is still
+computed with padding, trimmed only to the last valid position in the batch.
+"""
+
+import math
+from typing import *
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from transformers.models.bert.modeling_bert import (
+    BertIntermediate,
+    BertOutput,
+    BertSelfOutput,
+)
+
+from foldingdiff.checkpointing import run_layers
+
+QKV_NAMES = ("query", "key", "value")
+
+
+class Unpadded(NamedTuple):
+    """
+    Layout of unpadded (n_tokens, ...) tensors: index gives the position of
+    each token in a flattened (batch_size, max_len) layout
+    """
+
+    index: torch.Tensor
+    batch_size: int
+    max_len: int
+
+    def pad(self, x: torch.Tensor) -> torch.Tensor:
+        """(n_tokens, ...) -> (batch_size, max_len, ...), with zero padding"""
+        retval = x.new_zeros((self.batch_size * self.max_len,) + x.shape[1:])
+        retval[self.index] = x
+        return retval.view(self.batch_size, self.max_len, *x.shape[1:])
+
+    def unpad(self, x: torch.Tensor) -> torch.Tensor:
+        """(batch_size, max_len, ...) -> (n_tokens, ...)"""
+        return x.reshape(self.batch_size * self.max_len, *x.shape[2:])[self.index]
+
+
+def scaled_dot_product_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attn_mask: Optional[torch.Tensor] = None,
+    dropout_p: float = 0.0,
+) -> torch.Tensor:
+    """
+    F.scaled_dot_product_attention, with an equivalent fallback for versions of
+    torch that predate it. attn_mask is either a boolean mask of positions to
+    attend to, or a float mask added to the attention scores.
+    """
+    if hasattr(F, "scaled_dot_product_attention"):
+        return F.scaled_dot_product_attention(
+            query, key, value, attn_mask=attn_mask, dropout_p=dropout_p
+        )
+    scores = torch.matmul(query, key.transpose(-1, -2)) / math.sqrt(query.shape[-1])
+    if attn_mask is not None and attn_mask.dtype == torch.bool:
+        scores = scores.masked_fill(~attn_mask, float("-inf"))
+    elif attn_mask is not None:
+        scores = scores + attn_mask
+    probs = F.dropout(torch.softmax(scores, dim=-1), p=dropout_p)
+    return torch.matmul(probs, value)
+
+
+class FusedBertSelfAttention(nn.Module):
+    """
+    Self attention equivalent to BertSelfAttention for encoders, including its
+    relative position embeddings, with a fused qkv projection
+    """
+
+    def __init__(self, config) -> None:
+        super().__init__()
+        assert config.hidden_size % config.num_attention_heads == 0
+        self.num_attention_heads = config.num_attention_heads
+        self.attention_head_size = config.hidden_size // config.num_attention_heads
+        self.qkv = nn.Linear(config.hidden_size, 3 * config.hidden_size)
+        self.dropout_p = config.attention_probs_dropout_prob
+        self.position_embedding_type = getattr(
+            config, "position_embedding_type", "absolute"
+        )
+        if self.position_embedding_type in ("relative_key", "relative_key_query"):
+            self.max_position_embeddings = config.max_position_embeddings
+            self.distance_embedding = nn.Embedding(
+                2 * config.max_position_embeddings - 1, self.attention_head_size
+            )
+        self._register_state_dict_hook(self.__split_qkv_state_dict)
+
+    @staticmethod
+    def __split_qkv_state_dict(module, state_dict, prefix, local_metadata) -> None:
+        """Save the qkv projection as separate query, key, value projections"""
+        for param in ("weight", "bias"):
+            fused = state_dict.pop(f"{prefix}qkv.{param}")
+            for name, v in zip(QKV_NAMES, fused.chunk(3, dim=0)):
+                state_dict[f"{prefix}{name}.{param}"] = v
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        """Load separate query, key, value projections into the qkv projection"""
+        for param in ("weight", "bias"):
+            keys = [f"{prefix}{name}.{param}" for name in QKV_NAMES]
+            if all(k in state_dict for k in keys):
+                state_dict[f"{prefix}qkv.{param}"] = torch.cat(
+                    [state_dict.pop(k) for k in keys], dim=0
+                )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attn_mask: torch.Tensor,
+        unpadded: Optional[Unpadded] = None,
+    ):
+        """
+        hidden_states has shape (batch, seq_len, hidden) and attn_mask is a
+        boolean mask broadcastable to (batch, heads, seq_len, seq_len). If
+        unpadded is given, hidden_states has shape (n_tokens, hidden) instead.
+        """
+        qkv = self.qkv(hidden_states)
+        if unpadded is not None:
+            qkv = unpadded.pad(qkv)
+        batch_size, seq_length, _ = qkv.shape
+        # (batch, seq_len, 3 * hidden) -> 3 x (batch, heads, seq_len, head_size)
+        query, key, value = (
+            qkv.view(batch_size, seq_length, 3, self.num_attention_heads, -1)
+            .permute(2, 0, 3, 1, 4)
+            .unbind(0)
+        )
+
+        if self.position_embedding_type in ("relative_key", "relative_key_query"):
+            position_ids = torch.arange(seq_length, device=qkv.device)
+            distance = position_ids[:, None] - position_ids[None, :]
+            positional_embedding = self.distance_embedding(
+                distance + self.max_position_embeddings - 1
+            ).to(dtype=query.dtype)
+            # Relative position scores are added to the scores before scaling
+            bias = torch.einsum("bhld,lrd->bhlr", query, positional_embedding)
+            if self.position_embedding_type == "relative_key_query":
+                bias = bias + torch.einsum("bhrd,lrd->bhlr", key, positional_embedding)
+            bias = bias / math.sqrt(self.attention_head_size)
+            attn_mask = bias.masked_fill(~attn_mask, float("-inf"))
+
+        context = scaled_dot_product_attention(
+            query,
+            key,
+            value,
+            attn_mask=attn_mask,
+            dropout_p=self.dropout_p if self.training else 0.0,
+        )
+        context = context.transpose(1, 2).reshape(batch_size, seq_length, -1)
+        if unpadded is not None:
+            context = unpadded.unpad(context)
+        return context
+
+
+class FusedBertAttention(nn.Module):
+    """Counterpart of BertAttention"""
+
+    def __init__(self, config) -> None:
+        super().__init__()
+        self.self = FusedBertSelfAttention(config)
+        self.output = BertSelfOutput(config)
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attn_mask: torch.Tensor,
+        unpadded: Optional[Unpadded] = None,
+    ):
+        return self.output(self.self(hidden_states, attn_mask, unpadded), hidden_states)
+
+
+class FusedBertLayer(nn.Module):
+    """Counterpart of BertLayer"""
+
+    def __init__(self, config) -> None:
+        super().__init__()
+        self.attention = FusedBertAttention(config)
+        self.intermediate = BertIntermediate(config)
+        self.output = BertOutput(config)
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attn_mask: torch.Tensor,
+        unpadded: Optional[Unpadded] = None,
+    ):
+        attention_output = self.attention(hidden_states, attn_mask, unpadded)
+        return self.output(self.intermediate(attention_output), attention_output)
+
+
+class FusedBertEncoder(nn.Module):
+    """
+    Counterpart of BertEncoder. Takes a 0/1 attention mask of shape (batch,
+    seq_len) over keys, or (batch, seq_len, seq_len) over queries and keys,
+    rather than BertEncoder's additive extended mask. Returns a tuple of the
+    final hidden states.
+
+    If unpad, sequences with (batch, seq_len) masks are encoded with only their
+    unmasked tokens through the projections and feed-forward layers, and the
+    outputs at masked positions are zero. Whether to unpad is decided from the
+    shape of the mask alone, so that the mask is never compared on the host;
+    (batch, seq_len, seq_len) masks are always encoded with padding. Attention
+    itself is still computed on a padded (batch, max_len) rectangle, trimmed
+    only to the last unmasked position of the batch, so sequences shorter than
+    the longest still pay for its length in attention. If checkpoint_every is
+    positive, activations are checkpointed in segments of that many layers
+    when training.
+    """
+
+    def __init__(self, config, unpad: bool = False, checkpoint_every: int = 0) -> None:
+        super().__init__()
+        self.config = config
+        self.unpad = unpad
+        self.checkpoint_every = checkpoint_every
+        self.layer = nn.ModuleList(
+            [FusedBertLayer(config) for _ in range(config.num_hidden_layers)]
+        )
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: torch.Tensor,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+        return_dict: Optional[bool] = None,
+    ) -> Tuple[torch.Tensor]:
+        assert not output_attentions, "Fused attention does not output attentions"
+        assert not output_hidden_states, "Fused attention does not output hidden states"
+        if self.unpad and attention_mask.dim() == 2:
+            return self.__unpadded_forward(hidden_states, attention_mask.bool())
+        if attention_mask.dim() == 2:
+            attn_mask = attention_mask[:, None, None, :].bool()
+        else:
+            attn_mask = attention_mask[:, None, :, :].bool()
+        # Queries with no keys to attend to, e.g. padding of packed sequences,
+        # attend to all keys as they effectively do with an additive mask
+        attn_mask = attn_mask | ~attn_mask.any(dim=-1, keepdim=True)
+        hidden_states = self.__run_layers(hidden_states, attn_mask)
+        return (hidden_states,)
+
+    def __run_layers(self, hidden_states: torch.Tensor, *args) -> torch.Tensor:
+        """Run the layers, checkpointing if set and training"""
+        checkpoint_every = (
+            self.checkpoint_every if self.training and torch.is_grad_enabled() else 0
+        )
+        return run_layers(
+            self.layer, hidden_states, *args, checkpoint_every=checkpoint_every
+        )
+
+    def __unpadded_forward(
+        self, hidden_states: torch.Tensor, valid: torch.Tensor
+    ) -> Tuple[torch.Tensor]:
+        """Encode only the valid tokens, given as a (batch, seq_len) mask"""
+        batch_size, seq_length, hidden_size = hidden_states.shape
+        # Trim to just past the last valid position of any sequence
+        positions = torch.arange(1, seq_length + 1, device=valid.device)
+        max_len = max(int((positions * valid.any(dim=0)).max()), 1)
+        trimmed_valid = valid[:, :max_len]
+        unpadded = Unpadded(
+            index=torch.nonzero(trimmed_valid.flatten()).squeeze(1),
+            batch_size=batch_size,
+            max_len=max_len,
+        )
+        attn_mask = trimmed_valid[:, None, None, :]
+        attn_mask = attn_mask | ~attn_mask.any(dim=-1, keepdim=True)
+
+        tokens = unpadded.unpad(hidden_states[:, :max_len])
+        tokens = self.__run_layers(tokens, attn_mask, unpadded)
+
+        retval = hidden_states.new_zeros(batch_size, seq_length, hidden_size)
+        retval[valid] = tokens
+        return (retval,)
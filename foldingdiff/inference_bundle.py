@@ -0,0 +1,94 @@
+"""
+Minimal inference bundles of trained models, written by bin/export_bundle.py
+or when snapshotting a model with from_dir(..., copy_to=...). A bundle holds
+only what is needed to build the model and sample from it:
+- the weights, in safetensors format, which is memory mapped when loading
+- config.json and training_args.json, as in the training directory
+- the arguments that from_dir would otherwise derive from the training setup
+- the variance schedule tables, precomputed, also in safetensors format
+- the training mean offset, if any
+Unlike a training checkpoint, there is no optimizer or other training state,
+and loading does not need pytorch lightning.
+"""
+import os
+import json
+import shutil
+import logging
+from typing import *
+
+import torch
+from safetensors.torch import load_file, save_file
+
+WEIGHTS_FNAME = "model.safetensors"
+SCHEDULE_FNAME = "schedule.safetensors"
+MODEL_ARGS_FNAME = "model_args.json"
+MEAN_OFFSET_FNAME = "training_mean_offset.npy"
+
+
+def is_bundle(dirname: str) -> bool:
+    """Return whether the directory is an inference bundle"""
+    return os.path.isfile(os.path.join(dirname, WEIGHTS_FNAME))
+
+
+def write_bundle(
+    outdir: str,
+    state_dict: Optional[Dict[str, torch.Tensor]],
+    config,
+    training_args: Dict[str, Any],
+    model_args: Dict[str, Any],
+    mean_offset_fname: Optional[str] = None,
+) -> None:
+    """
+    Write a bundle of the model with the given state dict to outdir, without
+    weights if the state dict is None. config is the BertConfig of the model,
+    and model_args are the json serializable keyword arguments to build the
+    model with, besides the config.
+    """
+    # Imported here since it is only needed for writing, and imports matplotlib
+    from foldingdiff import beta_schedules
+
+    os.makedirs(outdir, exist_ok=True)
+    if state_dict is not None:
+        # safetensors does not allow tensors that share memory
+        save_file(
+            {k: v.detach().cpu().contiguous().clone() for k, v in state_dict.items()},
+            os.path.join(outdir, WEIGHTS_FNAME),
+        )
+    config.save_pretrained(outdir)
+    with open(os.path.join(outdir, "training_args.json"), "w") as sink:
+        json.dump(training_args, sink)
+    with open(os.path.join(outdir, MODEL_ARGS_FNAME), "w") as sink:
+        json.dump(model_args, sink)
+
+    # Autoregressive models are not trained with a variance schedule
+    if "variance_schedule" in training_args:
+        betas = beta_schedules.get_variance_schedule(
+            training_args["variance_schedule"], training_args["timesteps"]
+        )
+        schedule = beta_schedules.compute_alphas(betas)
+        save_file(
+            {k: v.contiguous() for k, v in schedule.items()},
+            os.path.join(outdir, SCHEDULE_FNAME),
+        )
+    if mean_offset_fname is not None and os.path.isfile(mean_offset_fname):
+        shutil.copyfile(mean_offset_fname, os.path.join(outdir, MEAN_OFFSET_FNAME))
+    logging.info(f"Wrote inference bundle to {outdir}")
+
+
+def load_model_args(dirname: str) -> Dict[str, Any]:
+    """Load the keyword arguments to build the model with, besides the config"""
+    with open(os.path.join(dirname, MODEL_ARGS_FNAME)) as source:
+        return json.load(source)
+
+
+def load_weights(dirname: str, device: str = "cpu") -> Dict[str, torch.Tensor]:
+    """Load the state dict of the model in the bundle"""
+    return load_file(os.path.join(dirname, WEIGHTS_FNAME), device=device)
+
+
+def load_schedule(dirname: str, device: str = "cpu") -> Dict[str, torch.Tensor]:
+    """
+    Load the precomputed variance schedule tables, keyed as the output of
+    beta_schedules.compute_alphas
+    """
+    return load_file(os.path.join(dirname, SCHEDULE_FNAME), device=device)
@@ -0,0 +1,108 @@
+"""
+Incremental encoding for causal models, which caches the keys and values of
+each layer so that each step of autoregressive generation only encodes the
+new positions rather than the whole sequence. Runs the layers of either the
+huggingface BertEncoder or the FusedBertEncoder with their weights as they are.
+"""
+import math
+from typing import *
+
+import torch
+from torch import nn
+
+from foldingdiff.fused_attention import (
+    FusedBertSelfAttention,
+    scaled_dot_product_attention,
+)
+
+
+class KVCache:
+    """
+    Keys and values of the positions encoded so far for each layer, each of
+    shape (batch, heads, positions, head_size)
+    """
+
+    def __init__(self, n_layers: int) -> None:
+        self.keys: List[Optional[torch.Tensor]] = [None] * n_layers
+        self.values: List[Optional[torch.Tensor]] = [None] * n_layers
+
+    def update(
+        self, layer_idx: int, key: torch.Tensor, value: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Add the keys and values of new positions, returning those of all"""
+        if self.keys[layer_idx] is not None:
+            key = torch.cat([self.keys[layer_idx], key], dim=2)
+            value = torch.cat([self.values[layer_idx], value], dim=2)
+        self.keys[layer_idx] = key
+        self.values[layer_idx] = value
+        return key, value
+
+    def select(self, idx: torch.Tensor) -> None:
+        """Keep only the given items of the batch, e.g. to drop finished ones"""
+        self.keys = [k if k is None else k[idx] for k in self.keys]
+        self.values = [v if v is None else v[idx] for v in self.values]
+
+
+def _cached_self_attention(
+    attention: nn.Module,
+    hidden_states: torch.Tensor,
+    cache: KVCache,
+    layer_idx: int,
+    start: int,
+) -> torch.Tensor:
+    """
+    Causal self attention of the new positions, starting at position start,
+    over the cached and new positions. attention is either a huggingface
+    BertSelfAttention or a FusedBertSelfAttention.
+    """
+    if isinstance(attention, FusedBertSelfAttention):
+        query, key, value = attention.qkv(hidden_states).chunk(3, dim=-1)
+    else:
+        query = attention.query(hidden_states)
+        key = attention.key(hidden_states)
+        value = attention.value(hidden_states)
+    # (batch, n_new, hidden) -> (batch, heads, n_new, head_size)
+    batch_size, n_new, _ = hidden_states.shape
+    query, key, value = (
+        x.view(batch_size, n_new, attention.num_attention_heads, -1).transpose(1, 2)
+        for x in (query, key, value)
+    )
+    key, value = cache.update(layer_idx, key, value)
+
+    query_positions = torch.arange(start, start + n_new, device=query.device)
+    key_positions = torch.arange(key.shape[2], device=query.device)
+    attn_mask = query_positions[:, None] >= key_positions[None, :]
+    position_embedding_type = attention.position_embedding_type
+    if position_embedding_type in ("relative_key", "relative_key_query"):
+        distance = query_positions[:, None] - key_positions[None, :]
+        positional_embedding = attention.distance_embedding(
+            distance + attention.max_position_embeddings - 1
+        ).to(dtype=query.dtype)
+        bias = torch.einsum("bhld,lrd->bhlr", query, positional_embedding)
+        if position_embedding_type == "relative_key_query":
+            bias = bias + torch.einsum("bhrd,lrd->bhlr", key, positional_embedding)
+        bias = bias / math.sqrt(attention.attention_head_size)
+        attn_mask = bias.masked_fill(~attn_mask, float("-inf"))
+
+    context = scaled_dot_product_attention(query, key, value, attn_mask=attn_mask)
+    return context.transpose(1, 2).reshape(batch_size, n_new, -1)
+
+
+def encode_incremental(
+    encoder: nn.Module, hidden_states: torch.Tensor, cache: KVCache, start: int
+) -> torch.Tensor:
+    """
+    Encode hidden states (batch, n_new, hidden) of the positions starting at
+    start, each attending to itself and all preceding positions, given the
+    cache of the preceding positions, which is updated with the new positions.
+    Dropout is not applied to attention probabilities, so use in eval mode.
+    """
+    for i, layer in enumerate(encoder.layer):
+        context = _cached_self_attention(
+            layer.attention.self, hidden_states, cache, i, start
+        )
+        attention_output = layer.attention.output(context, hidden_states)
+        hidden_states = layer.output(
+            layer.intermediate(attention_output), attention_output
+        )
+    return hidden_states
@@ -51,7 +51,6 @@ def radian_smooth_l1_loss(
 
     abs_d = torch.abs(d)
     retval = torch.where(abs_d < beta, 0.5 * (d**2) / beta, abs_d - 0.5 * beta)
-    assert torch.all(retval >= 0), f"Got negative loss terms: {torch.min(retval)}"
     retval = torch.mean(retval)
 
     # Regularize on "turns" around the circle
@@ -63,6 +62,51 @@ def radian_smooth_l1_loss(
     return retval
 
 
+def feature_smooth_l1_loss(
+    input: torch.Tensor,
+    target: torch.Tensor,
+    mask: torch.Tensor,
+    is_angular: torch.Tensor,
+    beta: torch.Tensor,
+    circle_penalty: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Smooth L1 loss of each feature of input and target, both of shape
+    (batch, seq_len, n_fts), averaged over the positions set in the 0/1 mask of
+    shape (batch, seq_len). Computes all features at once, matching
+    radian_smooth_l1_loss for features where the boolean is_angular of shape
+    (n_fts,) is set, and F.smooth_l1_loss for the rest. beta gives the beta of
+    each feature, where a beta of 0 gives the (radian) L1 loss, and
+    circle_penalty, if given, the circle penalty of each feature.
+    Returns the loss of each feature, of shape (n_fts,).
+
+    >>> x, y = torch.zeros(1, 1, 2), torch.tensor([[[2 * torch.pi - 0.1, 3.0]]])
+    >>> feature_smooth_l1_loss(x, y, torch.ones(1, 1), torch.tensor([True, False]), torch.ones(2))
+    tensor([0.0050, 2.5000])
+    """
+    assert (
+        target.shape == input.shape
+    ), f"Mismatched shapes: {input.shape} != {target.shape}"
+    d = target - input
+    d = torch.where(
+        is_angular, utils.modulo_with_wrapped_range(d, -torch.pi, torch.pi), d
+    )
+    abs_d = torch.abs(d)
+    # Equivalent to 0.5 * d^2 / beta below beta and abs_d - 0.5 * beta above it,
+    # without dividing by a beta of 0 in either branch
+    clipped = torch.minimum(abs_d, beta)
+    retval = 0.5 * clipped**2 / beta.clamp(min=torch.finfo(beta.dtype).tiny)
+    retval = retval + abs_d - clipped
+
+    # Regularize on "turns" around the circle
+    if circle_penalty is not None:
+        turns = torch.div(torch.abs(input), torch.pi, rounding_mode="trunc")
+        retval = retval + circle_penalty * turns
+
+    mask = mask.to(retval.dtype)
+    return torch.einsum("bl,blf->f", mask, retval) / mask.sum()
+
+
 def _get_pairwise_dist_batch(
     values: torch.Tensor, lengths: Sequence[int]
 ) -> Tuple[torch.Tensor, torch.Tensor]:
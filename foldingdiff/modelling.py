@@ -2,486 +2,42 @@
 Modelling
 """
 import os
-import re
-import shutil
 import time
-import glob
-from pathlib import Path
 import json
 import inspect
 import logging
 import math
-import functools
 from typing import *
 
 import torch
-from torch import nn
-from torch.nn import functional as F
 
 import pytorch_lightning as pl
 
-from transformers import BertConfig
-from transformers.models.bert.modeling_bert import (
-    BertPreTrainedModel,
-    BertEncoder,
-)
-from transformers.activations import get_activation
 from transformers.optimization import get_linear_schedule_with_warmup
 
-from tqdm.auto import tqdm
-
 from foldingdiff import losses, nerf
-from foldingdiff.datasets import FEATURE_SET_NAMES_TO_ANGULARITY
+from foldingdiff.base_models import (
+    TIME_ENCODING,
+    DECODER_HEAD,
+    PRECISION,
+    PRECISION_DTYPES,
+    GaussianFourierProjection,
+    SinusoidalPositionEmbeddings,
+    PositionalEncoding,
+    BertEmbeddings,
+    AnglesPredictor,
+    BertForDiffusionBase,
+    BertForAutoregressiveBase,
+)
 
 LR_SCHEDULE = Optional[Literal["OneCycleLR", "LinearWarmup"]]
-TIME_ENCODING = Literal["gaussian_fourier", "sinusoidal"]
 LOSS_KEYS = Literal["l1", "smooth_l1"]
-DECODER_HEAD = Literal["mlp", "linear"]
-
-
-class GaussianFourierProjection(nn.Module):
-    """
-    Gaussian random features for encoding time steps.
-    Built primarily for score-based models.
-
-    Source:
-    https://colab.research.google.com/drive/120kYYBOVa1i0TD85RjlEkFjaWDxSFUx3?usp=sharing#scrollTo=YyQtV7155Nht
-    """
-
-    def __init__(self, embed_dim: int, scale: float = 2 * torch.pi):
-        super().__init__()
-        # Randomly sample weights during initialization. These weights are fixed
-        # during optimization and are not trainable.
-        w = torch.randn(embed_dim // 2) * scale
-        assert w.requires_grad == False
-        self.register_buffer("W", w)
-
-    def forward(self, x: torch.Tensor):
-        """
-        takes as input the time vector and returns the time encoding
-        time (x): (batch_size, )
-        output  : (batch_size, embed_dim)
-        """
-        if x.ndim > 1:
-            x = x.squeeze()
-        elif x.ndim < 1:
-            x = x.unsqueeze(0)
-        x_proj = x[:, None] * self.W[None, :] * 2 * torch.pi
-        embed = torch.cat([torch.sin(x_proj), torch.cos(x_proj)], dim=-1)
-        return embed
-
-
-class SinusoidalPositionEmbeddings(nn.Module):
-    """
-    Positional embeddings
-    """
-
-    def __init__(self, dim: int) -> None:
-        super().__init__()
-        self.dim = dim
-
-    def forward(self, time: torch.Tensor) -> torch.Tensor:
-        device = time.device
-        half_dim = self.dim // 2
-        embeddings = math.log(10000) / (half_dim - 1)
-        # half_dim shape
-        embeddings = torch.exp(torch.arange(half_dim, device=device) * -embeddings)
-        # outer product (batch, 1) x (1, half_dim) -> (batch x half_dim)
-        embeddings = time[:, None] * embeddings[None, :]
-        # sin and cosine embeddings
-        embeddings = torch.cat((embeddings.sin(), embeddings.cos()), dim=-1)
-        return embeddings
-
-
-class PositionalEncoding(nn.Module):
-    """
-    Positional embedding for BERT.
-    Source: https://pytorch.org/tutorials/beginner/transformer_tutorial.html
-    """
-
-    def __init__(self, d_model: int, dropout: float = 0.1, max_len: int = 5000):
-        super().__init__()
-        self.dropout = nn.Dropout(p=dropout)
-
-        position = torch.arange(max_len).unsqueeze(1)
-        div_term = torch.exp(
-            torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model)
-        )
-        pe = torch.zeros(max_len, 1, d_model)
-        pe[:, 0, 0::2] = torch.sin(position * div_term)
-        pe[:, 0, 1::2] = torch.cos(position * div_term)
-        self.register_buffer("pe", pe)
-
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        """
-        Args:
-            x: Tensor, shape [batch_size, seq_len, embedding_dim]
-        """
-        assert len(x.shape) == 3
-        orig_shape = x.shape
-        # x is a tensor of shape (batch_size, seq_len, embedding_dim)
-        # permute to be (seq_len, batch_size, embedding_dim)
-        x = x.permute(1, 0, 2)
-        x += self.pe[: x.size(0)]
-        # permute back to (batch_size, seq_len, embedding_dim)
-        x = x.permute(1, 0, 2)
-        assert x.shape == orig_shape, f"{x.shape} != {orig_shape}"
-        return self.dropout(x)
-
-
-class BertEmbeddings(nn.Module):
-    """
-    Adds in positional embeddings if using absolute embeddings, adds layer norm and dropout
-    """
-
-    def __init__(self, config):
-        super().__init__()
-        self.position_embedding_type = getattr(
-            config, "position_embedding_type", "absolute"
-        )
-        if self.position_embedding_type == "absolute":
-            self.position_embeddings = nn.Embedding(
-                config.max_position_embeddings, config.hidden_size
-            )
-            self.register_buffer(
-                "position_ids",
-                torch.arange(config.max_position_embeddings).expand((1, -1)),
-            )
-
-        # self.LayerNorm is not snake-cased to stick with TensorFlow model variable name and be able to load
-        # any TensorFlow checkpoint file
-        self.LayerNorm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
-        self.dropout = nn.Dropout(config.hidden_dropout_prob)
-        # position_ids (1, len position emb) is contiguous in memory and exported when serialized
-
-    def forward(
-        self,
-        input_embeds: torch.Tensor,
-        position_ids: torch.LongTensor,
-    ) -> torch.Tensor:
-        assert position_ids is not None, "`position_ids` must be defined"
-        embeddings = input_embeds
-        if self.position_embedding_type == "absolute":
-            position_embeddings = self.position_embeddings(position_ids)
-            embeddings += position_embeddings
-
-        embeddings = self.LayerNorm(embeddings)
-        embeddings = self.dropout(embeddings)
-        return embeddings
-
-
-class AnglesPredictor(nn.Module):
-    """
-    Predict angles from the embeddings. For BERT, the MLM task is done using an
-    architecture like
-    d_model -> dense -> d_model -> activation -> layernorm -> dense -> d_output
-    https://github.com/huggingface/transformers/blob/v4.21.1/src/transformers/models/bert/modeling_bert.py#L681
-
-    activation should be given as nn.ReLU for example -- NOT nn.ReLU()
-    """
-
-    def __init__(
-        self,
-        d_model: int,
-        d_out: int = 4,
-        activation: Union[str, nn.Module] = "gelu",
-        eps: float = 1e-12,
-    ) -> None:
-        super().__init__()
-        self.d_model = d_model
-        self.d_out = d_out
-        self.dense1 = nn.Linear(d_model, d_model)
-
-        if isinstance(activation, str):
-            self.dense1_act = get_activation(activation)
-        else:
-            self.dense1_act = activation()
-        self.layer_norm = nn.LayerNorm(d_model, eps=eps)
-
-        self.dense2 = nn.Linear(d_model, d_out)
-
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = self.dense1(x)
-        x = self.dense1_act(x)
-        x = self.layer_norm(x)
-        x = self.dense2(x)
-        return x
-
-
-class BertForDiffusionBase(BertPreTrainedModel):
-    """
-    BERT designed to be used with continuous inputs instead of tokens
-
-    Reference: https://github.com/huggingface/transformers/blob/f681437203baa7671de3174b0fa583c349d9d5e1/src/transformers/models/bert/modeling_bert.py#L870
-
-    Decoder: linear = single linear decoding of per-position embeddings
-             mlp = two-layer MLP to decode per-position embeddings
-
-    This is the base model object and does _not_ include the pytorch lightning code
-    """
-
-    # Define loss functions and their wrapped angular versions
-    nonangular_loss_fn_dict = {
-        "l1": F.l1_loss,
-        "smooth_l1": F.smooth_l1_loss,
-    }
-    angular_loss_fn_dict = {
-        "l1": losses.radian_l1_loss,
-        "smooth_l1": functools.partial(
-            losses.radian_smooth_l1_loss, beta=torch.pi / 10
-        ),
-    }
-    # To have legacy models still work with these
-    loss_autocorrect_dict = {
-        "radian_l1_smooth": "smooth_l1",
-    }
-
-    def __init__(
-        self,
-        config,
-        ft_is_angular: List[bool] = [False, True, True, True],
-        ft_names: Optional[List[str]] = None,
-        time_encoding: TIME_ENCODING = "gaussian_fourier",
-        decoder: DECODER_HEAD = "mlp",
-    ) -> None:
-        """
-        dim should be the dimension of the inputs
-        """
-        super().__init__(config)
-        self.config = config
-        if self.config.is_decoder:
-            raise NotImplementedError
-        self.ft_is_angular = ft_is_angular
-        n_inputs = len(ft_is_angular)
-        self.n_inputs = n_inputs
-
-        if ft_names is not None:
-            self.ft_names = ft_names
-        else:
-            self.ft_names = [f"ft{i}" for i in range(n_inputs)]
-        assert (
-            len(self.ft_names) == n_inputs
-        ), f"Got {len(self.ft_names)} names, expected {n_inputs}"
-
-        # Needed to project the low dimensional input to hidden dim
-        self.inputs_to_hidden_dim = nn.Linear(
-            in_features=n_inputs, out_features=config.hidden_size
-        )
-        self.embeddings = BertEmbeddings(config)
-        self.encoder = BertEncoder(config)
-
-        # Set up the network to project token representation to our four outputs
-        if decoder == "linear":
-            self.token_decoder = nn.Linear(config.hidden_size, n_inputs)
-        elif decoder == "mlp":
-            self.token_decoder = AnglesPredictor(config.hidden_size, n_inputs)
-        else:
-            raise ValueError(f"Unrecognized decoder: {decoder}")
-
-        # Set up the time embedder
-        if time_encoding == "gaussian_fourier":
-            self.time_embed = GaussianFourierProjection(config.hidden_size)
-        elif time_encoding == "sinusoidal":
-            self.time_embed = SinusoidalPositionEmbeddings(config.hidden_size)
-        else:
-            raise ValueError(f"Unknown time encoding: {time_encoding}")
-        pl.utilities.rank_zero_info(f"Using time embedding: {self.time_embed}")
-
-        # Initialize weights and apply final processing
-        self.init_weights()
-
-        # Epoch counters and timers
-        self.train_epoch_counter = 0
-        self.train_epoch_last_time = time.time()
-
-    @classmethod
-    def from_dir(
-        cls,
-        dirname: str,
-        ft_is_angular: Optional[Sequence[bool]] = None,
-        load_weights: bool = True,
-        idx: int = -1,
-        best_by: Literal["train", "valid"] = "valid",
-        copy_to: str = "",
-        **kwargs,
-    ):
-        """
-        Builds this model out from directory. Legacy mode is for loading models
-        before there were separate folders for training and validation best models.
-        idx indicates which model to load if multiple are given
-        """
-        train_args_fname = os.path.join(dirname, "training_args.json")
-        with open(train_args_fname, "r") as source:
-            train_args = json.load(source)
-        config = BertConfig.from_json_file(os.path.join(dirname, "config.json"))
-
-        if ft_is_angular is None:
-            ft_is_angular = FEATURE_SET_NAMES_TO_ANGULARITY[
-                train_args["angles_definitions"]
-            ]
-            logging.info(f"Auto constructed ft_is_angular: {ft_is_angular}")
-
-        # Handles the case where we repurpose the time encoding for seq len encoding in the AR model
-        time_encoding_key = (
-            "time_encoding" if "time_encoding" in train_args else "seq_len_encoding"
-        )
-        model_args = dict(
-            config=config,
-            ft_is_angular=ft_is_angular,
-            time_encoding=train_args[time_encoding_key],
-            decoder=train_args["decoder"],
-            # lr=train_args["lr"],
-            # loss=train_args["loss"],
-            # l2=train_args["l2_norm"],
-            # l1=train_args["l1_norm"],
-            # circle_reg=train_args["circle_reg"],
-            # lr_scheduler=train_args["lr_scheduler"],
-            **kwargs,
-        )
-
-        if load_weights:
-            epoch_getter = lambda x: int(
-                re.findall(r"epoch=[0-9]+", os.path.basename(x)).pop().split("=")[-1]
-            )
-            subfolder = f"best_by_{best_by}"
-            # Sort checkpoints by epoch -- last item is latest epoch
-            ckpt_names = sorted(
-                glob.glob(os.path.join(dirname, "models", subfolder, "*.ckpt")),
-                key=epoch_getter,
-            )
-            logging.info(f"Found {len(ckpt_names)} checkpoints")
-            ckpt_name = ckpt_names[idx]
-            logging.info(f"Loading weights from {ckpt_name}")
-            if hasattr(cls, "load_from_checkpoint"):
-                # Defined for pytorch lightning module
-                retval = cls.load_from_checkpoint(
-                    checkpoint_path=ckpt_name, **model_args
-                )
-            else:
-                retval = cls(**model_args)
-                loaded = torch.load(ckpt_name, map_location=torch.device("cpu"))
-                retval.load_state_dict(loaded["state_dict"])
-        else:
-            retval = cls(**model_args)
-            logging.info(f"Loaded unitialized model from {dirname}")
-
-        # If specified, copy out the requisite files to the given directory
-        if copy_to:
-            logging.info(f"Copying minimal model file set to: {copy_to}")
-            os.makedirs(copy_to, exist_ok=True)
-            copy_to = Path(copy_to)
-            with open(copy_to / "training_args.json", "w") as sink:
-                json.dump(train_args, sink)
-            config.save_pretrained(copy_to)
-            if load_weights:
-                # Create the direcotry structure
-                ckpt_dir = copy_to / "models" / subfolder
-                os.makedirs(ckpt_dir, exist_ok=True)
-                shutil.copyfile(ckpt_name, ckpt_dir / os.path.basename(ckpt_name))
-
-        return retval
-
-    def forward(
-        self,
-        inputs: torch.Tensor,
-        timestep: torch.Tensor,  # Tensor of shape batch_length with time indices
-        attention_mask: torch.Tensor,
-        position_ids: Optional[torch.Tensor] = None,
-        head_mask: Optional[torch.Tensor] = None,
-        output_attentions: Optional[bool] = None,
-        output_hidden_states: Optional[bool] = None,
-        return_dict: Optional[bool] = None,
-    ):
-        r"""
-        encoder_hidden_states  (`torch.FloatTensor` of shape `(batch_size, sequence_length, hidden_size)`, *optional*):
-            Sequence of hidden-states at the output of the last layer of the encoder. Used in the cross-attention if
-            the model is configured as a decoder.
-        encoder_attention_mask (`torch.FloatTensor` of shape `(batch_size, sequence_length)`, *optional*):
-            Mask to avoid performing attention on the padding token indices of the encoder input. This mask is used in
-            the cross-attention if the model is configured as a decoder. Mask values selected in `[0, 1]`:
-            - 1 for tokens that are **not masked**,
-            - 0 for tokens that are **masked**.
-        past_key_values (`tuple(tuple(torch.FloatTensor))` of length `config.n_layers` with each tuple having 4 tensors of shape `(batch_size, num_heads, sequence_length - 1, embed_size_per_head)`):
-            Contains precomputed key and value hidden states of the attention blocks. Can be used to speed up decoding.
-            If `past_key_values` are used, the user can optionally input only the last `decoder_input_ids` (those that
-            don't have their past key value states given to this model) of shape `(batch_size, 1)` instead of all
-            `decoder_input_ids` of shape `(batch_size, sequence_length)`.
-        use_cache (`bool`, *optional*):
-            If set to `True`, `past_key_values` key value states are returned and can be used to speed up decoding (see
-            `past_key_values`).
-        """
-        output_attentions = (
-            output_attentions
-            if output_attentions is not None
-            else self.config.output_attentions
-        )
-        output_hidden_states = (
-            output_hidden_states
-            if output_hidden_states is not None
-            else self.config.output_hidden_states
-        )
-        return_dict = (
-            return_dict if return_dict is not None else self.config.use_return_dict
-        )
 
-        input_shape = inputs.size()
-        batch_size, seq_length, *_ = input_shape
-        logging.debug(f"Detected batch {batch_size} and seq length {seq_length}")
-
-        assert attention_mask is not None
-
-        # If position IDs are not given, auto-generate them
-        if position_ids is None:
-            # [1, seq_length]
-            position_ids = (
-                torch.arange(
-                    seq_length,
-                )
-                .expand(batch_size, -1)
-                .type_as(timestep)
-            )
-
-        # We can provide a self-attention mask of dimensions [batch_size, from_seq_length, to_seq_length]
-        # ourselves in which case we just need to make it broadcastable to all heads. This code is taken
-        # from hugggingface modeling_utils
-        assert (
-            attention_mask.dim() == 2
-        ), f"Attention mask expected in shape (batch_size, seq_length), got {attention_mask.shape}"
-        extended_attention_mask = attention_mask[:, None, None, :]
-        extended_attention_mask = extended_attention_mask.type_as(attention_mask)
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
-
-        # Prepare head mask if needed
-        # 1.0 in head_mask indicate we keep the head
-        # attention_probs has shape bsz x n_heads x N x N
-        # input head_mask has shape [num_heads] or [num_hidden_layers x num_heads]
-        # and head_mask is converted to shape [num_hidden_layers x batch x num_heads x seq_length x seq_length]
-        # msk = torch.ones(size=(self.config.num_attention_heads,))
-        # msk = msk.type_as(inputs)
-        # head_mask = self.get_head_mask(msk, self.config.num_hidden_layers)
-
-        assert len(inputs.shape) == 3  # batch_size, seq_length, features
-        inputs_upscaled = self.inputs_to_hidden_dim(inputs)  # Batch * seq_len * dim
-
-        # Pass through embeddings
-        inputs_upscaled = self.embeddings(inputs_upscaled, position_ids=position_ids)
-
-        # timestep is (batch, 1), squeeze to (batch,)
-        # embedding gets to (batch, embed_dim) -> unsqueee to (batch, 1, dim)
-        time_encoded = self.time_embed(timestep.squeeze(dim=-1)).unsqueeze(1)
-        inputs_with_time = inputs_upscaled + time_encoded
-        encoder_outputs = self.encoder(
-            inputs_with_time,
-            attention_mask=extended_attention_mask,
-            # head_mask=head_mask,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
 
-        sequence_output = encoder_outputs[0]
-        per_token_decoded = self.token_decoder(sequence_output)
-        return per_token_decoded
+def _accepts_arg(fn: Callable, arg: str) -> bool:
+    """Return whether the function, e.g. a loss, accepts the given argument"""
+    fn_args = inspect.getfullargspec(fn)
+    return arg in fn_args.args or arg in fn_args.kwonlyargs
 
 
 class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
@@ -501,6 +57,8 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
         steps_per_epoch: int = 250,  # Dummy value
         lr_scheduler: LR_SCHEDULE = None,
         write_preds_to_dir: Optional[str] = None,
+        batch_noiser: Optional[Callable[[Dict], Dict]] = None,
+        valid_timestep_batches: Optional[Callable[[Dict], Iterator]] = None,
         **kwargs,
     ):
         """Feed args to BertForDiffusionBase and then feed the rest into"""
@@ -540,9 +98,44 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
         self.l1_lambda = l1
         self.l2_lambda = l2
         self.circle_lambda = circle_reg
+        # Resolve once which losses accept circle_penalty, rather than every step
+        # https://stackoverflow.com/questions/23228664/how-to-check-which-arguments-a-function-method-takes
+        loss_fns = (
+            self.loss_func
+            if isinstance(self.loss_func, (tuple, list))
+            else [self.loss_func] * self.n_inputs
+        )
+        self._loss_kwargs = [
+            {"circle_penalty": self.circle_lambda}
+            if _accepts_arg(loss_fn, "circle_penalty")
+            else {}
+            for loss_fn in loss_fns
+        ]
+        # Built in losses are computed for all features at once, in one masked pass
+        self.register_buffer("_loss_is_angular", None, persistent=False)
+        self.register_buffer("_loss_beta", None, persistent=False)
+        self.register_buffer("_loss_circle_penalty", None, persistent=False)
+        if isinstance(loss, str):
+            self._loss_is_angular = torch.tensor(self.ft_is_angular)
+            self._loss_beta = torch.tensor(
+                [
+                    self.fused_loss_betas_dict[loss][0 if is_angular else 1]
+                    for is_angular in self.ft_is_angular
+                ]
+            )
+            if self.circle_lambda > 0:
+                self._loss_circle_penalty = torch.tensor(
+                    [kwargs.get("circle_penalty", 0.0) for kwargs in self._loss_kwargs]
+                )
         self.epochs = epochs
         self.steps_per_epoch = steps_per_epoch
         self.lr_scheduler = lr_scheduler
+        # Noises clean batches on device, e.g. NoisedAnglesDataset.noise_batch
+        self.batch_noiser = batch_noiser
+        # Expands clean validation batches across all timesteps, e.g.
+        # NoisedAnglesDataset.iter_timestep_batches, to validate at every timestep
+        self.valid_timestep_batches = valid_timestep_batches
+        self._valid_loss_by_t = {}
 
         # Set up the output directory for writing predictions
         self.write_preds_to_dir = write_preds_to_dir
@@ -551,19 +144,24 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
             os.makedirs(self.write_preds_to_dir, exist_ok=True)
 
     def _get_loss_terms(
-        self, batch, write_preds: Optional[str] = None
+        self,
+        batch,
+        write_preds: Optional[str] = None,
+        predicted_noise: Optional[torch.Tensor] = None,
     ) -> List[torch.Tensor]:
         """
         Returns the loss terms for the model. Length of the returned list
-        is equivalent to the number of features we are fitting to.
+        is equivalent to the number of features we are fitting to. If given
+        predicted_noise, uses that rather than running the model.
         """
         known_noise = batch["known_noise"]
-        predicted_noise = self.forward(
-            batch["corrupted"],
-            batch["t"],
-            attention_mask=batch["attn_mask"],
-            position_ids=batch["position_ids"],
-        )
+        if predicted_noise is None:
+            predicted_noise = self.forward(
+                batch["corrupted"],
+                batch["t"],
+                attention_mask=batch["attn_mask"],
+                position_ids=batch["position_ids"],
+            )
         assert (
             known_noise.shape == predicted_noise.shape
         ), f"{known_noise.shape} != {predicted_noise.shape}"
@@ -572,36 +170,36 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
         # attn_mask has shape (batch, seq_len) --> where gives back
         # two lists of values, one for each dimension
         # known_noise has shape (batch, seq_len, num_fts)
-        unmask_idx = torch.where(batch["attn_mask"])
-        assert len(unmask_idx) == 2
-        loss_terms = []
-        for i in range(known_noise.shape[-1]):
-            loss_fn = (
-                self.loss_func[i]
-                if isinstance(self.loss_func, list)
-                else self.loss_func
+        attn_mask = batch["attn_mask"]
+        if attn_mask.dim() == 3:
+            # Packed (batch, seq_len, seq_len) mask; real tokens attend to themselves
+            attn_mask = torch.diagonal(attn_mask, dim1=1, dim2=2)
+        if self._loss_beta is not None:
+            loss_terms = losses.feature_smooth_l1_loss(
+                predicted_noise,
+                known_noise,
+                attn_mask,
+                is_angular=self._loss_is_angular,
+                beta=self._loss_beta,
+                circle_penalty=self._loss_circle_penalty,
             )
-            logging.debug(f"Using loss function {loss_fn}")
-            # Determine whether the loss accepts circle_penalty
-            # https://stackoverflow.com/questions/23228664/how-to-check-which-arguments-a-function-method-takes
-            loss_args = inspect.getfullargspec(loss_fn)
-            if (
-                "circle_penalty" in loss_args.args
-                or "circle_penalty" in loss_args.kwonlyargs
-            ):
-                logging.debug(f"Loss function {loss_fn} accepts circle_penalty")
-                l = loss_fn(
-                    predicted_noise[unmask_idx[0], unmask_idx[1], i],
-                    known_noise[unmask_idx[0], unmask_idx[1], i],
-                    circle_penalty=self.circle_lambda,
+        else:
+            unmask_idx = torch.where(attn_mask)
+            assert len(unmask_idx) == 2
+            loss_terms = []
+            for i in range(known_noise.shape[-1]):
+                loss_fn = (
+                    self.loss_func[i]
+                    if isinstance(self.loss_func, (tuple, list))
+                    else self.loss_func
                 )
-            else:
-                logging.debug(f"Loss function {loss_fn} does not accept circle_penalty")
                 l = loss_fn(
                     predicted_noise[unmask_idx[0], unmask_idx[1], i],
                     known_noise[unmask_idx[0], unmask_idx[1], i],
+                    **self._loss_kwargs[i],
                 )
-            loss_terms.append(l)
+                loss_terms.append(l)
+            loss_terms = torch.stack(loss_terms)
 
         if write_preds is not None:
             with open(write_preds, "w") as f:
@@ -609,7 +207,7 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
                     "known_noise": known_noise.cpu().numpy().tolist(),
                     "predicted_noise": predicted_noise.cpu().numpy().tolist(),
                     "attn_mask": batch["attn_mask"].cpu().numpy().tolist(),
-                    "losses": [l.item() for l in loss_terms],
+                    "losses": loss_terms.tolist(),
                 }
                 json.dump(d_to_write, f)
 
@@ -618,6 +216,9 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
             or self.use_pairwise_dist_loss > 0
         ):
             # Compute the pairwise distance loss
+            assert (
+                batch["attn_mask"].dim() == 2
+            ), "Pairwise distance loss is not supported for packed sequences"
             bs = batch["sqrt_one_minus_alphas_cumprod_t"].shape[0]
             # The alpha* have shape of [batch], e.g. [32]
             # corrupted have shape of [batch, seq_len, num_angles], e.g. [32, 128, 6]
@@ -674,9 +275,17 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
                 lengths=batch["lengths"],
                 weights=coef,
             )
-            loss_terms.append(pdist_loss)
+            loss_terms = torch.cat([loss_terms, pdist_loss.view(1)])
+
+        return loss_terms
 
-        return torch.stack(loss_terms)
+    def on_after_batch_transfer(self, batch, dataloader_idx: int):
+        """Noise batches of clean items on device if given a batch noiser"""
+        if self.batch_noiser is not None and "corrupted" not in batch:
+            # Clean validation batches are instead expanded across all timesteps
+            if self.training or self.valid_timestep_batches is None:
+                batch = self.batch_noiser(batch)
+        return batch
 
     def training_step(self, batch, batch_idx):
         """
@@ -721,6 +330,8 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
         """
         Validation step
         """
+        if self.valid_timestep_batches is not None and "corrupted" not in batch:
+            return self._exhaustive_validation_step(batch)
         with torch.no_grad():
             loss_terms = self._get_loss_terms(
                 batch,
@@ -750,6 +361,100 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
 
         return {"val_loss": avg_loss}
 
+    def _exhaustive_validation_step(self, batch) -> Dict[str, torch.Tensor]:
+        """
+        Validate a batch of clean items at every timestep, running the model on
+        many timesteps at once, and accumulate the loss at each timestep
+        """
+        bs = batch["attn_mask"].shape[0]
+        all_loss_terms = []
+        with torch.no_grad():
+            for timesteps, chunk in self.valid_timestep_batches(batch):
+                predicted_noise = self.forward(
+                    chunk["corrupted"],
+                    chunk["t"],
+                    attention_mask=chunk["attn_mask"],
+                    position_ids=chunk["position_ids"],
+                )
+                # Chunks are ordered by timestep, then item
+                for i, t in enumerate(timesteps):
+                    idx = slice(i * bs, (i + 1) * bs)
+                    loss_terms = self._get_loss_terms(
+                        {k: v[idx] for k, v in chunk.items()},
+                        predicted_noise=predicted_noise[idx],
+                    )
+                    if t in self._valid_loss_by_t:
+                        self._valid_loss_by_t[t][0] += loss_terms
+                        self._valid_loss_by_t[t][1] += 1
+                    else:
+                        self._valid_loss_by_t[t] = [loss_terms, 1]
+                    all_loss_terms.append(loss_terms)
+        loss_terms = torch.stack(all_loss_terms).mean(dim=0)
+        avg_loss = torch.mean(loss_terms)
+
+        pseudo_ft_names = (
+            (self.ft_names + ["pairwise_dist_loss"])
+            if self.use_pairwise_dist_loss
+            else self.ft_names
+        )
+        loss_dict = {
+            f"val_loss_{val_name}": self.all_gather(val)
+            for val_name, val in zip(pseudo_ft_names, loss_terms)
+        }
+        loss_dict["val_loss"] = avg_loss
+        self.log_dict(loss_dict, rank_zero_only=True)
+        return {"val_loss": avg_loss}
+
+    def _log_valid_loss_by_t(self, n_bins: int = 10) -> None:
+        """
+        Log the validation loss averaged over bins of timesteps, and append the
+        loss at each timestep to a csv in the log directory. Resets the loss.
+        """
+        timesteps = sorted(self._valid_loss_by_t.keys())
+        losses_by_t = torch.stack(
+            [
+                self._valid_loss_by_t[t][0] / self._valid_loss_by_t[t][1]
+                for t in timesteps
+            ]
+        )
+        self._valid_loss_by_t = {}
+        if self.trainer.sanity_checking:
+            return
+        # Average across replicas
+        losses_by_t = self.all_gather(losses_by_t)
+        losses_by_t = losses_by_t.reshape(-1, *losses_by_t.shape[-2:]).mean(dim=0)
+        mean_by_t = losses_by_t.mean(dim=1)
+
+        bin_size = math.ceil(len(timesteps) / n_bins)
+        for start in range(0, len(timesteps), bin_size):
+            end = min(start + bin_size, len(timesteps))
+            self.log(
+                f"val_loss_t{timesteps[start]}-{timesteps[end - 1]}",
+                mean_by_t[start:end].mean(),
+                rank_zero_only=True,
+            )
+
+        log_dir = self.trainer.log_dir
+        if log_dir is not None and self.trainer.is_global_zero:
+            pseudo_ft_names = (
+                (self.ft_names + ["pairwise_dist_loss"])
+                if self.use_pairwise_dist_loss
+                else self.ft_names
+            )
+            fname = os.path.join(log_dir, "val_loss_by_timestep.csv")
+            write_header = not os.path.isfile(fname)
+            os.makedirs(log_dir, exist_ok=True)
+            with open(fname, "a") as sink:
+                if write_header:
+                    header = ["epoch", "t", "val_loss"]
+                    header += [f"val_loss_{n}" for n in pseudo_ft_names]
+                    sink.write(",".join(header) + "\n")
+                for t, l, terms in zip(
+                    timesteps, mean_by_t.tolist(), losses_by_t.tolist()
+                ):
+                    row = [self.train_epoch_counter, t, l] + terms
+                    sink.write(",".join(str(x) for x in row) + "\n")
+
     def validation_epoch_end(self, outputs) -> None:
         """Log the average validation loss over the epoch"""
         # Note that this method is called before zstraining_epoch_end().
@@ -758,6 +463,8 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
         pl.utilities.rank_zero_info(
             f"Valid loss at epoch {self.train_epoch_counter} end: {mean_loss:.4f}"
         )
+        if self._valid_loss_by_t:
+            self._log_valid_loss_by_t()
 
     def configure_optimizers(self) -> Dict[str, Any]:
         """
@@ -804,95 +511,6 @@ class BertForDiffusion(BertForDiffusionBase, pl.LightningModule):
         return retval
 
 
-class BertForAutoregressiveBase(BertForDiffusionBase):
-    """
-    Overrides the previous model's forward function to not handle noise or timesteps
-    """
-
-    def forward(
-        self,
-        inputs: torch.Tensor,
-        attention_mask: torch.Tensor,
-        seq_lengths: torch.Tensor,
-        position_ids: Optional[torch.Tensor] = None,
-        output_attentions: Optional[bool] = None,
-        output_hidden_states: Optional[bool] = None,
-        return_dict: Optional[bool] = None,
-    ):
-        assert len(inputs.shape) == 3  # batch_size, seq_length, features
-        inputs_upscaled = self.inputs_to_hidden_dim(inputs)  # Batch * seq_len * dim
-
-        # Embed the lengths - note that we are reusing the time embedding here
-        # Shape (batch, embed) -> (batch, 1, embed)
-        len_embed = self.time_embed(seq_lengths).unsqueeze(1)
-        inputs_upscaled += len_embed
-
-        if position_ids is None:
-            batch_size, seq_length, *_ = inputs.size()
-            # Shape (batch, seq_len)
-            position_ids = (
-                torch.arange(
-                    seq_length,
-                )
-                .expand(batch_size, -1)
-                .to(inputs.device)
-            )
-
-        # We can provide a self-attention mask of dimensions [batch_size, from_seq_length, to_seq_length]
-        # ourselves in which case we just need to make it broadcastable to all heads. This code is taken
-        # from hugggingface modeling_utils
-        assert (
-            attention_mask.dim() == 2
-        ), f"Attention mask expected in shape (batch_size, seq_length), got {attention_mask.shape}"
-        extended_attention_mask = attention_mask[:, None, None, :]
-        extended_attention_mask = extended_attention_mask.type_as(attention_mask)
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
-
-        inputs_upscaled = self.embeddings(inputs_upscaled, position_ids=position_ids)
-        encoder_outputs = self.encoder(
-            inputs_upscaled,
-            attention_mask=extended_attention_mask,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
-
-        sequence_output = encoder_outputs[0]
-        per_token_decoded = self.token_decoder(sequence_output)
-        return per_token_decoded
-
-    @torch.no_grad()
-    def sample(
-        self,
-        seed_angles: torch.Tensor,
-        seq_lengths: torch.Tensor,
-        num_seed: int = 2,
-        pbar: bool = True,
-    ) -> List[torch.Tensor]:
-        """
-        Sample a set of angles of seq_lengths given a series of seed angles
-        seed_angles should be given as a tensor of (batch, seq_len, num_angles)
-        The first num_seed angles are taken as fixed and the rest are autoregressively
-        generated
-        """
-        assert torch.all(seed_angles[:, :num_seed, :] <= torch.pi)
-        assert torch.all(seed_angles[:, :num_seed, :] >= -torch.pi)
-        retval = seed_angles.clone().to(seed_angles.device)
-        assert seed_angles.ndim == 3
-
-        attention_mask = torch.zeros(seed_angles.shape[:2]).to(seed_angles.device)
-        for i in tqdm(range(num_seed, torch.max(seq_lengths).item()), disable=not pbar):
-            attention_mask[:, :i] = 1.0
-            assert torch.all(attention_mask.sum(axis=1) == i)
-            next_angle = self.forward(
-                retval,
-                attention_mask=attention_mask,
-                seq_lengths=seq_lengths,
-            )[:, i, :]
-            retval[:, i, :] = next_angle
-        return [retval[i, :l, :] for i, l in enumerate(seq_lengths)]
-
-
 class BertForAutoregressive(BertForAutoregressiveBase, pl.LightningModule):
     """
     Wraps model in a pl.LightningModule for easy training as an
@@ -910,7 +528,7 @@ class BertForAutoregressive(BertForAutoregressiveBase, pl.LightningModule):
         steps_per_epoch: int = 250,  # Dummy value
         **kwargs,
     ):
-        BertForDiffusionBase.__init__(self, **kwargs)
+        BertForAutoregressiveBase.__init__(self, **kwargs)
         self.learning_rate = lr
         self.lr_scheduler = lr_scheduler
         self.l2_lambda = l2
@@ -922,6 +540,18 @@ class BertForAutoregressive(BertForAutoregressiveBase, pl.LightningModule):
         """
         Get the loss terms for a batch
         """
+        if "causal_target_mask" in batch:
+            # Teacher forced targets at every position, averaged over the positions
+            assert self.causal, "All positions targets require a causal model"
+            preds = self.forward(
+                batch["angles"],
+                attention_mask=batch["attn_mask"],
+                seq_lengths=batch["lengths"],
+                position_ids=batch["position_ids"],
+            )
+            target_idx = torch.where(batch["causal_target_mask"])
+            return self.loss(preds[target_idx], batch["causal_target"][target_idx])
+
         # Get the predictions
         preds = self.forward(
             batch["angles"],
@@ -0,0 +1,202 @@
+"""
+Sampling from a denoiser exported to ONNX by bin/export_onnx.py, run with
+onnxruntime. Mirrors the sampling loop in sampling.py, but only needs numpy
+and onnxruntime, so torch, transformers, and pytorch lightning do not need to
+be installed to sample.
+"""
+import os
+import json
+import logging
+from typing import *
+
+from tqdm.auto import tqdm
+
+import numpy as np
+
+from foldingdiff import utils
+
+ONNX_FNAME = "denoiser.onnx"
+SAMPLING_CONFIG_FNAME = "sampling_config.json"
+
+# Inputs and outputs of the exported denoiser
+INPUT_NAMES = ["inputs", "timestep", "attention_mask"]
+OUTPUT_NAMES = ["predicted_noise"]
+# Schedule terms from beta_schedules.compute_alphas used by sampling
+SCHEDULE_KEYS = [
+    "betas",
+    "alphas",
+    "sqrt_one_minus_alphas_cumprod",
+    "posterior_variance",
+]
+
+# Called with inputs (batch, seq_len, n_fts), timestep (batch, 1), and attention
+# mask (batch, seq_len), returns the predicted noise (batch, seq_len, n_fts)
+Denoiser = Callable[[np.ndarray, np.ndarray, np.ndarray], np.ndarray]
+
+
+class OnnxDenoiser:
+    """
+    Runs the exported denoiser with an onnxruntime session on CPU
+    """
+
+    def __init__(self, fname: str, num_threads: Optional[int] = None) -> None:
+        import onnxruntime as ort
+
+        opts = ort.SessionOptions()
+        if num_threads is not None:
+            opts.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            fname, sess_options=opts, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(
+        self, inputs: np.ndarray, timestep: np.ndarray, attention_mask: np.ndarray
+    ) -> np.ndarray:
+        feeds = {
+            "inputs": inputs.astype(np.float32),
+            "timestep": timestep.astype(np.int64),
+            "attention_mask": attention_mask.astype(np.float32),
+        }
+        return self.session.run(OUTPUT_NAMES, feeds)[0]
+
+
+def p_sample(
+    denoiser: Denoiser,
+    x: np.ndarray,
+    t_index: int,
+    seq_lens: Sequence[int],
+    schedule: Dict[str, np.ndarray],
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """
+    Sample the given timestep, as sampling.p_sample
+    """
+    attn_mask = np.zeros(x.shape[:2], dtype=np.float32)
+    for i, length in enumerate(seq_lens):
+        attn_mask[i, :length] = 1.0
+    t = np.full((x.shape[0], 1), t_index, dtype=np.int64)
+
+    model_mean = (
+        x
+        - schedule["betas"][t_index]
+        * denoiser(x, t, attn_mask)
+        / schedule["sqrt_one_minus_alphas_cumprod"][t_index]
+    ) / np.sqrt(schedule["alphas"][t_index])
+    if t_index == 0:
+        return model_mean
+    noise = rng.standard_normal(x.shape, dtype=np.float32)
+    return model_mean + np.sqrt(schedule["posterior_variance"][t_index]) * noise
+
+
+def p_sample_loop(
+    denoiser: Denoiser,
+    lengths: Sequence[int],
+    noise: np.ndarray,
+    schedule: Dict[str, np.ndarray],
+    is_angle: Sequence[bool],
+    rng: np.random.Generator,
+    disable_pbar: bool = False,
+) -> np.ndarray:
+    """
+    Returns an array of shape (timesteps, batch_size, seq_len, n_ft), as
+    sampling.p_sample_loop
+    """
+    angular_idx = np.where(is_angle)[0]
+    img = noise.astype(np.float32)
+    imgs = []
+    timesteps = len(schedule["betas"])
+    for i in tqdm(
+        reversed(range(0, timesteps)),
+        desc="sampling loop time step",
+        total=timesteps,
+        disable=disable_pbar,
+    ):
+        img = p_sample(denoiser, img, i, lengths, schedule, rng).astype(np.float32)
+        img[..., angular_idx] = utils.modulo_with_wrapped_range(
+            img[..., angular_idx], range_min=-np.pi, range_max=np.pi
+        )
+        imgs.append(img)
+    return np.stack(imgs)
+
+
+class OnnxSampler:
+    """
+    Samples from a directory written by bin/export_onnx.py, containing the
+    denoiser and the schedule and features it was trained with
+    """
+
+    def __init__(self, dirname: str, num_threads: Optional[int] = None) -> None:
+        with open(os.path.join(dirname, SAMPLING_CONFIG_FNAME)) as source:
+            config = json.load(source)
+        self.denoiser = OnnxDenoiser(
+            os.path.join(dirname, ONNX_FNAME), num_threads=num_threads
+        )
+        self.feature_names: List[str] = config["feature_names"]
+        self.feature_is_angular: List[bool] = config["feature_is_angular"]
+        self.pad: int = config["pad"]
+        self.variance_scales = np.array(config["variance_scales"], dtype=np.float32)
+        self.mean_offset = (
+            None
+            if config["mean_offset"] is None
+            else np.array(config["mean_offset"], dtype=np.float32)
+        )
+        self.schedule = {
+            k: np.array(config["schedule"][k], dtype=np.float32)
+            for k in SCHEDULE_KEYS
+        }
+        self.timesteps = len(self.schedule["betas"])
+
+    def sample_noise(
+        self, shape: Tuple[int, ...], rng: np.random.Generator
+    ) -> np.ndarray:
+        """Sample starting noise, as NoisedAnglesDataset.sample_noise"""
+        noise = rng.standard_normal(shape, dtype=np.float32) * self.variance_scales
+        angular_idx = np.where(self.feature_is_angular)[0]
+        noise[..., angular_idx] = utils.modulo_with_wrapped_range(
+            noise[..., angular_idx], -np.pi, np.pi
+        )
+        return noise
+
+    def sample(
+        self,
+        n: int = 10,
+        sweep_lengths: Tuple[int, int] = (50, 128),
+        batch_size: int = 512,
+        seed: Optional[int] = None,
+        disable_pbar: bool = False,
+    ) -> List[np.ndarray]:
+        """
+        Sample n items at each length in the sweep range, as sampling.sample.
+        Returns a list of arrays, shape (timesteps, seq_len, fts).
+        """
+        sweep_min, sweep_max = sweep_lengths
+        if not sweep_min < sweep_max <= self.pad:
+            raise ValueError(f"Invalid length range {sweep_lengths} for {self.pad}")
+        lengths = [l for l in range(sweep_min, sweep_max) for _ in range(n)]
+        rng = np.random.default_rng(seed)
+
+        logging.info(f"Sampling {len(lengths)} items in batches of size {batch_size}")
+        retval = []
+        for this_lengths in utils.seq_to_groups(lengths, batch_size):
+            noise = self.sample_noise(
+                (len(this_lengths), max(this_lengths), len(self.feature_names)), rng
+            )
+            sampled = p_sample_loop(
+                self.denoiser,
+                lengths=this_lengths,
+                noise=noise,
+                schedule=self.schedule,
+                is_angle=self.feature_is_angular,
+                rng=rng,
+                disable_pbar=disable_pbar,
+            )
+            retval.extend(sampled[:, i, :l, :] for i, l in enumerate(this_lengths))
+
+        if self.mean_offset is not None:
+            angular_idx = np.where(self.feature_is_angular)[0]
+            retval = [s + self.mean_offset for s in retval]
+            for s in retval:
+                s[..., angular_idx] = utils.modulo_with_wrapped_range(
+                    s[..., angular_idx], range_min=-np.pi, range_max=np.pi
+                )
+        return retval
@@ -90,6 +90,46 @@ def plot_val_dists_at_t(
     return fig
 
 
+def plot_hists_at_t(
+    t: int,
+    edges: np.ndarray,
+    counts: np.ndarray,
+    ft_names: Sequence[str],
+    share_axes: bool = True,
+    zero_center_angles: bool = False,
+    fname: Optional[str] = None,
+):
+    """
+    Plot precomputed histograms of values at timestep t, as plot_val_dists_at_t
+    does from the raw values. edges is (n_features, nbins + 1) and counts is
+    (n_features, nbins), e.g. from custom_metrics.timestep_histograms
+    """
+    n_fts = len(ft_names)
+    assert edges.shape[0] == counts.shape[0] == n_fts
+
+    fig, axes = plt.subplots(
+        nrows=1,
+        ncols=n_fts,
+        sharex=share_axes,
+        sharey=share_axes,
+        dpi=300,
+        figsize=(2.6 * n_fts, 2.5),
+    )
+    for i, (ax, ft_name) in enumerate(zip(axes, ft_names)):
+        ax.stairs(counts[i], edges[i], fill=True, alpha=0.75)
+        if "dist" not in ft_name:
+            if zero_center_angles:
+                ax.axvline(np.pi, color="tab:orange")
+                ax.axvline(-np.pi, color="tab:orange")
+            else:
+                ax.axvline(0, color="tab:orange")
+                ax.axvline(2 * np.pi, color="tab:orange")
+        ax.set(title=f"Timestep {t} - {ft_name}")
+    if fname is not None:
+        fig.savefig(fname, bbox_inches="tight")
+    return fig
+
+
 def plot_losses(
     log_fname: str,
     out_fname: Optional[str] = None,
@@ -2,6 +2,7 @@
 Code for sampling from diffusion models
 """
 import json
+import math
 import os
 import multiprocessing as mp
 from pathlib import Path
@@ -16,14 +17,89 @@ import pandas as pd
 
 import torch
 from torch import nn
+from torch.nn import functional as F
 from torch.utils.data import default_collate
 from huggingface_hub import snapshot_download
 
 from foldingdiff import datasets as dsets
-from foldingdiff import beta_schedules, modelling, utils, sampling, tmalign
+from foldingdiff import beta_schedules, base_models, utils, sampling, tmalign
 from foldingdiff import angles_and_coords as ac
 
 
+class TracedDenoiser(nn.Module):
+    """
+    Inference wrapper for BertForDiffusionBase that runs the model as TorchScript
+    traced once for each shape bucket, saving the Python overhead of each call
+    in the sampling loop. Buckets are keyed by batch size and the sequence length
+    rounded up to a multiple of length_multiple; inputs are padded to the bucket
+    length and outputs trimmed back. Padding costs compute, so lengths are only
+    rounded if asked, e.g. for callers with many distinct lengths. Calls that
+    cannot be traced, e.g. in training, with grad, with 3D attention masks,
+    with per token timesteps, or with an unpadding encoder, and buckets that
+    fail to trace fall back to the eager model.
+    """
+
+    def __init__(
+        self, model: base_models.BertForDiffusionBase, length_multiple: int = 1
+    ) -> None:
+        super().__init__()
+        self.model = model
+        self.n_inputs = model.n_inputs
+        self.length_multiple = length_multiple
+        # Traced models by bucket, None for buckets that failed to trace
+        self._traced: Dict[
+            Tuple[int, int, Tuple[int, ...]], Optional[torch.jit.ScriptModule]
+        ] = {}
+
+    def _bucket_length(self, seq_length: int) -> int:
+        """Length to pad sequences of the given length to"""
+        padded = math.ceil(seq_length / self.length_multiple) * self.length_multiple
+        return max(seq_length, min(padded, self.model.config.max_position_embeddings))
+
+    def _trace(
+        self, inputs: torch.Tensor, timestep: torch.Tensor, attention_mask: torch.Tensor
+    ) -> Optional[torch.jit.ScriptModule]:
+        """Trace the model for the shapes of the given inputs"""
+        logging.info(f"Tracing denoiser for inputs {inputs.shape}")
+        try:
+            return torch.jit.trace(
+                self.model, (inputs, timestep, attention_mask), check_trace=False
+            )
+        except Exception as e:
+            logging.warning(f"Falling back to eager for inputs {inputs.shape}: {e}")
+            return None
+
+    def forward(
+        self, inputs: torch.Tensor, timestep: torch.Tensor, attention_mask: torch.Tensor
+    ) -> torch.Tensor:
+        if (
+            self.model.training
+            or torch.is_grad_enabled()
+            or attention_mask.dim() != 2
+            or (timestep.dim() == 2 and timestep.shape[1] > 1)
+            or getattr(self.model.encoder, "unpad", False)
+        ):
+            return self.model(inputs, timestep, attention_mask)
+
+        batch_size, seq_length = inputs.shape[:2]
+        padded_length = self._bucket_length(seq_length)
+        pad = padded_length - seq_length
+        if pad:
+            inputs = F.pad(inputs, (0, 0, 0, pad))
+            attention_mask = F.pad(attention_mask, (0, pad))
+
+        # The traced graph is specific to the timestep shape, (batch,) or (batch, 1)
+        key = (batch_size, padded_length, tuple(timestep.shape[1:]))
+        if key not in self._traced:
+            self._traced[key] = self._trace(inputs, timestep, attention_mask)
+        traced = self._traced[key]
+        if traced is None:
+            out = self.model(inputs, timestep, attention_mask)
+        else:
+            out = traced(inputs, timestep, attention_mask)
+        return out[:, :seq_length]
+
+
 @torch.no_grad()
 def p_sample(
     model: nn.Module,
@@ -141,11 +217,13 @@ def sample(
     feature_key: str = "angles",
     disable_pbar: bool = False,
     trim_to_length: bool = True,  # Trim padding regions to reduce memory
+    trace: bool = False,
 ) -> List[np.ndarray]:
     """
     Sample from the given model. Use the train_dset to generate noise to sample
     sequence lengths. Returns a list of arrays, shape (timesteps, seq_len, fts).
-    If sweep_lengths is set, we generate n items per length in the sweep range
+    If sweep_lengths is set, we generate n items per length in the sweep range.
+    If trace, the model is run as a TracedDenoiser.
 
     train_dset object must support:
     - sample_noise - provided by NoisedAnglesDataset
@@ -174,6 +252,9 @@ def sample(
         lengths[i : i + batch_size] for i in range(0, len(lengths), batch_size)
     ]
 
+    if trace and not isinstance(model, TracedDenoiser):
+        model = TracedDenoiser(model)
+
     logging.info(f"Sampling {len(lengths)} items in batches of size {batch_size}")
     retval = []
     for this_lengths in lengths_chunkified:
@@ -225,7 +306,10 @@ def sample(
 
 
 def sample_simple(
-    model_dir: str, n: int = 10, sweep_lengths: Tuple[int, int] = (50, 128)
+    model_dir: str,
+    n: int = 10,
+    sweep_lengths: Tuple[int, int] = (50, 128),
+    trace: bool = False,
 ) -> List[pd.DataFrame]:
     """
     Simple wrapper on sample to automatically load in the model and dummy dataset
@@ -238,7 +322,7 @@ def sample_simple(
     with open(os.path.join(model_dir, "training_args.json")) as source:
         training_args = json.load(source)
 
-    model = modelling.BertForDiffusionBase.from_dir(model_dir)
+    model = base_models.BertForDiffusionBase.from_dir(model_dir)
     if torch.cuda.is_available():
         model = model.to("cuda:0")
 
@@ -254,7 +338,12 @@ def sample_simple(
     )
 
     sampled = sample(
-        model, dummy_noised_dset, n=n, sweep_lengths=sweep_lengths, disable_pbar=True
+        model,
+        dummy_noised_dset,
+        n=n,
+        sweep_lengths=sweep_lengths,
+        disable_pbar=True,
+        trace=trace,
     )
     final_sampled = [s[-1] for s in sampled]
     sampled_dfs = [
@@ -137,6 +137,15 @@ def update_dict_nonnull(d: Dict[str, Any], vals: Dict[str, Any]) -> Dict[str, An
     return d
 
 
+def md5_file(fname: str) -> str:
+    """Create a md5 sum of the contents of the given file"""
+    hash_md5 = hashlib.md5()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
 def md5_all_py_files(dirname: str) -> str:
     """Create a single md5 sum for all given files"""
     # https://stackoverflow.com/questions/36099331/how-to-grab-all-files-in-a-folder-and-get-their-md5-hash-in-python
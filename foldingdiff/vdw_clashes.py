@@ -11,7 +11,6 @@ Useful references:
 Usage:
 python vdw_clashes.py <pdb file1> <pdb file2> ...
 """
-import warnings
 from typing import Collection, Dict
 import multiprocessing as mp
 
@@ -21,8 +20,7 @@ from tqdm.auto import tqdm
 
 from scipy.spatial.distance import pdist, squareform
 
-from biotite.structure.io.pdb import PDBFile
-from biotite import structure as struct
+from foldingdiff.angles_and_coords import read_backbone, backbone_atom_array
 
 # Van der waals in Angstroms
 VDW_RADII = {
@@ -34,12 +32,8 @@ VDW_RADII = {
 def count_clashes(fname: str, alpha: float = 0.63) -> int:
     """Counts the number of clashes in a PDB file."""
 
-    # Read in the PDB file
-    pdb_file = PDBFile.read(fname)
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        atoms = pdb_file.get_structure()[0]
-    atoms = atoms[struct.filter_backbone(atoms)]
+    # Read in the backbone atoms of the first model of the PDB file
+    atoms = backbone_atom_array(read_backbone(fname))
 
     # Compute pairwise distances
     pairwise_distances = squareform(pdist(atoms.coord))
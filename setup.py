@@ -18,6 +18,7 @@ setup(
         "torch",
         "scipy",
         "transformers",
+        "safetensors",
         "pytorch-lightning",
         "huggingface-hub",
         "seaborn",
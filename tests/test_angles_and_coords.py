@@ -1,8 +1,12 @@
 import os
+import glob
+import gzip
+import shutil
 import tempfile
 import unittest
 
 import numpy as np
+import biotite.structure as struc
 from biotite.structure.io.pdb import PDBFile
 
 from foldingdiff import angles_and_coords as ac
@@ -40,3 +44,94 @@ class TestAddingSidechains(unittest.TestCase):
             ref_coords = get_structure_coords(fname)
             test_coords = get_structure_coords(os.path.join(td, "out.pdb"))
             self.assertTrue(np.allclose(ref_coords, test_coords))
+
+
+class TestFeaturizeStructure(unittest.TestCase):
+    """
+    Test that the single pass featurization matches the separate extractors
+    """
+
+    def setUp(self) -> None:
+        self.fname = os.path.join(os.path.dirname(__file__), "../data/1CRN.pdb")
+
+    def test_matches_separate_extractors(self):
+        """Test that angles and coords match those from separate parses"""
+        feats = ac.featurize_structure(self.fname)
+        angles = ac.canonical_distances_and_dihedrals(
+            self.fname, distances=ac.EXHAUSTIVE_DISTS, angles=ac.EXHAUSTIVE_ANGLES
+        )
+        coords = ac.extract_backbone_coords(self.fname, ["CA"])
+        self.assertListEqual(list(feats["angles"].columns), list(angles.columns))
+        self.assertTrue(
+            np.allclose(feats["angles"].values, angles.values, equal_nan=True)
+        )
+        self.assertTrue(np.allclose(feats["coords"], coords))
+
+    def test_atom_array(self):
+        """Test that an already parsed AtomArray gives the same values"""
+        from_file = ac.featurize_structure(self.fname, coord_atoms=["N", "CA", "C"])
+        from_array = ac.featurize_structure(
+            ac.read_structure(self.fname), coord_atoms=["N", "CA", "C"]
+        )
+        self.assertTrue(
+            np.allclose(
+                from_file["angles"].values, from_array["angles"].values, equal_nan=True
+            )
+        )
+        self.assertTrue(np.allclose(from_file["coords"], from_array["coords"]))
+
+
+class TestReadBackbone(unittest.TestCase):
+    """
+    Test that the streaming backbone reader matches parsing with biotite
+    """
+
+    def setUp(self) -> None:
+        self.fnames = sorted(
+            glob.glob(os.path.join(os.path.dirname(__file__), "../data/*.pdb"))
+        )
+
+    def test_matches_biotite(self):
+        """Test that backbone atoms match those of the full structure"""
+        for fname in self.fnames:
+            chain = PDBFile.read(fname).get_structure()[0]
+            ref = chain[struc.filter_backbone(chain)]
+            backbone = ac.read_backbone(fname)
+            self.assertFalse(backbone.multi_model)
+            self.assertTrue(np.array_equal(backbone.coords, ref.coord), fname)
+            self.assertTrue(np.array_equal(backbone.atom_names, ref.atom_name))
+            self.assertTrue(np.array_equal(backbone.res_ids, ref.res_id))
+            self.assertTrue(np.array_equal(backbone.res_names, ref.res_name))
+            self.assertTrue(np.array_equal(backbone.chain_ids, ref.chain_id))
+
+    def test_gzip(self):
+        """Test that gzipped files give the same backbone"""
+        with tempfile.TemporaryDirectory() as td:
+            gz_fname = os.path.join(td, "1CRN.pdb.gz")
+            with open(self.fnames[0], "rb") as source:
+                with gzip.open(gz_fname, "wb") as sink:
+                    shutil.copyfileobj(source, sink)
+            self.assertTrue(
+                np.array_equal(
+                    ac.read_backbone(gz_fname).coords,
+                    ac.read_backbone(self.fnames[0]).coords,
+                )
+            )
+
+    def test_multi_model(self):
+        """Test that reading stops at, and flags, a second model"""
+        with open(self.fnames[0]) as source:
+            atoms = [l for l in source if l.startswith("ATOM")]
+        with tempfile.TemporaryDirectory() as td:
+            fname = os.path.join(td, "multi.pdb")
+            with open(fname, "w") as sink:
+                for i in range(2):
+                    sink.write(f"MODEL        {i + 1}\n")
+                    sink.writelines(atoms)
+                    sink.write("ENDMDL\n")
+            backbone = ac.read_backbone(fname)
+            self.assertTrue(backbone.multi_model)
+            self.assertEqual(
+                len(backbone.coords), 3 * ac.get_pdb_length(self.fnames[0])
+            )
+            self.assertIsNone(ac.canonical_distances_and_dihedrals(fname))
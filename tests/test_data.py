@@ -3,12 +3,43 @@ Unit tests to test data loaders. These primarily check that the data loaders ret
 with expected shapes and ranges.
 """
 
+import os
+import glob
+import time
+import pickle
+import shutil
+import tempfile
 import unittest
+from unittest import mock
+from multiprocessing.reduction import ForkingPickler
 
 import numpy as np
 import torch
+import torch.multiprocessing  # Registers reductions for shared tensors
+from torch.utils.data import default_collate
 
 from foldingdiff import datasets, utils
+from foldingdiff.angles_and_coords import featurize_structure
+from foldingdiff.feature_store import ShardWriter
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+
+
+class LocalPdbsTestCase(unittest.TestCase):
+    """
+    Base for tests on datasets of a temporary copy of the PDB files in DATA_DIR,
+    which are copied to self.pdb_dir under self.tempdir
+    """
+
+    def setUp(self) -> None:
+        self.tempdir = tempfile.mkdtemp()
+        self.pdb_dir = os.path.join(self.tempdir, "pdbs")
+        os.makedirs(self.pdb_dir)
+        for fname in glob.glob(os.path.join(DATA_DIR, "*.pdb")):
+            shutil.copy(fname, self.pdb_dir)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tempdir)
 
 
 class TestCathCanonical(unittest.TestCase):
@@ -52,6 +83,181 @@ class TestCathCanonical(unittest.TestCase):
         self.assertTrue(np.all(d["angles"].numpy()[..., angular_idx] <= np.pi))
 
 
+class TestLocalPdbCache(LocalPdbsTestCase):
+    """
+    Tests for caching featurized structures from a local directory of PDB files
+    """
+
+    def test_cache_matches_uncached(self):
+        """Test that a dataset loaded from cache matches a freshly computed one"""
+        kwargs = dict(pdbs=self.pdb_dir, pad=128, min_length=20)
+        ref = datasets.CathCanonicalAnglesDataset(use_cache=False, **kwargs)
+        # First call builds the cache, second call loads it
+        for _ in range(2):
+            cached = datasets.CathCanonicalAnglesDataset(
+                use_cache=True, cache_dir=self.tempdir, **kwargs
+            )
+            self.assertTrue(os.path.isdir(cached.cache_fname))
+            self.assertEqual(ref.filenames, cached.filenames)
+            self.assertTrue(np.allclose(ref.means, cached.means))
+            for i in range(len(ref)):
+                x, y = ref[i], cached[i]
+                for k in x.keys():
+                    self.assertTrue(torch.allclose(x[k], y[k]), f"Mismatch in {k}")
+
+    def test_incremental_featurization(self):
+        """Test that only new files are featurized when files are added"""
+        new_fname = os.path.join(self.pdb_dir, "1CRN_copy.pdb")
+        kwargs = dict(pdbs=self.pdb_dir, pad=128, min_length=20, cache_dir=self.tempdir)
+        dset = datasets.CathCanonicalAnglesDataset(**kwargs)
+        orig_len = len(dset.store)
+
+        # An identical file under a new name reuses the existing entry
+        shutil.copy(os.path.join(self.pdb_dir, "1CRN.pdb"), new_fname)
+        with mock.patch.object(
+            datasets.CathCanonicalAnglesDataset,
+            "_CathCanonicalAnglesDataset__compute_featurization",
+            side_effect=AssertionError("Should not featurize"),
+        ):
+            dset = datasets.CathCanonicalAnglesDataset(**kwargs)
+        self.assertEqual(len(dset.store), orig_len + 1)
+        self.assertIn(new_fname, dset.store.fnames)
+
+    def test_toy_reuses_cache(self):
+        """Test that toy datasets read from the cache built by the full dataset"""
+        kwargs = dict(pdbs=self.pdb_dir, pad=128, min_length=0, cache_dir=self.tempdir)
+        full = datasets.CathCanonicalAnglesDataset(**kwargs)
+        with mock.patch.object(
+            datasets.CathCanonicalAnglesDataset,
+            "_CathCanonicalAnglesDataset__compute_featurization",
+            side_effect=AssertionError("Should not featurize"),
+        ):
+            toy = datasets.CathCanonicalAnglesDataset(toy=2, **kwargs)
+        self.assertEqual(len(toy.store), 2)
+        for i in range(2):
+            j = full.store.fnames.index(toy.store.fnames[i])
+            self.assertTrue(
+                np.array_equal(
+                    toy.store.get_angles(i), full.store.get_angles(j), equal_nan=True
+                )
+            )
+        # Toy datasets do not replace the assembled cache of the full dataset
+        self.assertEqual(
+            len(datasets.FeatureStore.load(full.cache_fname)), len(full.store)
+        )
+
+    def test_failures_not_retried(self):
+        """Test that files that fail to featurize are recorded and not retried"""
+        with open(os.path.join(self.pdb_dir, "corrupt.pdb"), "w") as sink:
+            sink.write("not a pdb file\n")
+        kwargs = dict(pdbs=self.pdb_dir, pad=128, min_length=0, cache_dir=self.tempdir)
+        dset = datasets.CathCanonicalAnglesDataset(featurize_workers=1, **kwargs)
+        cache = datasets.FeaturizationCache(
+            os.path.join(self.tempdir, "featurization_cache"),
+            schema=datasets.featurization_schema(),
+        )
+        self.assertEqual(
+            [v["fname"] for v in cache.failures.values()],
+            [os.path.join(self.pdb_dir, "corrupt.pdb")],
+        )
+        # Touch a file so that the assembled store is not reused as is
+        shutil.copy(
+            os.path.join(self.pdb_dir, "1CRN.pdb"),
+            os.path.join(self.pdb_dir, "1CRN_copy.pdb"),
+        )
+        with mock.patch.object(
+            datasets.CathCanonicalAnglesDataset,
+            "_CathCanonicalAnglesDataset__compute_featurization",
+            side_effect=AssertionError("Should not featurize"),
+        ):
+            retried = datasets.CathCanonicalAnglesDataset(**kwargs)
+        self.assertEqual(len(retried.store), len(dset.store) + 1)
+
+    def test_timeout(self):
+        """Test that a file taking too long is given up on with an error"""
+        with mock.patch.object(
+            datasets, "featurize_structure", side_effect=lambda *a, **k: time.sleep(5)
+        ):
+            fname, s, error = datasets._featurize_file("slow.pdb", timeout=0.1)
+        self.assertEqual(fname, "slow.pdb")
+        self.assertIsNone(s)
+        self.assertIn("TimeoutError", error)
+
+
+class TestPrecomputedItems(LocalPdbsTestCase):
+    """
+    Tests that items precomputed at construction match per item processing
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.kwargs = dict(pdbs=self.pdb_dir, pad=128, min_length=20, use_cache=False)
+
+    def assert_items_equal(self, x, y):
+        """Assert that all items of the two datasets are equal"""
+        self.assertEqual(len(x), len(y))
+        for i in range(len(x)):
+            for k, v in x[i].items():
+                self.assertTrue(torch.equal(v, y[i][k]), f"Mismatch in {k}")
+
+    def test_matches_per_item(self):
+        """Test that precomputed items match those processed per item"""
+        for cls in [
+            datasets.CathCanonicalAnglesDataset,
+            datasets.CathCanonicalAnglesOnlyDataset,
+        ]:
+            self.assert_items_equal(
+                cls(precompute=True, **self.kwargs),
+                cls(precompute=False, **self.kwargs),
+            )
+
+    def test_feature_mean_var(self):
+        """Test that feature statistics from precomputed items match per item"""
+        x = datasets.CathCanonicalAnglesOnlyDataset(precompute=True, **self.kwargs)
+        y = datasets.CathCanonicalAnglesOnlyDataset(precompute=False, **self.kwargs)
+        for ft in x.feature_names["angles"]:
+            for a, b in zip(x.get_feature_mean_var(ft), y.get_feature_mean_var(ft)):
+                self.assertAlmostEqual(a.item(), b.item(), places=5)
+
+    def test_set_means(self):
+        """Test that setting the means recomputes the items"""
+        x = datasets.CathCanonicalAnglesOnlyDataset(precompute=True, **self.kwargs)
+        y = datasets.CathCanonicalAnglesOnlyDataset(precompute=False, **self.kwargs)
+        means = np.linspace(-1, 1, num=len(x.feature_idx))
+        x.set_masked_means(means)
+        y.set_masked_means(means)
+        self.assertTrue(np.allclose(x.get_masked_means(), means))
+        self.assert_items_equal(x, y)
+
+    def test_coords_skip_angles(self):
+        """Test that the coords dataset never materializes item angles"""
+        x = datasets.CathCanonicalCoordsDataset(**self.kwargs)
+        y = datasets.CathCanonicalAnglesDataset(**self.kwargs)
+        self.assertEqual(len(x), len(y))
+        for i in range(len(x)):
+            self.assertNotIn("angles", x[i])
+            self.assertTrue(torch.equal(x[i]["coords"], y[i]["coords"]))
+        self.assertEqual(x._item_angles, {})
+
+    def test_items_do_not_alias(self):
+        """Test that modifying a returned item does not modify the dataset"""
+        dset = datasets.CathCanonicalAnglesDataset(**self.kwargs)
+        item = dset[0]
+        item["angles"][:] = 10.0
+        self.assertFalse(torch.equal(dset[0]["angles"], item["angles"]))
+
+    def test_shared_memory(self):
+        """Test that datasets in shared memory pickle without copying arrays"""
+        ref = datasets.CathCanonicalAnglesOnlyDataset(**self.kwargs)
+        dset = datasets.CathCanonicalAnglesOnlyDataset(
+            shared_memory=True, **self.kwargs
+        )
+        self.assert_items_equal(ref, dset)
+        pickled = bytes(ForkingPickler.dumps(dset))
+        self.assertLess(len(pickled), dset.store.angles.nbytes)
+        self.assert_items_equal(ref, pickle.loads(pickled))
+
+
 class TestCathCanonicalAnglesOnly(unittest.TestCase):
     """
     Tests for the CATH canonical angles only dataset (i.e. no distance returned)
@@ -166,3 +372,298 @@ class TestNoisedDataset(unittest.TestCase):
         recovered = utils.modulo_with_wrapped_range(recovered, -np.pi, np.pi)
         delta = recovered - orig_angles
         self.assertTrue(torch.allclose(delta, torch.zeros_like(delta), atol=1e-4), f"Got non-zero delta on de-noise: {delta}")
+
+
+class TestLengthBucketing(unittest.TestCase):
+    """
+    Tests for the length bucketed batch sampler and padding trimming collate
+    """
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(6489)
+        self.lengths = rng.integers(20, 128, size=1000).tolist()
+        self.batch_size = 16
+
+    def test_covers_all_indices(self):
+        """Test that each index is sampled exactly once per epoch"""
+        sampler = datasets.LengthBucketedBatchSampler(
+            self.lengths, batch_size=self.batch_size, bucket_factor=4
+        )
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        self.assertTrue(all(len(b) <= self.batch_size for b in batches))
+        self.assertListEqual(
+            sorted(i for b in batches for i in b), list(range(len(self.lengths)))
+        )
+
+    def test_reduces_padding(self):
+        """Test that batches contain less padding than random batches"""
+        sampler = datasets.LengthBucketedBatchSampler(
+            self.lengths, batch_size=self.batch_size, bucket_factor=4
+        )
+        lengths = np.array(self.lengths)
+        padded = sum(lengths[b].max() * len(b) for b in sampler)
+        self.assertLess(padded, 1.25 * lengths.sum())
+
+    def test_epochs_differ(self):
+        """Test that successive epochs give different batches"""
+        sampler = datasets.LengthBucketedBatchSampler(
+            self.lengths, batch_size=self.batch_size
+        )
+        self.assertNotEqual(list(sampler), list(sampler))
+        sampler.set_epoch(3)
+        first = list(sampler)
+        sampler.set_epoch(3)
+        self.assertEqual(first, list(sampler))
+
+    def test_collate_trim_padding(self):
+        """Test that collated sequence keys are trimmed to the longest item"""
+        pad, lengths = 32, [5, 12, 9]
+        items = []
+        for l in lengths:
+            attn_mask = torch.zeros(pad)
+            attn_mask[:l] = 1.0
+            items.append(
+                {
+                    "angles": torch.randn(pad, 6),
+                    "attn_mask": attn_mask,
+                    "position_ids": torch.arange(pad),
+                    "t": torch.tensor([1]),
+                    "lengths": torch.tensor(l),
+                }
+            )
+        batch = datasets.collate_trim_padding(items)
+        self.assertEqual(batch["angles"].shape, (3, 12, 6))
+        self.assertEqual(batch["attn_mask"].shape, (3, 12))
+        self.assertEqual(batch["position_ids"].shape, (3, 12))
+        self.assertEqual(batch["t"].shape, (3, 1))
+        self.assertTrue(
+            torch.equal(batch["attn_mask"].sum(dim=1), batch["lengths"].float())
+        )
+
+
+class TestSequencePacking(unittest.TestCase):
+    """
+    Tests for packing multiple structures into shared rows
+    """
+
+    def setUp(self) -> None:
+        self.pad, self.lengths = 32, [20, 5, 12, 9, 30]
+        self.items = []
+        for i, l in enumerate(self.lengths):
+            attn_mask = torch.zeros(self.pad)
+            attn_mask[:l] = 1.0
+            self.items.append(
+                {
+                    "corrupted": torch.randn(self.pad, 6),
+                    "attn_mask": attn_mask,
+                    "position_ids": torch.arange(self.pad),
+                    "t": torch.tensor([i]),
+                    "lengths": torch.tensor(l),
+                }
+            )
+
+    def test_packing(self):
+        """Test that all tokens are packed once into rows no longer than pad"""
+        batch = datasets.collate_pack(self.items)
+        n_rows = batch["corrupted"].shape[0]
+        self.assertLess(n_rows, len(self.items))
+        self.assertEqual(batch["attn_mask"].shape, (n_rows, self.pad, self.pad))
+        self.assertEqual(batch["t"].shape, (n_rows, self.pad))
+        self.assertEqual(int(batch["lengths"].sum()), sum(self.lengths))
+        # Each item's tokens appear exactly once, with their own timestep
+        is_token = torch.diagonal(batch["attn_mask"], dim1=1, dim2=2).bool()
+        for i, l in enumerate(self.lengths):
+            self.assertEqual(int((batch["t"][is_token] == i).sum()), l)
+
+    def test_block_diagonal(self):
+        """Test that segments only attend within themselves"""
+        batch = datasets.collate_pack(self.items)
+        for r in range(batch["attn_mask"].shape[0]):
+            mask = batch["attn_mask"][r]
+            starts = torch.where(batch["position_ids"][r] == 0)[0]
+            for start in starts:
+                if mask[start, start] == 0:
+                    continue  # Padding
+                l = int(mask[start].sum())
+                self.assertTrue(torch.all(mask[start : start + l, start : start + l]))
+                self.assertEqual(int(mask[start : start + l].sum()), l * l)
+                self.assertTrue(
+                    torch.equal(
+                        batch["position_ids"][r, start : start + l], torch.arange(l)
+                    )
+                )
+
+
+class TestBatchedNoise(LocalPdbsTestCase):
+    """
+    Tests for noising collated batches of clean items
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        clean = datasets.CathCanonicalAnglesOnlyDataset(
+            pdbs=self.pdb_dir, pad=128, min_length=0, use_cache=False
+        )
+        kwargs = dict(timesteps=100, beta_schedule="cosine", angular_variance=np.pi)
+        self.dset = datasets.NoisedAnglesDataset(clean, **kwargs)
+        self.deferred = datasets.NoisedAnglesDataset(clean, defer_noise=True, **kwargs)
+
+    def test_matches_per_item(self):
+        """Test that batched noise has the same keys, shapes, and dtypes"""
+        ref = default_collate([self.dset[i] for i in range(len(self.dset))])
+        clean = default_collate([self.deferred[i] for i in range(len(self.deferred))])
+        self.assertNotIn("corrupted", clean)
+        batch = self.deferred.noise_batch(clean)
+        self.assertEqual(set(ref.keys()), set(batch.keys()))
+        for k, v in ref.items():
+            self.assertEqual(v.shape, batch[k].shape, k)
+            self.assertEqual(v.dtype, batch[k].dtype, k)
+
+    def test_noise_values(self):
+        """Test that noised values follow from the given timesteps and noise"""
+        clean = default_collate([self.deferred[i] for i in range(len(self.deferred))])
+        clean["t"] = torch.arange(len(self.deferred))[:, None] * 30
+        batch = self.deferred.noise_batch(clean)
+        for i in range(len(self.deferred)):
+            t = int(clean["t"][i])
+            terms = self.dset.alpha_beta_terms
+            expected = (
+                terms["sqrt_alphas_cumprod"][t] * clean["angles"][i]
+                + terms["sqrt_one_minus_alphas_cumprod"][t] * batch["known_noise"][i]
+            )
+            expected = utils.modulo_with_wrapped_range(expected, -np.pi, np.pi)
+            self.assertTrue(torch.allclose(expected, batch["corrupted"][i], atol=1e-6))
+        self.assertTrue(torch.all(batch["known_noise"].abs() <= np.pi))
+
+    def test_timestep_batches(self):
+        """Test that exhaustive batches cover each clean item at every timestep"""
+        exhaustive = datasets.NoisedAnglesDataset(
+            self.deferred.dset,
+            timesteps=100,
+            exhaustive_t=True,
+            defer_noise=True,
+            beta_schedule="cosine",
+        )
+        self.assertEqual(len(exhaustive), len(self.deferred))
+        clean = default_collate([exhaustive[i] for i in range(len(exhaustive))])
+        bs = len(exhaustive)
+        covered = []
+        for timesteps, batch in exhaustive.iter_timestep_batches(clean, max_items=30):
+            self.assertLessEqual(batch["corrupted"].shape[0], 30)
+            self.assertEqual(batch["corrupted"].shape[0], len(timesteps) * bs)
+            expected_t = torch.tensor(list(timesteps)).repeat_interleave(bs)
+            self.assertTrue(torch.equal(batch["t"].squeeze(-1), expected_t))
+            for i in range(len(timesteps)):
+                self.assertTrue(
+                    torch.equal(batch["angles"][i * bs : (i + 1) * bs], clean["angles"])
+                )
+            covered.extend(timesteps)
+        self.assertEqual(covered, list(range(100)))
+
+
+class TestAutoregressiveAllPositions(LocalPdbsTestCase):
+    """
+    Tests for teacher forced targets at every position
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        clean = datasets.CathCanonicalAnglesOnlyDataset(
+            pdbs=self.pdb_dir, pad=128, min_length=0, use_cache=False
+        )
+        self.dset = datasets.AutoregressiveCausalDataset(clean, all_positions=True)
+
+    def test_shifted_targets(self):
+        """Test that each position targets the next, up to the last residue"""
+        for i in range(len(self.dset)):
+            item = self.dset[i]
+            l = item["lengths"].item()
+            self.assertTrue(torch.equal(item["causal_target"][:-1], item["angles"][1:]))
+            self.assertEqual(item["causal_target_mask"].sum().item(), min(l, 128) - 1)
+            self.assertEqual(item["causal_target_mask"][min(l, 128) - 1].item(), 0)
+
+
+class TestShardedDataset(unittest.TestCase):
+    """
+    Tests for streaming structures from shards
+    """
+
+    def setUp(self) -> None:
+        self.tempdir = tempfile.mkdtemp()
+        self.fnames = sorted(glob.glob(os.path.join(DATA_DIR, "*.pdb")))
+        # Write each structure to its own shard, as bin/write_shards.py does
+        feature_names = datasets.FEATURE_SET_NAMES_TO_FEATURE_NAMES["canonical"]
+        writer = ShardWriter(self.tempdir, feature_names, structures_per_shard=1)
+        stats = datasets.ShardSplitStatistics(len(feature_names))
+        for fname in self.fnames:
+            s = featurize_structure(fname)
+            angles = s["angles"].loc[:, feature_names].values
+            writer.add({"angles": angles, "coords": s["coords"], "fname": fname}, fname)
+            stats.add(fname, angles)
+        writer.close(metadata={"splits": stats.to_dict()})
+        self.ref = datasets.CathCanonicalAnglesOnlyDataset(
+            pdbs=self.fnames, pad=128, min_length=0, use_cache=False
+        )
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tempdir)
+
+    def test_matches_in_memory(self):
+        """Test that streamed items match those of the in-memory dataset"""
+        dset = datasets.ShardedAnglesDataset(self.tempdir, pad=128, min_length=0)
+        self.assertEqual(len(dset), len(self.ref))
+        self.assertTrue(np.allclose(dset.means, self.ref.means))
+        dset.means = self.ref.means
+        streamed = dict(zip(dset.filenames, dset))
+        for i in range(len(self.ref)):
+            item = streamed[self.ref.filenames[i]]
+            self.assertEqual(set(item.keys()), set(self.ref[i].keys()))
+            for k, v in self.ref[i].items():
+                self.assertTrue(torch.equal(v, item[k]), k)
+
+    def test_splits_partition(self):
+        """Test that splits are disjoint and together cover every structure"""
+        split_fnames = [
+            datasets.ShardedAnglesDataset(self.tempdir, split=s, min_length=0).filenames
+            for s in datasets.SPLIT_FRACTIONS
+        ]
+        self.assertEqual(
+            sorted(sum((f.tolist() for f in split_fnames), [])), self.fnames
+        )
+        for s, fnames in zip(datasets.SPLIT_FRACTIONS, split_fnames):
+            self.assertTrue(all(datasets.hash_split(f) == s for f in fnames))
+
+    def test_workers_partition(self):
+        """Test that shuffled loading with workers yields each structure once"""
+        dset = datasets.ShardedAnglesDataset(
+            self.tempdir, pad=128, min_length=0, shuffle=True, shuffle_buffer=2
+        )
+        loader = torch.utils.data.DataLoader(dset, batch_size=1, num_workers=2)
+        lengths = sorted(int(b["lengths"]) for b in loader)
+        self.assertEqual(lengths, sorted(min(l, 128) for l in self.ref.all_lengths))
+
+    def test_replicas_equal_counts(self):
+        """Test that every replica yields the same number of items"""
+        dset = datasets.ShardedAnglesDataset(
+            self.tempdir, pad=128, min_length=0, shuffle=True, shuffle_buffer=2
+        )
+        for num_replicas in [2, 3, len(self.fnames) + 2]:
+            for num_workers in [1, 3]:
+                counts = []
+                for rank in range(num_replicas):
+                    n = 0
+                    for worker_id in range(num_workers):
+                        worker_info = mock.Mock(
+                            id=worker_id, num_workers=num_workers, seed=worker_id
+                        )
+                        with mock.patch.object(
+                            datasets, "_replicas", return_value=(num_replicas, rank)
+                        ), mock.patch.object(
+                            datasets, "get_worker_info", return_value=worker_info
+                        ):
+                            n += sum(1 for _ in dset)
+                            expected = len(dset)
+                    counts.append(n)
+                self.assertEqual(counts, [expected] * num_replicas)
+                self.assertGreaterEqual(expected * num_replicas, len(self.fnames))
@@ -0,0 +1,196 @@
+"""
+Tests for the memory-mapped feature store
+"""
+
+import os
+import json
+import pickle
+import tempfile
+import unittest
+from multiprocessing.reduction import ForkingPickler
+
+import numpy as np
+import pandas as pd
+import torch.multiprocessing  # Registers reductions for shared tensors
+
+from foldingdiff import feature_store as fs
+
+
+class TestFeatureStore(unittest.TestCase):
+    """
+    Test writing and reading back the columnar feature store
+    """
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(6489)
+        self.feature_names = ["phi", "psi", "omega"]
+        self.structures = [
+            {
+                "angles": pd.DataFrame(
+                    rng.uniform(-np.pi, np.pi, size=(l, 3)).astype(np.float32),
+                    columns=self.feature_names,
+                ),
+                "coords": rng.normal(size=(l, 3)).astype(np.float32),
+                "fname": f"struct_{i}.pdb",
+            }
+            for i, l in enumerate([5, 120, 1, 300])
+        ]
+
+    def test_in_memory(self):
+        """Test that per-structure views match the inputs"""
+        store = fs.FeatureStore.from_structures(self.structures)
+        self.assertEqual(len(store), len(self.structures))
+        for i, s in enumerate(self.structures):
+            self.assertTrue(np.array_equal(store.get_angles(i), s["angles"].values))
+            self.assertTrue(np.array_equal(store.get_coords(i), s["coords"]))
+
+    def test_roundtrip(self):
+        """Test that saving and loading gives back identical, memory mapped values"""
+        store = fs.FeatureStore.from_structures(
+            self.structures, metadata={"key": "value"}
+        )
+        with tempfile.TemporaryDirectory() as tempdir:
+            dirname = store.save(os.path.join(tempdir, "store"))
+            loaded = fs.FeatureStore.load(dirname)
+            self.assertIsInstance(loaded.angles, np.memmap)
+            self.assertEqual(loaded.metadata, {"key": "value"})
+            self.assertEqual(loaded.feature_names, self.feature_names)
+            for i, s in enumerate(self.structures):
+                item = loaded[i]
+                self.assertEqual(item["fname"], s["fname"])
+                self.assertTrue(np.array_equal(item["angles"].values, s["angles"].values))
+                self.assertTrue(np.array_equal(item["coords"], s["coords"]))
+            self.assertTrue(np.array_equal(loaded.statistics.m2, store.statistics.m2))
+            del loaded
+
+    def test_items_are_writable_copies(self):
+        """Test that items taken from a memory mapped store can be modified"""
+        store = fs.FeatureStore.from_structures(self.structures)
+        with tempfile.TemporaryDirectory() as tempdir:
+            loaded = fs.FeatureStore.load(store.save(os.path.join(tempdir, "store")))
+            item = loaded[1]
+            item["coords"][:] = 0.0
+            self.assertFalse(np.all(loaded.get_coords(1) == 0.0))
+            del loaded, item
+
+    def test_shared_memory_pickle(self):
+        """Test that a store in shared memory pickles as handles, not copies"""
+        store = fs.FeatureStore.from_structures(self.structures).share_memory()
+        pickled = bytes(ForkingPickler.dumps(store))
+        self.assertLess(len(pickled), store.angles.nbytes)
+        loaded = pickle.loads(pickled)
+        self.assertEqual(loaded.fnames.tolist(), store.fnames.tolist())
+        for i, s in enumerate(self.structures):
+            self.assertTrue(np.array_equal(loaded.get_angles(i), s["angles"].values))
+            self.assertTrue(np.array_equal(loaded.get_coords(i), s["coords"]))
+
+    def test_mmap_pickle(self):
+        """Test that a memory mapped store pickles as its location"""
+        store = fs.FeatureStore.from_structures(self.structures)
+        with tempfile.TemporaryDirectory() as tempdir:
+            loaded = fs.FeatureStore.load(store.save(os.path.join(tempdir, "store")))
+            pickled = pickle.dumps(loaded)
+            self.assertLess(len(pickled), store.angles.nbytes)
+            unpickled = pickle.loads(pickled)
+            self.assertIsInstance(unpickled.angles, np.memmap)
+            self.assertTrue(np.array_equal(unpickled.angles, store.angles))
+            self.assertEqual(unpickled.fnames.tolist(), store.fnames.tolist())
+            del loaded, unpickled
+
+    def test_version_mismatch(self):
+        """Test that a store written with another format version is ignored"""
+        store = fs.FeatureStore.from_structures(self.structures)
+        with tempfile.TemporaryDirectory() as tempdir:
+            dirname = store.save(os.path.join(tempdir, "store"))
+            meta_fname = os.path.join(dirname, fs.META_FNAME)
+            with open(meta_fname) as source:
+                meta = json.load(source)
+            meta["format_version"] = fs.FORMAT_VERSION - 1
+            with open(meta_fname, "w") as sink:
+                json.dump(meta, sink)
+            self.assertIsNone(fs.FeatureStore.read_metadata(dirname))
+            with self.assertRaises(FileNotFoundError):
+                fs.FeatureStore.load(dirname)
+
+
+    def test_shards(self):
+        """Test writing structures across shards and reading them back"""
+        with tempfile.TemporaryDirectory() as tempdir:
+            writer = fs.ShardWriter(
+                tempdir, feature_names=self.feature_names, structures_per_shard=3
+            )
+            keys = [f"key_{i}" for i in range(len(self.structures))]
+            for s, k in zip(self.structures, keys):
+                writer.add(s, k)
+            writer.close(metadata={"key": "value"})
+            index = fs.read_shard_index(tempdir)
+            self.assertEqual(index["metadata"], {"key": "value"})
+            self.assertEqual([s["n_structures"] for s in index["shards"]], [3, 1])
+
+            read_keys, i = [], 0
+            for shard in index["shards"]:
+                store, shard_keys = fs.read_shard(os.path.join(tempdir, shard["fname"]))
+                read_keys.extend(shard_keys)
+                for j in range(len(store)):
+                    s = self.structures[i]
+                    self.assertEqual(store.fnames[j], s["fname"])
+                    self.assertTrue(
+                        np.array_equal(store.get_angles(j), s["angles"].values)
+                    )
+                    self.assertTrue(np.array_equal(store.get_coords(j), s["coords"]))
+                    i += 1
+            self.assertEqual(read_keys, keys)
+
+class TestStringTable(unittest.TestCase):
+    """
+    Test the table of strings backed by a single array
+    """
+
+    def test_roundtrip(self):
+        """Test that strings, including empty and non-ascii ones, are preserved"""
+        strings = ["a.pdb", "", "dir/ß.pdb", "a.pdb"]
+        table = fs.StringTable.from_strings(strings)
+        self.assertEqual(len(table), len(strings))
+        self.assertEqual(table.tolist(), strings)
+        self.assertEqual(table[-1], strings[-1])
+        self.assertEqual(table.index("a.pdb"), 0)
+        self.assertIn("dir/ß.pdb", table)
+        self.assertNotIn("b.pdb", table)
+        with self.assertRaises(IndexError):
+            table[len(strings)]
+
+    def test_empty(self):
+        """Test a table of no strings"""
+        table = fs.StringTable.from_strings([])
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.tolist(), [])
+
+    def test_take(self):
+        """Test taking a subset of the strings as a new table"""
+        strings = ["a.pdb", "", "dir/ß.pdb", "bb.pdb"]
+        table = fs.StringTable.from_strings(strings)
+        idx = [3, 0, 1, 3]
+        subset = table.take(idx)
+        self.assertEqual(subset, [strings[i] for i in idx])
+        self.assertEqual(subset.index("bb.pdb"), 0)
+        self.assertEqual(table.take([]).tolist(), [])
+
+    def test_slice(self):
+        """Test that slicing returns a table of the sliced strings"""
+        strings = ["a.pdb", "", "dir/ß.pdb", "bb.pdb"]
+        table = fs.StringTable.from_strings(strings)
+        for s in [slice(1, 3), slice(None, None, -1), slice(2, None), slice(3, 1)]:
+            self.assertIsInstance(table[s], fs.StringTable)
+            self.assertEqual(table[s].tolist(), strings[s])
+
+    def test_lookup_not_pickled(self):
+        """Test that the lookup dict is not carried when pickling"""
+        table = fs.StringTable.from_strings(["a.pdb", "b.pdb"])
+        self.assertIn("b.pdb", table)
+        unpickled = pickle.loads(pickle.dumps(table))
+        self.assertIsNone(unpickled._index)
+        self.assertEqual(unpickled, table)
+        self.assertEqual(unpickled.index("b.pdb"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,7 @@ import unittest
 
 import numpy as np
 import torch
+from torch.nn import functional as F
 
 from foldingdiff import losses
 
@@ -144,6 +145,75 @@ class TestRadianSmoothL1Loss(unittest.TestCase):
         self.assertAlmostEqual(3.04143, l.item(), places=5)
 
 
+class TestFeatureSmoothL1Loss(unittest.TestCase):
+    """
+    Tests for the smooth L1 loss of all features at once
+    """
+
+    def setUp(self) -> None:
+        torch.manual_seed(6489)
+        self.input = torch.randn(8, 32, 4) * 4
+        self.target = torch.randn(8, 32, 4) * 3
+        self.mask = torch.ones(8, 32)
+        self.mask[:, 20:] = 0
+        self.mask[3, 5:] = 0
+        self.is_angular = torch.tensor([False, True, True, False])
+
+    def per_feature(self, beta: float, circle_penalty: float = 0.0):
+        """Losses of each masked feature computed separately"""
+        idx = torch.where(self.mask)
+        return torch.stack(
+            [
+                losses.radian_smooth_l1_loss(
+                    self.input[idx][:, i],
+                    self.target[idx][:, i],
+                    beta=beta,
+                    circle_penalty=circle_penalty,
+                )
+                if is_angular
+                else F.smooth_l1_loss(self.input[idx][:, i], self.target[idx][:, i])
+                for i, is_angular in enumerate(self.is_angular)
+            ]
+        )
+
+    def test_matches_per_feature(self):
+        """Test that the loss matches the losses of each feature"""
+        beta = torch.where(self.is_angular, 0.1, 1.0)
+        l = losses.feature_smooth_l1_loss(
+            self.input, self.target, self.mask, self.is_angular, beta
+        )
+        self.assertTrue(torch.allclose(l, self.per_feature(0.1), atol=1e-5))
+
+    def test_circle_penalty(self):
+        """Test that the circle penalty matches that of each feature"""
+        beta = torch.where(self.is_angular, 0.1, 1.0)
+        circle_penalty = torch.where(self.is_angular, 0.5, 0.0)
+        l = losses.feature_smooth_l1_loss(
+            self.input, self.target, self.mask, self.is_angular, beta, circle_penalty
+        )
+        self.assertTrue(torch.allclose(l, self.per_feature(0.1, 0.5), atol=1e-5))
+
+    def test_zero_beta(self):
+        """Test that a beta of 0 gives the L1 loss, with finite gradients"""
+        x = self.input.clone().requires_grad_()
+        l = losses.feature_smooth_l1_loss(
+            x, self.target, self.mask, self.is_angular, torch.zeros(4)
+        )
+        l.sum().backward()
+        self.assertTrue(torch.all(torch.isfinite(x.grad)))
+        idx = torch.where(self.mask)
+        self.assertAlmostEqual(
+            l[1].item(),
+            losses.radian_l1_loss(self.input[idx][:, 1], self.target[idx][:, 1]).item(),
+            places=5,
+        )
+        self.assertAlmostEqual(
+            l[0].item(),
+            F.l1_loss(self.input[idx][:, 0], self.target[idx][:, 0]).item(),
+            places=5,
+        )
+
+
 class TestPairwiseDistLoss(unittest.TestCase):
     """
     Tests for pairwise distance loss
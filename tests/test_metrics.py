@@ -1,7 +1,12 @@
+import os
+import glob
+import shutil
+import tempfile
 import unittest
 
 import numpy as np
 
+from foldingdiff import datasets
 from foldingdiff import custom_metrics as cm
 
 
@@ -41,6 +46,46 @@ class TestKLFromEmpirical(unittest.TestCase):
         self.assertEqual(np.inf, kl)
 
 
+class TestTimestepHistograms(unittest.TestCase):
+    """
+    Tests for the vectorized histograms and KL divergence across timesteps
+    """
+
+    def setUp(self) -> None:
+        self.tempdir = tempfile.mkdtemp()
+        data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+        for fname in glob.glob(os.path.join(data_dir, "*.pdb")):
+            shutil.copy(fname, self.tempdir)
+        clean = datasets.CathCanonicalAnglesOnlyDataset(
+            pdbs=self.tempdir, pad=128, min_length=0, use_cache=False
+        )
+        self.dset = datasets.NoisedAnglesDataset(
+            clean, timesteps=100, beta_schedule="cosine", angular_variance=np.pi
+        )
+        self.n_positions = sum(
+            int(clean[i]["attn_mask"].sum()) for i in range(len(clean))
+        )
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tempdir)
+
+    def test_shapes_and_counts(self):
+        """Test that every position is counted once per timestep and feature"""
+        hists = cm.timestep_histograms(self.dset, nbins=20, max_chunk_elements=1000)
+        n_fts = len(self.dset.feature_names["angles"])
+        self.assertEqual(hists["counts"].shape, (100, n_fts, 20))
+        self.assertEqual(hists["edges"].shape, (n_fts, 21))
+        self.assertTrue(np.all(hists["counts"].sum(axis=-1) == self.n_positions))
+        self.assertTrue(np.all(hists["noise_counts"].sum(axis=-1) == self.n_positions))
+
+    def test_kl_decreases(self):
+        """Test that values approach the noise distribution by the last timestep"""
+        hists = cm.timestep_histograms(self.dset, nbins=10, timesteps=[0, 99])
+        kl = cm.kl_from_histograms(hists["counts"], hists["noise_counts"])
+        self.assertEqual(kl.shape, (2, len(self.dset.feature_names["angles"])))
+        self.assertTrue(np.all(kl[1] < kl[0]))
+
+
 class TestWrappedMean(unittest.TestCase):
     """Test for the wrapped mean function"""
 
@@ -96,3 +141,45 @@ class TestWrappedMean(unittest.TestCase):
         x[:100] = np.nan
         m_with_nan = cm.wrapped_mean(x)
         self.assertAlmostEqual(m, m_with_nan, places=2)
+
+
+class TestFeatureStatistics(unittest.TestCase):
+    """Tests for the streaming feature statistics"""
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(seed=6489)
+        self.x = rng.uniform(-np.pi, np.pi, size=(1000, 3))
+        self.x[rng.random(self.x.shape) < 0.1] = np.nan
+        self.lengths = np.array([0, 10, 300, 0, 690])
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)[:-1]])
+
+    def assert_matches(self, stats, x):
+        """Assert that the statistics match those computed directly on x"""
+        self.assertTrue(np.allclose(stats.wrapped_mean(), cm.wrapped_mean(x, axis=0)))
+        self.assertTrue(np.allclose(stats.mean, np.nanmean(x, axis=0)))
+        self.assertTrue(np.allclose(stats.var(ddof=1), np.nanvar(x, axis=0, ddof=1)))
+        self.assertTrue(np.array_equal(stats.nan_count, np.isnan(x).sum(axis=0)))
+
+    def test_from_values(self):
+        """Test statistics of all values"""
+        self.assert_matches(cm.FeatureStatistics.from_values(self.x), self.x)
+
+    def test_segments(self):
+        """Test reducing the statistics of a subset of segments, including empty"""
+        stats = cm.FeatureStatistics.from_segments(self.x, self.offsets, self.lengths)
+        self.assertEqual(stats.mean.shape, (len(self.lengths), 3))
+        self.assert_matches(stats.reduce(), self.x)
+        self.assert_matches(stats.reduce([0, 1, 2]), self.x[:310])
+
+    def test_update(self):
+        """Test that updating in chunks matches computing in one pass"""
+        stats = cm.FeatureStatistics.empty(3)
+        for i in range(0, len(self.x), 7):
+            stats.update(self.x[i : i + 7])
+        self.assert_matches(stats, self.x)
+        roundtrip = cm.FeatureStatistics.from_dict(stats.to_dict())
+        self.assert_matches(roundtrip, self.x)
+
+    def test_empty(self):
+        """Test that the mean of no values is nan"""
+        self.assertTrue(np.all(np.isnan(cm.FeatureStatistics.empty(3).wrapped_mean())))
@@ -5,6 +5,7 @@ tests for model subparts
 import unittest
 
 import torch
+from transformers import BertConfig
 
 from foldingdiff import modelling
 
@@ -94,5 +95,184 @@ class TestGaussianFourierProjection(unittest.TestCase):
                 self.assertFalse(torch.allclose(e[i], e[j]))
 
 
+class TestCausalAutoregressive(unittest.TestCase):
+    """
+    Tests for the causally masked autoregressive model
+    """
+
+    def setUp(self) -> None:
+        torch.random.manual_seed(6489)
+        cfg = BertConfig(
+            max_position_embeddings=32,
+            num_attention_heads=2,
+            hidden_size=16,
+            intermediate_size=16,
+            num_hidden_layers=2,
+        )
+        self.model = modelling.BertForAutoregressiveBase(
+            config=cfg, ft_is_angular=[True] * 6, causal=True
+        )
+        self.model.eval()
+        self.inputs = torch.randn(3, 32, 6)
+        self.attn_mask = torch.ones(3, 32)
+        self.attn_mask[0, 20:] = 0
+        self.lengths = self.attn_mask.sum(dim=1).long()
+
+    def test_no_lookahead(self):
+        """Test that predictions do not depend on later positions"""
+        x = self.model(self.inputs, self.attn_mask, self.lengths)
+        perturbed = self.inputs.clone()
+        perturbed[:, 10:] = torch.randn(3, 22, 6)
+        y = self.model(perturbed, self.attn_mask, self.lengths)
+        self.assertTrue(torch.allclose(x[:, :10], y[:, :10], atol=1e-6))
+        self.assertFalse(torch.allclose(x[:, 10:], y[:, 10:]))
+
+    def test_cached_sampling(self):
+        """Test that sampling with cached keys and values matches full forwards"""
+        lengths = torch.tensor([32, 20, 9])
+        for position_embedding_type in ["absolute", "relative_key_query"]:
+            for fused in [False, True]:
+                cfg = BertConfig(
+                    max_position_embeddings=32,
+                    num_attention_heads=2,
+                    hidden_size=16,
+                    intermediate_size=16,
+                    num_hidden_layers=2,
+                    position_embedding_type=position_embedding_type,
+                )
+                model = modelling.BertForAutoregressiveBase(
+                    config=cfg,
+                    ft_is_angular=[True] * 6,
+                    fused_attention=fused,
+                    causal=True,
+                ).eval()
+                seed = torch.rand(3, 32, 6) * 2 - 1
+                x = model.sample(seed, lengths, num_seed=3, pbar=False)
+                y = model.sample(seed, lengths, num_seed=3, pbar=False, use_cache=False)
+                for a, b, l in zip(x, y, lengths):
+                    self.assertEqual(a.shape[0], l)
+                    self.assertTrue(torch.allclose(a, b, atol=1e-5))
+
+
+class TestFusedAttention(unittest.TestCase):
+    """
+    Tests that the fused attention encoder matches the huggingface encoder
+    """
+
+    def setUp(self) -> None:
+        torch.random.manual_seed(6489)
+        self.inputs = torch.randn(3, 48, 6)
+        self.timesteps = torch.randint(0, 250, (3, 1))
+        self.attn_mask = torch.ones(3, 48)
+        self.attn_mask[1, 20:] = 0
+        self.attn_mask[2, 33:] = 0
+
+    def build(self, position_embedding_type: str, fused: bool):
+        """Build a small model with the given attention implementation"""
+        cfg = BertConfig(
+            max_position_embeddings=48,
+            num_attention_heads=2,
+            hidden_size=16,
+            intermediate_size=16,
+            num_hidden_layers=2,
+            position_embedding_type=position_embedding_type,
+        )
+        return modelling.BertForDiffusionBase(
+            config=cfg, ft_is_angular=[True] * 6, fused_attention=fused
+        ).eval()
+
+    def test_matches_huggingface(self):
+        """Test that the fused encoder loads huggingface weights and matches"""
+        for position_embedding_type in ["absolute", "relative_key"]:
+            ref = self.build(position_embedding_type, fused=False)
+            fused = self.build(position_embedding_type, fused=True)
+            fused.load_state_dict(ref.state_dict())
+            with torch.no_grad():
+                x = ref(self.inputs, self.timesteps, self.attn_mask)
+                y = fused(self.inputs, self.timesteps, self.attn_mask)
+            self.assertTrue(torch.allclose(x, y, atol=1e-5), position_embedding_type)
+
+    def test_state_dict_roundtrip(self):
+        """Test that fused weights are saved in the huggingface layout"""
+        fused = self.build("relative_key", fused=True)
+        ref = self.build("relative_key", fused=False)
+        self.assertEqual(fused.state_dict().keys(), ref.state_dict().keys())
+        ref.load_state_dict(fused.state_dict())
+        with torch.no_grad():
+            x = ref(self.inputs, self.timesteps, self.attn_mask)
+            y = fused(self.inputs, self.timesteps, self.attn_mask)
+        self.assertTrue(torch.allclose(x, y, atol=1e-5))
+
+    def test_unpadded_matches_padded(self):
+        """Test that skipping padding does not change outputs at valid positions"""
+        valid = self.attn_mask.bool()
+        for position_embedding_type in ["absolute", "relative_key_query"]:
+            ref = self.build(position_embedding_type, fused=True)
+            ref.encoder.unpad = True
+            x = ref(self.inputs, self.timesteps, self.attn_mask)
+            ref.encoder.unpad = False
+            y = ref(self.inputs, self.timesteps, self.attn_mask)
+            self.assertTrue(
+                torch.allclose(x[valid], y[valid], atol=1e-5), position_embedding_type
+            )
+
+    def test_unpadded_non_prefix_mask(self):
+        """Test that masks with gaps are unpadded without changing valid outputs"""
+        attn_mask = self.attn_mask.clone()
+        attn_mask[0, 5:9] = 0
+        valid = attn_mask.bool()
+        ref = self.build("relative_key", fused=True)
+        ref.encoder.unpad = True
+        x = ref(self.inputs, self.timesteps, attn_mask)
+        ref.encoder.unpad = False
+        y = ref(self.inputs, self.timesteps, attn_mask)
+        self.assertTrue(torch.allclose(x[valid], y[valid], atol=1e-5))
+
+
+class TestActivationCheckpointing(unittest.TestCase):
+    """
+    Tests that checkpointing encoder activations does not change gradients
+    """
+
+    def setUp(self) -> None:
+        torch.random.manual_seed(6489)
+        self.inputs = torch.randn(3, 32, 6)
+        self.timesteps = torch.randint(0, 250, (3, 1))
+        self.attn_mask = torch.ones(3, 32)
+        self.attn_mask[1, 20:] = 0
+
+    def grads(self, checkpoint_every: int, **kwargs):
+        """Gradients of a small model without dropout, in training mode"""
+        torch.random.manual_seed(6489)
+        cfg = BertConfig(
+            max_position_embeddings=32,
+            num_attention_heads=2,
+            hidden_size=16,
+            intermediate_size=16,
+            num_hidden_layers=3,
+            hidden_dropout_prob=0.0,
+            attention_probs_dropout_prob=0.0,
+            position_embedding_type="relative_key",
+        )
+        model = modelling.BertForDiffusionBase(
+            config=cfg,
+            ft_is_angular=[True] * 6,
+            checkpoint_every=checkpoint_every,
+            **kwargs,
+        ).train()
+        model(self.inputs, self.timesteps, self.attn_mask).sum().backward()
+        return [p.grad for p in model.parameters() if p.grad is not None]
+
+    def test_same_gradients(self):
+        """Test checkpointing in segments that do and do not divide the layers"""
+        for kwargs in [{}, {"fused_attention": True}, {"unpad_sequences": True}]:
+            ref = self.grads(0, **kwargs)
+            for checkpoint_every in [1, 2]:
+                grads = self.grads(checkpoint_every, **kwargs)
+                self.assertEqual(len(ref), len(grads))
+                for g_ref, g in zip(ref, grads):
+                    self.assertTrue(torch.allclose(g_ref, g, atol=1e-6), kwargs)
+
+
 if __name__ == "__main__":
     unittest.main()
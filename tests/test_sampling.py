@@ -8,7 +8,7 @@ import unittest
 import numpy as np
 import torch
 
-from foldingdiff import sampling
+from foldingdiff import beta_schedules, modelling, onnx_sampling, sampling
 
 
 class TestSamplingReproducible(unittest.TestCase):
@@ -45,3 +45,119 @@ class TestSamplingReproducible(unittest.TestCase):
             self.full_model, n=1, sweep_lengths=[50, 51]
         ).pop()
         self.assertFalse(np.allclose(samp_1.values, samp_2.values))
+
+
+class TestTracedDenoiser(unittest.TestCase):
+    """
+    Test that the traced denoiser matches the eager model
+    """
+
+    def setUp(self) -> None:
+        mini_model = os.path.join(
+            os.path.dirname(__file__), "mini_model_for_testing", "results"
+        )
+        torch.manual_seed(6489)
+        self.model = modelling.BertForDiffusionBase.from_dir(
+            mini_model, load_weights=False
+        ).eval()
+        self.inputs = torch.randn(4, 60, 6)
+        self.timesteps = torch.full((4,), 100)
+        self.attn_mask = torch.ones(4, 60)
+        self.attn_mask[1, 45:] = 0
+
+    def test_matches_eager(self):
+        """Test that traced outputs match eager outputs in padded buckets"""
+        traced = sampling.TracedDenoiser(self.model, length_multiple=16)
+        valid = self.attn_mask.bool()
+        with torch.no_grad():
+            ref = self.model(self.inputs, self.timesteps, self.attn_mask)
+            for _ in range(2):
+                out = traced(self.inputs, self.timesteps, self.attn_mask)
+                self.assertEqual(out.shape, ref.shape)
+                self.assertTrue(torch.allclose(out[valid], ref[valid], atol=1e-5))
+        self.assertEqual(list(traced._traced.keys()), [(4, 64, ())])
+        self.assertIsNotNone(traced._traced[(4, 64, ())])
+
+    def test_timestep_shapes(self):
+        """Test that each timestep shape gets its own trace or runs eagerly"""
+        traced = sampling.TracedDenoiser(self.model, length_multiple=16)
+        valid = self.attn_mask.bool()
+        per_token = torch.randint(0, 250, (4, 60))
+        with torch.no_grad():
+            for timestep in (self.timesteps, self.timesteps[:, None], per_token):
+                ref = self.model(self.inputs, timestep, self.attn_mask)
+                out = traced(self.inputs, timestep, self.attn_mask)
+                self.assertTrue(torch.allclose(out[valid], ref[valid], atol=1e-5))
+        self.assertEqual(list(traced._traced.keys()), [(4, 64, ()), (4, 64, (1,))])
+
+    def test_eager_with_grad(self):
+        """Test that calls with grad enabled are not traced"""
+        traced = sampling.TracedDenoiser(self.model)
+        traced(self.inputs, self.timesteps, self.attn_mask)
+        self.assertFalse(traced._traced)
+
+
+class TestNumpySampling(unittest.TestCase):
+    """
+    Test that the numpy sampling loop used with onnxruntime matches torch
+    """
+
+    def setUp(self) -> None:
+        mini_model = os.path.join(
+            os.path.dirname(__file__), "mini_model_for_testing", "results"
+        )
+        torch.manual_seed(6489)
+        self.model = modelling.BertForDiffusionBase.from_dir(
+            mini_model, load_weights=False
+        ).eval()
+        self.betas = beta_schedules.cosine_beta_schedule(20)
+        self.schedule = {
+            k: v.numpy()
+            for k, v in beta_schedules.compute_alphas(self.betas).items()
+            if k in onnx_sampling.SCHEDULE_KEYS
+        }
+        self.lengths = [40, 25]
+        self.noise = torch.randn(2, 40, 6)
+
+    def denoiser(self, inputs, timestep, attention_mask) -> np.ndarray:
+        """Run the torch model on numpy inputs"""
+        with torch.no_grad():
+            return self.model(
+                torch.from_numpy(inputs),
+                torch.from_numpy(timestep),
+                torch.from_numpy(attention_mask),
+            ).numpy()
+
+    def test_p_sample_matches_torch(self):
+        """Test that the final denoising step matches torch"""
+        ref = sampling.p_sample(
+            self.model,
+            self.noise,
+            torch.zeros(2, dtype=torch.long),
+            self.lengths,
+            t_index=0,
+            betas=self.betas,
+        )
+        out = onnx_sampling.p_sample(
+            self.denoiser,
+            self.noise.numpy(),
+            0,
+            self.lengths,
+            self.schedule,
+            np.random.default_rng(6489),
+        )
+        self.assertTrue(np.allclose(out, ref.numpy(), atol=1e-5))
+
+    def test_p_sample_loop(self):
+        """Test that the loop returns wrapped angles for every timestep"""
+        out = onnx_sampling.p_sample_loop(
+            self.denoiser,
+            self.lengths,
+            self.noise.numpy(),
+            self.schedule,
+            is_angle=[True] * 6,
+            rng=np.random.default_rng(6489),
+            disable_pbar=True,
+        )
+        self.assertEqual(out.shape, (20, 2, 40, 6))
+        self.assertTrue(np.all(np.abs(out) <= np.pi))
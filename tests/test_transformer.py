@@ -1,12 +1,14 @@
 import os
+import inspect
 import unittest
 import tempfile
+import importlib.util
 
 import numpy as np
 import torch
 from transformers import BertConfig
 
-from foldingdiff import modelling
+from foldingdiff import inference_bundle, modelling
 
 ATOL, RTOL = 1e-6, 1e-3
 
@@ -236,5 +238,156 @@ class TestTransformerBaseLoadingSaving(unittest.TestCase):
             self.assertAlmostEqual(p1.data.ne(p2.data).sum(), 0)
 
 
+class TestReducedPrecision(unittest.TestCase):
+    """
+    Test that running the encoder in reduced precision stays close to fp32
+    """
+
+    def setUp(self) -> None:
+        model_dir = os.path.join(
+            os.path.dirname(__file__), "mini_model_for_testing", "results"
+        )
+        assert os.path.isdir(model_dir)
+        torch.random.manual_seed(6489)
+        self.model = modelling.BertForDiffusionBase.from_dir(
+            model_dir, load_weights=False
+        ).eval()
+        self.inputs = (torch.rand(8, 128, 6) * 2 - 1) * np.pi
+        self.timesteps = torch.randint(0, 250, (8, 1))
+        self.attn_mask = torch.ones(8, 128)
+        self.attn_mask[:, 100:] = 0
+
+    def test_bf16_matches_fp32(self):
+        """Test that bf16 outputs are fp32 and close to fp32 outputs"""
+        with torch.no_grad():
+            ref = self.model(self.inputs, self.timesteps, self.attn_mask)
+            self.model.encoder_precision = "bf16"
+            out = self.model(self.inputs, self.timesteps, self.attn_mask)
+        self.assertEqual(out.dtype, torch.float32)
+        self.assertTrue(torch.allclose(out, ref, atol=1e-2))
+
+
+class TestQuantized(unittest.TestCase):
+    """
+    Test loading a dynamic int8 quantized model
+    """
+
+    def setUp(self) -> None:
+        self.model_dir = os.path.join(
+            os.path.dirname(__file__), "mini_model_for_testing", "results"
+        )
+        assert os.path.isdir(self.model_dir)
+        self.inputs = (torch.rand(8, 128, 6) * 2 - 1) * np.pi
+        self.timesteps = torch.randint(0, 250, (8, 1))
+        self.attn_mask = torch.ones(8, 128)
+
+    def test_quantized_close_to_fp32(self):
+        """Test that Linear layers are quantized and outputs stay close"""
+        torch.random.manual_seed(6489)
+        ref_model = modelling.BertForDiffusionBase.from_dir(
+            self.model_dir, load_weights=False
+        ).eval()
+        torch.random.manual_seed(6489)
+        model = modelling.BertForDiffusionBase.from_dir(
+            self.model_dir, load_weights=False, quantize=True
+        )
+        self.assertFalse(
+            any(type(m) is torch.nn.Linear for m in model.modules()),
+            "Expected all Linear layers to be quantized",
+        )
+        with torch.no_grad():
+            ref = ref_model(self.inputs, self.timesteps, self.attn_mask)
+            out = model(self.inputs, self.timesteps, self.attn_mask)
+        self.assertLess((out - ref).abs().mean(), 0.1 * ref.abs().mean())
+
+
+class TestInferenceBundle(unittest.TestCase):
+    """
+    Test writing a model to an inference bundle and loading it back
+    """
+
+    def setUp(self) -> None:
+        self.model_dir = os.path.join(
+            os.path.dirname(__file__), "mini_model_for_testing", "results"
+        )
+        assert os.path.isdir(self.model_dir)
+        self.inputs = (torch.rand(8, 128, 6) * 2 - 1) * np.pi
+        self.timesteps = torch.randint(0, 250, (8, 1))
+        self.attn_mask = torch.ones(8, 128)
+
+    def test_round_trip(self):
+        """Test that the model loaded from a bundle gives the same outputs"""
+        model = modelling.BertForDiffusionBase.from_dir(
+            self.model_dir, load_weights=False
+        ).eval()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inference_bundle.write_bundle(
+                tmpdir,
+                model.state_dict(),
+                model.config,
+                {"variance_schedule": "cosine", "timesteps": 250},
+                {"ft_is_angular": model.ft_is_angular, "decoder": "mlp"},
+            )
+            self.assertTrue(inference_bundle.is_bundle(tmpdir))
+            bundled = modelling.BertForDiffusionBase.from_dir(tmpdir).eval()
+            schedule = inference_bundle.load_schedule(tmpdir)
+        self.assertEqual(schedule["betas"].shape, (250,))
+        with torch.no_grad():
+            ref = model(self.inputs, self.timesteps, self.attn_mask)
+            out = bundled(self.inputs, self.timesteps, self.attn_mask)
+        self.assertTrue(torch.equal(out, ref))
+
+
+class TestBuildFromTrainConfig(unittest.TestCase):
+    """
+    Test that a shipped config builds a model through the train.py arg path
+    """
+
+    def setUp(self) -> None:
+        bin_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "bin")
+        spec = importlib.util.spec_from_file_location(
+            "train", os.path.join(bin_dir, "train.py")
+        )
+        self.train = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.train)
+        self.config = os.path.join(
+            os.path.dirname(bin_dir), "config_jsons", "cath_full_angles_cosine.json"
+        )
+        assert os.path.isfile(self.config)
+
+    def build_model(self, argv):
+        """Build a model using the train kwargs resolved from the given argv"""
+        args = self.train.build_parser().parse_args(argv)
+        config_args = self.train.build_config_args(args)
+        kwargs = inspect.signature(self.train.train).bind(**config_args)
+        kwargs.apply_defaults()
+        kwargs = kwargs.arguments
+        cfg = BertConfig(
+            max_position_embeddings=kwargs["max_seq_len"],
+            num_attention_heads=kwargs["num_heads"],
+            hidden_size=kwargs["hidden_size"],
+            intermediate_size=kwargs["intermediate_size"],
+            num_hidden_layers=kwargs["num_hidden_layers"],
+            position_embedding_type=kwargs["position_embedding_type"],
+            use_cache=False,
+        )
+        return modelling.BertForDiffusionBase(
+            config=cfg,
+            time_encoding=kwargs["time_encoding"],
+            decoder=kwargs["decoder"],
+            precision=kwargs["precision"],
+        )
+
+    def test_default_precision(self):
+        """Test that a config without precision builds an fp32 model"""
+        model = self.build_model([self.config])
+        self.assertEqual(model.encoder_precision, "fp32")
+
+    def test_precision_override(self):
+        """Test that --precision overrides the config"""
+        model = self.build_model([self.config, "--precision", "bf16"])
+        self.assertEqual(model.encoder_precision, "bf16")
+
+
 if __name__ == "__main__":
     unittest.main()